@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""Speed and exactness of the final allocation, from weights to wei amounts.
+
+Compares the float shares converted with `int(amount*DECIMALS)`, as the
+amounts used to be sent, with the exact largest-remainder `allocate`.
+
+Run with `python benchmarks/bench_allocation.py [address_count]`.
+"""
+import random
+import sys
+import time
+
+from poolmonitor.accrual import compute_rewards, allocate
+from poolmonitor.ethereum import DECIMALS, to_wei
+
+
+def synthetic_weights(count, seed=0):
+    """Balance-blocks of `count` holders, from dust to whales."""
+    rnd = random.Random(seed)
+    return {'0x%040x' % rnd.getrandbits(160):
+            rnd.getrandbits(rnd.randrange(40, 100)) * rnd.randrange(1, 45000)
+            for _ in range(count)}
+
+
+def main(count=1000000, per_block=1.4, blocks=45000):
+    weights = synthetic_weights(count)
+    total = to_wei(per_block) * blocks
+    print(f"{len(weights)} addresses, {total} wei to allocate")
+
+    started = time.perf_counter()
+    rewards = compute_rewards(weights, sum(weights.values()), per_block, blocks)
+    floats = {a: int(amount*DECIMALS) for a, amount in rewards.items()}
+    float_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    exact = allocate(weights, total)
+    exact_time = time.perf_counter() - started
+
+    for name, amounts, elapsed in (("floats", floats, float_time),
+                                   ("allocate", exact, exact_time)):
+        missing = total - sum(amounts.values())
+        print(f"  {name + ':':<10} {elapsed:.2f}s, total off by {missing} wei")
+    print(f"  largest per-address difference: "
+          f"{max(abs(exact[a] - floats[a]) for a in weights)} wei")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""Compare the fast Transfer decoder with web3's generic event decoding.
+
+Run with `python benchmarks/bench_decoder.py [log_count] [holder_count]`.
+"""
+import random
+import sys
+import time
+
+from web3 import Web3
+from web3._utils.method_formatters import log_entry_formatter
+
+from poolmonitor.decoder import (TRANSFER_TOPIC, decode_transfers,
+                                 decode_transfer_event)
+from poolmonitor.uniswap import get_contract_abi
+
+POOL_ADDRESS = '0x29bA3D899E8a819Cf920adAfF53ef1CF31969E66'
+
+
+def synthetic_logs(count, holders, seed=0):
+    rnd = random.Random(seed)
+    addresses = ['%064x' % rnd.getrandbits(160) for _ in range(holders)]
+    logs = []
+    for i in range(count):
+        logs.append(log_entry_formatter({
+            'address': POOL_ADDRESS,
+            'blockNumber': hex(10000000 + i // 4),
+            'blockHash': '0x%064x' % (i // 4),
+            'transactionHash': '0x%064x' % i,
+            'transactionIndex': '0x0',
+            'logIndex': hex(i % 4),
+            'removed': False,
+            'topics': ['0x' + TRANSFER_TOPIC.hex(),
+                       '0x' + rnd.choice(addresses),
+                       '0x' + rnd.choice(addresses)],
+            'data': '0x%064x' % rnd.getrandbits(80),
+        }))
+    return logs
+
+
+def main(count=100000, holders=5000):
+    web3 = Web3()
+    abi = [item for item in get_contract_abi()
+           if item.get('name') == 'Transfer'][0]
+    logs = synthetic_logs(count, holders)
+
+    started = time.perf_counter()
+    generic = [decode_transfer_event(web3.codec, abi, log) for log in logs]
+    generic_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    fast = decode_transfers(web3.codec, abi, logs)
+    fast_time = time.perf_counter() - started
+
+    assert fast == generic
+    print(f"{count} logs, {holders} holders")
+    print(f"get_event_data:   {generic_time:.3f}s "
+          f"({count / generic_time:,.0f} logs/s)")
+    print(f"decode_transfers: {fast_time:.3f}s "
+          f"({count / fast_time:,.0f} logs/s)")
+    print(f"speedup:          {generic_time / fast_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
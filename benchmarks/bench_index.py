@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""Memory use and lookup speed of the balance timeline indexes.
+
+Run with `python benchmarks/bench_index.py [holder_count] [transfer_count]`.
+"""
+import random
+import sys
+import time
+import tracemalloc
+
+from poolmonitor.settings import config
+from poolmonitor.index import BalanceIndex, RewardIndex
+
+ZERO = "0x0000000000000000000000000000000000000000"
+
+
+def synthetic_transfers(holders, count, seed=0):
+    """Mints to every holder, then random transfers between them."""
+    rnd = random.Random(seed)
+    addresses = ['0x%040x' % rnd.getrandbits(160) for _ in range(holders)]
+    balances = dict()
+    height = 10000000
+    for addr in addresses:
+        height += rnd.randrange(2)
+        amount = rnd.getrandbits(70) + 1
+        balances[addr] = amount
+        yield height, 0, None, ZERO, addr, amount
+    for _ in range(count - holders):
+        height += rnd.randrange(2)
+        src, dst = rnd.choice(addresses), rnd.choice(addresses)
+        amount = rnd.randrange(balances[src] + 1)
+        balances[src] -= amount
+        balances[dst] += amount
+        yield height, 0, None, src, dst, amount
+
+
+def measure(index_class, holders, count):
+    transfers = list(synthetic_transfers(holders, count))
+    started = time.perf_counter()
+    index = index_class({'start_height': 0})
+    index.add_transfers(transfers, transfers[-1][0])
+    build_time = time.perf_counter() - started
+
+    # Built again for the memory, tracing slows it down a lot.
+    del index
+    tracemalloc.start()
+    index = index_class({'start_height': 0})
+    index.add_transfers(transfers, transfers[-1][0])
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    addresses = list(index.timelines)
+    last = transfers[-1][0]
+    rnd = random.Random(1)
+    queries = [(rnd.choice(addresses), rnd.randrange(10000000, last))
+               for _ in range(100000)]
+    started = time.perf_counter()
+    for address, height in queries:
+        index.balance_at(address, height)
+    lookup_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    index.holders_at(last - (last - 10000000) // 2, top=100)
+    holders_time = time.perf_counter() - started
+
+    print(f"{index_class.__name__}: {len(index.timelines)} addresses, "
+          f"{count} transfers")
+    print(f"  build:       {build_time:.2f}s")
+    print(f"  memory:      {size / 2**20:.1f} MiB "
+          f"({size / count:.0f} bytes per transfer)")
+    print(f"  balance_at:  {lookup_time / len(queries) * 1e6:.2f}us")
+    print(f"  holders_at:  {holders_time:.2f}s")
+
+
+def main(holders=100000, count=500000):
+    config.setdefault('reward_start', 0)
+    measure(BalanceIndex, holders, count)
+    measure(RewardIndex, holders, count)
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""Serial scan against the threaded fetch/decode/accrual pipeline.
+
+The node is simulated by a fixed delay per window of logs, decoding and
+accrual are the real ones.
+
+Run with `python benchmarks/bench_pipeline.py [log_count] [window_delay]`.
+"""
+import sys
+import time
+
+from web3 import Web3
+
+from poolmonitor.accrual import RewardAccrual
+from poolmonitor.decoder import decode_transfers
+from poolmonitor.pipeline import Pipeline, iter_batches
+from poolmonitor.uniswap import get_contract_abi
+
+from bench_decoder import synthetic_logs
+
+WINDOW = 1000
+
+
+def fetch(logs, delay):
+    for batch in iter_batches(logs, WINDOW):
+        time.sleep(delay)
+        yield batch
+
+
+def accrue(transfers_batches):
+    accrual = RewardAccrual(0)
+    for transfers in transfers_batches:
+        for height, log_index, block_hash, src, dst, amount in transfers:
+            accrual.transfer(height, src, dst, amount)
+    return accrual.finalize(20000000)
+
+
+def main(count=200000, delay=0.02):
+    web3 = Web3()
+    abi = [item for item in get_contract_abi()
+           if item.get('name') == 'Transfer'][0]
+    logs = synthetic_logs(count, 5000)
+
+    def decode(batch):
+        return decode_transfers(web3.codec, abi, batch)
+
+    started = time.perf_counter()
+    list(fetch(logs, delay))
+    fetch_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    serial = accrue(decode(batch) for batch in fetch(logs, delay))
+    serial_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    pipeline = Pipeline('bench', fetch(logs, delay), [('decode', decode)])
+    piped = accrue(pipeline)
+    pipeline_time = time.perf_counter() - started
+
+    assert piped == serial
+    print(f"{count} logs, {delay * 1000:.0f}ms per {WINDOW} logs window")
+    print(f"  fetch only: {fetch_time:.2f}s")
+    print(f"  serial:     {serial_time:.2f}s")
+    print(f"  pipeline:   {pipeline_time:.2f}s")
+
+
+if __name__ == "__main__":
+    main(*[(float if '.' in arg else int)(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""End-to-end `poolmonitor run` against a synthetic chain, offline.
+
+A synthetic history is served by the local stand-in node of
+`synthetic_chain`, and `commands.main` is run on it with `--profile`, first
+with an empty cache (cold) then with the cache filled (warm). The wall time
+of each run and of each phase is printed, compared with the last recorded
+run of the same parameters, and appended to the history file, so
+regressions show up across versions.
+
+Run from this directory with `python bench_run.py [options]`, see `--help`.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+import yaml
+
+import poolmonitor
+from poolmonitor.commands import main as run_main
+from poolmonitor.ethereum import get_web3, get_token_contract
+
+from synthetic_chain import SyntheticChain, serve, TOKEN, MULTICALL
+
+DEFAULT_CONFIG = Path(poolmonitor.__file__).parent / 'config_default.yaml'
+
+
+def write_config(path, chain, url, cache_path, **web3_options):
+    with open(DEFAULT_CONFIG) as f:
+        config = yaml.safe_load(f)
+    config['web3'].update(url=url, urls=[], mode='rpc', chain_id=1,
+                          multicall_address=MULTICALL, **web3_options)
+    config['pools'] = [{'address': pool.address,
+                        'start_height': chain.start_height,
+                        'type': 'uniswap'}
+                       for pool in chain.pools.values()]
+    config['reward_start'] = chain.start_height
+    config['token']['address'] = TOKEN
+    config['cache'].update(enabled=True, path=str(cache_path))
+    with open(path, 'w') as f:
+        yaml.safe_dump(config, f)
+
+
+def get_phases(metrics):
+    """Seconds per phase, summed over the pools."""
+    phases = dict()
+    for counter in metrics['counters']:
+        if counter['name'] == 'phase_seconds':
+            phase = counter['labels']['phase']
+            phases[phase] = phases.get(phase, 0) + counter['value']
+    return phases
+
+
+def get_rpc_calls(metrics):
+    calls = dict()
+    for counter in metrics['counters']:
+        if counter['name'] == 'rpc_requests':
+            method = counter['labels']['method']
+            calls[method] = calls.get(method, 0) + counter['value']
+    return calls
+
+
+def run(config_path, metrics_path, start_height, end_height):
+    # Fresh connections and contracts for each configuration.
+    get_web3.cache_clear()
+    get_token_contract.cache_clear()
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        run_main(['-c', str(config_path), '-s', str(start_height),
+                  '-e', str(end_height), '--no-post', '--profile',
+                  '--profile-output', str(metrics_path)])
+    wall = time.perf_counter() - started
+    with open(metrics_path) as f:
+        metrics = json.load(f)
+    return {'wall': wall, 'phases': get_phases(metrics),
+            'rpc_calls': get_rpc_calls(metrics)}
+
+
+def get_version():
+    try:
+        commit = subprocess.run(
+            ['git', 'describe', '--always', '--dirty'], capture_output=True,
+            text=True, cwd=Path(__file__).parent).stdout.strip()
+    except OSError:
+        commit = ''
+    return f"{poolmonitor.__version__} {commit}".strip()
+
+
+def load_previous(history_path, params):
+    if not os.path.exists(history_path):
+        return None
+    previous = None
+    with open(history_path) as f:
+        for line in f:
+            record = json.loads(line)
+            if record['params'] == params:
+                previous = record
+    return previous
+
+
+def format_change(value, before):
+    if before is None or not before:
+        return ''
+    change = (value - before) / before * 100
+    return f"{change:+.0f}% vs {before:.2f}s"
+
+
+def print_results(results, previous, threshold):
+    regressions = list()
+    for scenario, result in results.items():
+        before = previous and previous['results'].get(scenario)
+        print(f"{scenario}: {result['wall']:.2f}s "
+              f"{format_change(result['wall'], before and before['wall'])}")
+        timings = [('wall', result['wall'], before and before['wall'])] + [
+            (phase, seconds, before and before['phases'].get(phase))
+            for phase, seconds in result['phases'].items()]
+        for phase, seconds, phase_before in sorted(
+                timings[1:], key=lambda item: -item[1]):
+            print(f"  {phase:<16} {seconds:>8.2f}s "
+                  f"{format_change(seconds, phase_before)}")
+        print(f"  RPC calls: {json.dumps(result['rpc_calls'])}")
+        for phase, seconds, phase_before in timings:
+            # Ignore the noise of very short phases.
+            if phase_before and seconds > 0.1 \
+                    and seconds > phase_before * (1 + threshold):
+                regressions.append(f"{scenario} {phase}")
+    if regressions:
+        print(f"Slower than the previous run by more than "
+              f"{threshold:.0%}: {', '.join(regressions)}")
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--holders', type=int, default=2000)
+    parser.add_argument('--events', type=int, default=50000)
+    parser.add_argument('--blocks', type=int, default=500000)
+    parser.add_argument('--pools', type=int, default=2)
+    parser.add_argument('--max-results', type=int, default=10000,
+                        help="logs above which eth_getLogs is refused")
+    parser.add_argument('--latency', type=float, default=0,
+                        help="seconds added to every RPC request")
+    parser.add_argument('--block-range', type=int, default=50000,
+                        help="web3.big_block_range of the runs")
+    parser.add_argument('--history', default='.bench_history.jsonl',
+                        help="JSON lines file of the previous results")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="relative slowdown reported as a regression")
+    parser.add_argument('--no-record', dest='record', action='store_false',
+                        help="don't append the results to the history")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    params = {'holders': args.holders, 'events': args.events,
+              'blocks': args.blocks, 'pools': args.pools,
+              'max_results': args.max_results, 'latency': args.latency,
+              'block_range': args.block_range}
+
+    started = time.perf_counter()
+    chain = SyntheticChain(args.holders, args.events, args.blocks, args.pools)
+    print(f"{chain.log_count} logs in {args.pools} pools over {args.blocks} "
+          f"blocks, generated in {time.perf_counter() - started:.2f}s")
+    server = serve(chain, args.max_results, args.latency)
+
+    results = dict()
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            config_path = tmp / 'config.yaml'
+            write_config(config_path, chain, server.url, tmp / 'cache',
+                         big_block_range=args.block_range)
+            for scenario in ('cold', 'warm'):
+                results[scenario] = run(config_path, tmp / 'metrics.json',
+                                        chain.start_height, chain.height)
+    finally:
+        server.shutdown()
+
+    previous = load_previous(args.history, params)
+    regressions = print_results(results, previous, args.threshold)
+    if args.record:
+        with open(args.history, 'a') as f:
+            f.write(json.dumps({'version': get_version(),
+                                'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                                'params': params, 'results': results}) + '\n')
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""Synthetic Uniswap pair histories served by a local JSON-RPC stand-in.
+
+`SyntheticChain` generates the Transfer and Sync logs of `pools` pairs of
+the configured token with `holders` addresses, spread over `blocks` blocks.
+`serve` answers, on localhost, what a run needs from a node:
+
+- `eth_blockNumber`, `eth_chainId`, `eth_getBlockByNumber`
+- `eth_getLogs`, refusing queries of more than `max_results` logs with the
+  -32005 error nodes send, so the range splitting is exercised
+- `eth_call` to the pairs (`getReserves`, `token0`, `token1`) and to the
+  Multicall `aggregate` of them
+
+An optional `latency`, in seconds, is added to every request.
+"""
+import json
+import random
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from eth_abi import decode_abi, encode_abi
+from eth_utils import (event_signature_to_log_topic,
+                       function_signature_to_4byte_selector, to_checksum_address)
+
+ZERO = "0x0000000000000000000000000000000000000000"
+TOKEN = "0x27702a26126e0B3702af63Ee09aC4d1A084EF628"
+WETH = "0xC02aaA39b223FE8D0A0e5C4F27eAD9083C756Cc2"
+MULTICALL = "0xcA11bde05977b3631167028862bE2a173976CA11"
+
+TRANSFER_TOPIC = '0x' + event_signature_to_log_topic(
+    "Transfer(address,address,uint256)").hex()
+SYNC_TOPIC = '0x' + event_signature_to_log_topic(
+    "Sync(uint112,uint112)").hex()
+
+AGGREGATE = function_signature_to_4byte_selector(
+    "aggregate((address,bytes)[])")
+GET_RESERVES = function_signature_to_4byte_selector("getReserves()")
+TOKEN0 = function_signature_to_4byte_selector("token0()")
+TOKEN1 = function_signature_to_4byte_selector("token1()")
+
+
+def topic_address(address):
+    return '0x' + '0' * 24 + address[2:].lower()
+
+
+class SyntheticPool:
+    def __init__(self, address):
+        self.address = address
+        self.logs = list()
+        self.heights = list()
+        self.sync_heights = list()
+        self.reserves = list()
+
+    def add_log(self, height, log_index, topics, data):
+        self.logs.append({
+            'address': self.address,
+            'topics': topics,
+            'data': data,
+            'blockNumber': hex(height),
+            'blockHash': '0x%064x' % height,
+            'transactionHash': '0x%064x' % (height * 1000 + log_index),
+            'transactionIndex': '0x0',
+            'logIndex': hex(log_index),
+            'removed': False,
+        })
+        self.heights.append(height)
+
+    def reserves_at(self, height):
+        i = bisect_right(self.sync_heights, height) - 1
+        return self.reserves[i] if i >= 0 else (0, 0)
+
+
+class SyntheticChain:
+    def __init__(self, holders=1000, events=20000, blocks=100000, pools=1,
+                 start_height=10000000, seed=0):
+        rnd = random.Random(seed)
+        self.start_height = start_height
+        self.height = start_height + blocks
+        self.holders = ['0x%040x' % rnd.getrandbits(160)
+                        for _ in range(holders)]
+        self.pools = dict()
+        for i in range(pools):
+            address = to_checksum_address('0x%040x' % rnd.getrandbits(160))
+            self.pools[address.lower()] = self.generate(
+                SyntheticPool(address), rnd, events // pools, blocks)
+
+    def generate(self, pool, rnd, events, blocks):
+        heights = sorted(rnd.randrange(self.start_height, self.height)
+                         for _ in range(events))
+        balances = dict()
+        reserve0 = reserve1 = 0
+        last_height = log_index = None
+        for height in heights:
+            log_index = log_index + 1 if height == last_height else 0
+            last_height = height
+            holding = [a for a, b in balances.items() if b > 0]
+            kind = rnd.random()
+            if not holding or kind < 0.2:
+                src, dst = ZERO, rnd.choice(self.holders)
+                amount = rnd.getrandbits(70) + 1
+            elif kind < 0.3:
+                src, dst = rnd.choice(holding), ZERO
+                amount = rnd.randrange(1, balances[src] + 1)
+            else:
+                src, dst = rnd.choice(holding), rnd.choice(self.holders)
+                amount = rnd.randrange(1, balances[src] + 1)
+            balances[src] = balances.get(src, 0) - amount
+            balances[dst] = balances.get(dst, 0) + amount
+            pool.add_log(height, log_index,
+                         [TRANSFER_TOPIC, topic_address(src),
+                          topic_address(dst)], '0x%064x' % amount)
+            if ZERO in (src, dst):
+                sign = 1 if src == ZERO else -1
+                reserve0 = max(reserve0 + sign * amount * 3, 0)
+                reserve1 = max(reserve1 + sign * amount, 0)
+                log_index += 1
+                pool.add_log(height, log_index, [SYNC_TOPIC],
+                             '0x%064x%064x' % (reserve0, reserve1))
+                pool.sync_heights.append(height)
+                pool.reserves.append((reserve0, reserve1))
+        return pool
+
+    @property
+    def log_count(self):
+        return sum(len(pool.logs) for pool in self.pools.values())
+
+    def get_logs(self, query):
+        addresses = query.get('address')
+        if isinstance(addresses, str):
+            addresses = [addresses]
+        start = int(query.get('fromBlock', '0x0'), 16)
+        end = query.get('toBlock', 'latest')
+        end = self.height if end == 'latest' else int(end, 16)
+        topics = query.get('topics') or [None]
+        first_topics = topics[0]
+        if isinstance(first_topics, str):
+            first_topics = [first_topics]
+
+        logs = list()
+        for address in addresses or self.pools:
+            pool = self.pools.get(address.lower())
+            if pool is None:
+                continue
+            for log in pool.logs[bisect_left(pool.heights, start):
+                                 bisect_right(pool.heights, end)]:
+                if first_topics is None or log['topics'][0] in first_topics:
+                    logs.append(log)
+        logs.sort(key=lambda log: (int(log['blockNumber'], 16),
+                                   int(log['logIndex'], 16)))
+        return logs
+
+    def call(self, to, data, height):
+        selector, arguments = data[:4], data[4:]
+        if to.lower() == MULTICALL.lower() and selector == AGGREGATE:
+            calls, = decode_abi(['(address,bytes)[]'], arguments)
+            return encode_abi(['uint256', 'bytes[]'], [
+                height, [self.call(target, call_data, height)
+                         for target, call_data in calls]])
+        pool = self.pools[to.lower()]
+        if selector == GET_RESERVES:
+            return encode_abi(['uint112', 'uint112', 'uint32'],
+                              [*pool.reserves_at(height), 0])
+        if selector == TOKEN0:
+            return encode_abi(['address'], [TOKEN])
+        if selector == TOKEN1:
+            return encode_abi(['address'], [WETH])
+        raise ValueError(f"Unknown call {data[:4].hex()}")
+
+
+def get_height(chain, tag):
+    if tag in (None, 'latest', 'pending'):
+        return chain.height
+    if tag == 'earliest':
+        return 0
+    return int(tag, 16)
+
+
+def handle(chain, method, params, max_results):
+    """Result of a JSON-RPC call, or raises `RPCError`."""
+    if method == 'eth_blockNumber':
+        return hex(chain.height)
+    if method == 'eth_chainId':
+        return '0x1'
+    if method == 'net_version':
+        return '1'
+    if method == 'eth_getBlockByNumber':
+        height = get_height(chain, params[0])
+        return {'number': hex(height), 'hash': '0x%064x' % height,
+                'parentHash': '0x%064x' % (height - 1),
+                'timestamp': hex(1600000000 + height * 13),
+                'transactions': []}
+    if method == 'eth_getLogs':
+        logs = chain.get_logs(params[0])
+        if len(logs) > max_results:
+            raise RPCError(-32005, f"query returned more than {max_results} "
+                                   f"results")
+        return logs
+    if method == 'eth_call':
+        transaction = params[0]
+        data = bytes.fromhex(transaction['data'][2:])
+        height = get_height(chain, params[1] if len(params) > 1 else None)
+        return '0x' + chain.call(transaction['to'], data, height).hex()
+    raise RPCError(-32601, f"the method {method} does not exist")
+
+
+class RPCError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+def serve(chain, max_results=10000, latency=0, port=0):
+    """Serve `chain` in a background thread, return the server, its URL
+    being `server.url`."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            request = json.loads(self.rfile.read(
+                int(self.headers['Content-Length'])))
+            if latency:
+                time.sleep(latency)
+            response = {'jsonrpc': '2.0', 'id': request.get('id')}
+            try:
+                response['result'] = handle(chain, request['method'],
+                                            request.get('params') or [],
+                                            max_results)
+            except RPCError as e:
+                response['error'] = {'code': e.code, 'message': e.message}
+            body = json.dumps(response).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,181 @@
+"""Incremental reward accrual.
+
+Holders earn "balance-blocks": their positive balance multiplied by the
+number of blocks it was held. Instead of crediting every holder on every
+Transfer, the accrual remembers the height at which each address was last
+settled and only credits the addresses a transfer touches. A global counter
+of positive supply keeps the total weight up to date at the same cost.
+"""
+from .settings import config
+
+
+class RewardAccrual:
+    """Accumulates per-address balance-blocks over a reward window.
+
+    The accrual clock opens on the first transfer after `reward_start`, from
+    the height of the previous transfer (or `reward_start` if none was seen),
+    which is how the history processors have always measured the window.
+    """
+
+    def __init__(self, reward_start):
+        self.reward_start = reward_start
+        self.last_height = reward_start
+        self.origin = None
+        self.balances = dict()
+        self.weights = dict()
+        self.settled = dict()
+        self.supply = 0
+        self.total_weight = 0
+
+    @property
+    def started(self):
+        return self.origin is not None
+
+    def _settle(self, addr, height):
+        balance = self.balances.get(addr, 0)
+        if balance > 0:
+            since = self.settled.get(addr, self.origin)
+            if height > since:
+                self.weights[addr] = (self.weights.get(addr, 0)
+                                      + balance * (height - since))
+        self.settled[addr] = height
+
+    def _advance(self, height):
+        if self.origin is None:
+            self.origin = self.last_height
+        self.total_weight += self.supply * (height - self.last_height)
+
+    def restore(self, balances, last_height=None):
+        """Resume from `balances` snapshotted before the reward window.
+
+        `last_height` is the height of the last transfer included in the
+        snapshot, if any.
+        """
+        self.balances = dict(balances)
+        self.supply = sum(b for b in self.balances.values() if b > 0)
+        if last_height is not None:
+            self.last_height = last_height
+
+    def transfer(self, height, src, dst, amount):
+        """Apply a Transfer of `amount` from `src` to `dst` at `height`."""
+        if height > self.reward_start:
+            self._advance(height)
+            self._settle(src, height)
+            self._settle(dst, height)
+
+        for addr, delta in ((src, -amount), (dst, amount)):
+            before = self.balances.get(addr, 0)
+            after = before + delta
+            self.balances[addr] = after
+            self.supply += max(after, 0) - max(before, 0)
+
+        self.last_height = height
+
+    def to_dict(self):
+        """Serializable state, reloaded with `from_dict`."""
+        return {
+            'reward_start': self.reward_start,
+            'last_height': self.last_height,
+            'origin': self.origin,
+            'balances': {a: str(b) for a, b in self.balances.items()},
+            'weights': {a: str(w) for a, w in self.weights.items()},
+            'settled': self.settled,
+            'supply': str(self.supply),
+            'total_weight': str(self.total_weight)
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        accrual = cls(state['reward_start'])
+        accrual.last_height = state['last_height']
+        accrual.origin = state['origin']
+        accrual.balances = {a: int(b) for a, b in state['balances'].items()}
+        accrual.weights = {a: int(w) for a, w in state['weights'].items()}
+        accrual.settled = dict(state['settled'])
+        accrual.supply = int(state['supply'])
+        accrual.total_weight = int(state['total_weight'])
+        return accrual
+
+    def finalize(self, end_height):
+        """Settle every holder up to `end_height` and return the weights.
+
+        Weights are returned in first-seen order of the addresses, without
+        zero entries.
+        """
+        self._advance(end_height)
+        self.last_height = end_height
+        for addr in self.balances:
+            self._settle(addr, end_height)
+
+        return {a: self.weights[a] for a in self.balances
+                if self.weights.get(a, 0) > 0}
+
+
+class TimeWeightedAverage:
+    """Average over the blocks of `[start, end]` of a value changing in
+    steps."""
+
+    def __init__(self, start, value=0):
+        self.start = start
+        self.height = start
+        self.value = value
+        self.area = 0
+
+    def update(self, height, value):
+        if height > self.height:
+            self.area += self.value * (height - self.height)
+            self.height = height
+        self.value = value
+
+    def to_dict(self):
+        return {'start': self.start, 'height': self.height,
+                'value': str(self.value), 'area': str(self.area)}
+
+    @classmethod
+    def from_dict(cls, state):
+        average = cls(state['start'], int(state['value']))
+        average.height = state['height']
+        average.area = int(state['area'])
+        return average
+
+    def average(self, end):
+        if end <= self.start:
+            return self.value
+        area = self.area + self.value * max(end - self.height, 0)
+        return area / (end - self.start)
+
+
+def compute_rewards(weights, total_weight, per_block, total_blocks):
+    """Split `per_block * total_blocks` between holders by weight."""
+    shares = {a: w / total_weight for a, w in weights.items()}
+    return {a: s*per_block*total_blocks for a, s in shares.items()}
+
+
+def get_reward_start(pool, start_height):
+    """First block of `pool` rewards for a window opening at
+    `start_height`."""
+    return max(pool['start_height'], config['reward_start'], start_height)
+
+
+def allocate(weights, total):
+    """Split the integer `total` between `weights` in proportion, exactly.
+
+    Each address gets the floor of its share, and the units left over go one
+    by one to the largest remainders, ties in `weights` order, so the amounts
+    always sum to `total`. Weights are ints or `Fraction`s.
+    """
+    weight_sum = sum(weights.values())
+    if not weights or not weight_sum or total <= 0:
+        return {a: 0 for a in weights}
+
+    shares = [divmod(total * weight, weight_sum)
+              for weight in weights.values()]
+    amounts = [amount for amount, remainder in shares]
+    left = total - sum(amounts)
+    if left:
+        remainders = [remainder for amount, remainder in shares]
+        ranked = sorted(range(len(remainders)), key=remainders.__getitem__,
+                        reverse=True)
+        for i in ranked[:left]:
+            amounts[i] += 1
+    return dict(zip(weights, amounts))
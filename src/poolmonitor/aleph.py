@@ -1,9 +1,18 @@
-    
-from aleph_client.main import create_post, get_posts
+import base64
+import json
+import os
+from pathlib import Path
+
+import requests
+from aleph_client.main import create_post, create_store, get_posts
+from aleph_client.asynchronous import get_posts as async_get_posts
 from aleph_client.chains.ethereum import ETHAccount
 from functools import lru_cache
 
 from .settings import config
+from .maps import ENCODING, split_distribution, join_distribution
+from .cassette import get_cassette
+from . import metrics
 
 @lru_cache(maxsize=32)
 def get_aleph_account():
@@ -15,41 +24,186 @@ def get_aleph_address():
     return (get_aleph_account()).get_address()
 
 
-def create_distribution_tx_post(distribution):
-    print(f"Preparing pending TX post {distribution}")
-    post = create_post(
+def store_distribution_maps(distribution):
+    """Store the per-address maps of `distribution` in a file and return
+    the summary referencing it."""
+    summary, data = split_distribution(distribution)
+    message = create_store(
         get_aleph_account(),
-        distribution,
-        post_type='incentive-distribution',
+        file_content=data,
+        storage_engine='storage',
         channel=config['aleph']['channel'],
         api_server=config['aleph']['api_server'])
+    summary['maps'] = {
+        'hash': message['content']['item_hash'],
+        'storage_engine': 'storage',
+        'encoding': ENCODING,
+        'size': len(data)
+    }
+    return summary
+
+
+def create_distribution_tx_post(distribution):
+    if config['aleph'].get('store_maps', False):
+        with metrics.timed('aleph_store'):
+            distribution = store_distribution_maps(distribution)
+    print(f"Preparing pending TX post {distribution}")
+    with metrics.timed('aleph_post'):
+        post = create_post(
+            get_aleph_account(),
+            distribution,
+            post_type='incentive-distribution',
+            channel=config['aleph']['channel'],
+            api_server=config['aleph']['api_server'])
+
+
+def fetch_stored_file(file_hash):
+    resp = requests.get(
+        f"{config['aleph']['api_server']}/api/v0/storage/raw/{file_hash}",
+        timeout=60)
+    resp.raise_for_status()
+    return resp.content
+
+
+@lru_cache(maxsize=8)
+def get_stored_file(file_hash):
+    """Content of a stored file, through the cassette if enabled."""
+    cassette = get_cassette()
+    if cassette is None:
+        return fetch_stored_file(file_hash)
+    return base64.b64decode(cassette.call(
+        'aleph_file', file_hash,
+        lambda: base64.b64encode(fetch_stored_file(file_hash)).decode()))
+
+
+def get_full_distribution(content):
+    """Return the distribution `content` with its per-address maps, fetching
+    them if they were stored apart. Only call it when the maps are needed,
+    the summary is enough for everything else."""
+    if 'maps' not in content:
+        return content
+    return join_distribution(content, get_stored_file(content['maps']['hash']))
+
+def get_distribution_cache_path():
+    cache_config = config.get('cache') or dict()
+    if not cache_config.get('enabled', False):
+        return None
+    path = Path(cache_config.get('path', '.poolmonitor'))
+    os.makedirs(path, exist_ok=True)
+    return path / f"latest_distribution_{config['web3']['chain_id']}.json"
+
+
+def load_latest_cache():
+    """Return the cache path of the latest distribution lookup and what it
+    holds, None for either if missing."""
+    cache_path = get_distribution_cache_path()
+    cached = None
+    if cache_path is not None and cache_path.exists():
+        with open(cache_path) as f:
+            cached = json.load(f)
+    return cache_path, cached
+
+
+def check_latest(post, cache_path, cached):
+    """Return the `(end_height, content)` of `post` if it's the latest
+    successful distribution, caching it, or None to look further."""
+    if cached is not None and post['item_hash'] == cached['hash']:
+        return cached['end_height'], cached['content']
+    if not is_successful_distribution(post['content']):
+        return None
+
+    end_height = max((pool['end']
+                      for pool in post['content'].get('pools', [])),
+                     default=0)
+    if cache_path is not None:
+        with open(cache_path, 'w') as f:
+            json.dump({'hash': post['item_hash'],
+                       'end_height': end_height,
+                       'content': post['content']}, f)
+    return end_height, post['content']
+
 
 def get_latest_successful_distribution():
-    posts = get_posts(
-        types=["incentive-distribution"],
-        addresses=[get_aleph_address()],
-        api_server=config['aleph']['api_server'])
+    """Return the end height and content of our latest successful
+    distribution, or `(0, None)`.
+
+    Posts are read newest first, page by page, until a successful one or
+    the one found by the previous run (cached locally by hash) shows up,
+    which usually takes a single small request.
+    """
+    cache_path, cached = load_latest_cache()
+    page_size = config['aleph'].get('page_size', 20)
+    with metrics.timed('aleph_latest'):
+        for post in iter_distribution_posts(page_size):
+            latest = check_latest(post, cache_path, cached)
+            if latest is not None:
+                return latest
+    return 0, None
+
+
+async def async_get_latest_successful_distribution():
+    """`get_latest_successful_distribution` for a running event loop, where
+    the synchronous aleph client can't be used."""
+    cache_path, cached = load_latest_cache()
+    page_size = config['aleph'].get('page_size', 20)
+    with metrics.timed('aleph_latest'):
+        async for post in async_iter_distribution_posts(page_size):
+            latest = check_latest(post, cache_path, cached)
+            if latest is not None:
+                return latest
+    return 0, None
+
+
+def get_posts_query(page_size, page):
+    return dict(pagination=page_size,
+                page=page,
+                types=["incentive-distribution"],
+                addresses=[get_aleph_address()],
+                api_server=config['aleph']['api_server'])
+
+
+def query_posts(query):
+    """Page of posts matching `query`, through the cassette if enabled."""
+    cassette = get_cassette()
+    if cassette is None:
+        return get_posts(**query)
+    return cassette.call('aleph', query, lambda: get_posts(**query))
+
+
+async def async_query_posts(query):
+    cassette = get_cassette()
+    if cassette is not None and cassette.replaying:
+        return cassette.replay('aleph', query)
+    posts = await async_get_posts(**query)
+    if cassette is not None:
+        cassette.record('aleph', query, posts)
+    return posts
+
+
+def iter_distribution_posts(page_size=200):
+    """Yield our incentive-distribution posts, newest first, page by page."""
+    page = 1
+    while True:
+        posts = query_posts(get_posts_query(page_size, page))
+        yield from posts['posts']
+        if len(posts['posts']) < page_size:
+            return
+        page += 1
+
+
+async def async_iter_distribution_posts(page_size=200):
+    page = 1
+    while True:
+        posts = await async_query_posts(get_posts_query(page_size, page))
+        for post in posts['posts']:
+            yield post
+        if len(posts['posts']) < page_size:
+            return
+        page += 1
+
 
-    current_post = None
-    current_end_height = 0
-    for post in posts['posts']:
-        successful = False
-        if post['content']['status'] != 'distribution':
-            pass
-
-        for target in post['content'].get('targets', []):
-            if target['success']:
-                successful = True
-                break
-        
-        if successful:
-            for pool in post['content'].get('pools', []):
-                if pool['end'] >= current_end_height:
-                    current_post = post
-                    current_end_height = pool['end']
-                    break
-    
-    if current_post is not None:
-        return current_end_height, current_post['content']
-    else:
-        return 0, None
\ No newline at end of file
+def is_successful_distribution(content):
+    """Whether tokens were sent for a distribution and at least one
+    transaction went through."""
+    return (content.get('status') == 'distribution'
+            and any(target['success'] for target in content.get('targets', [])))
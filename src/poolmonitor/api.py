@@ -0,0 +1,173 @@
+"""Local HTTP API serving pending rewards, the `serve` command.
+
+Each pool's `RewardIndex` is built once from its transfer history, then
+extended with the newly confirmed blocks every `refresh_interval` seconds.
+Queries are answered from the indexes alone, without touching the chain:
+
+    GET /pools
+    GET /pending/{address}?start=<height>&end=<height>
+
+`start` defaults to the block after the last successful distribution and
+`end` to the indexed height. Pool shares are the pool weights measured at
+the indexed height.
+"""
+import asyncio
+import logging
+
+from aiohttp import web
+from web3 import Web3
+
+from .settings import config
+from .ethereum import get_web3
+from .history import fetch_transfers, sync_store
+from .index import RewardIndex
+from .multicall import call_groups
+from .storage import open_store
+from .aleph import async_get_latest_successful_distribution
+from .commands import get_start_height, get_pool_weights
+
+LOGGER = logging.getLogger(__name__)
+
+
+def fetch_new_transfers(web3, pool, after_height, end_height):
+    """Return the transfers of `pool` in `(after_height, end_height]`,
+    through the cache when enabled."""
+    store = open_store(pool)
+    if store is None:
+        return list(fetch_transfers(web3, pool, after_height, end_height))
+    try:
+        sync_store(store, web3, pool, end_height)
+        return list(store.iter_transfers(after_height, end_height))
+    finally:
+        store.close()
+
+
+class RewardsState:
+    def __init__(self, pools):
+        self.pools = pools
+        self.indexes = {pool['address']: RewardIndex(pool) for pool in pools}
+        self.pool_weights = dict()
+        self.start_height = None
+        self.height = None
+
+    def fetch(self, web3):
+        """Fetch what the indexes miss, blocking. Returns the height and
+        the transfers to index, and the pool weights."""
+        confirmations = (config.get('api') or dict()).get('confirmations', 12)
+        height = web3.eth.blockNumber - confirmations
+        transfers = {
+            pool['address']: fetch_new_transfers(
+                web3, pool, self.indexes[pool['address']].height
+                or pool['start_height'], height)
+            for pool in self.pools}
+        weight_results = call_groups(
+            web3, [pool['weight_calls'](pool) for pool in self.pools], height)
+        return height, transfers, get_pool_weights(self.pools, weight_results)
+
+    def update(self, height, transfers, pool_weights, start_height):
+        for address, pool_transfers in transfers.items():
+            self.indexes[address].add_transfers(pool_transfers, height)
+        self.pool_weights = pool_weights
+        self.start_height = start_height
+        self.height = height
+
+    def pending(self, address, start_height, end_height):
+        per_block = config['reward_per_block']
+        return {
+            pool['address']: self.indexes[pool['address']].pending(
+                address, start_height, end_height,
+                per_block*self.pool_weights[pool['address']])
+            for pool in self.pools}
+
+
+async def refresh(app):
+    state = app['state']
+    web3 = get_web3()
+    loop = asyncio.get_event_loop()
+    # The synchronous aleph client needs an event loop of its own, look the
+    # last distribution up from this one instead of the executor.
+    start_height = get_start_height(
+        latest=await async_get_latest_successful_distribution())
+    # The indexes are only changed from the event loop, so requests never
+    # see them half updated.
+    fetched = await loop.run_in_executor(None, state.fetch, web3)
+    state.update(*fetched, start_height)
+    LOGGER.info(f"Indexed up to {state.height}")
+
+
+async def refresh_loop(app):
+    interval = (config.get('api') or dict()).get('refresh_interval', 60)
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await refresh(app)
+        except Exception:
+            LOGGER.exception("Error refreshing the reward indexes")
+
+
+async def start_refresh(app):
+    await refresh(app)
+    app['refresh'] = asyncio.ensure_future(refresh_loop(app))
+
+
+async def stop_refresh(app):
+    app['refresh'].cancel()
+
+
+def get_height_param(request, name, default):
+    value = request.query.get(name)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise web.HTTPBadRequest(text=f"Invalid {name} height")
+
+
+async def get_pools(request):
+    state = request.app['state']
+    return web.json_response({
+        'height': state.height,
+        'start': state.start_height,
+        'pools': [{'address': pool['address'],
+                   'type': pool.get('type', 'uniswap'),
+                   'weight': state.pool_weights[pool['address']]}
+                  for pool in state.pools]
+    })
+
+
+async def get_pending(request):
+    state = request.app['state']
+    try:
+        address = Web3.toChecksumAddress(request.match_info['address'])
+    except ValueError:
+        raise web.HTTPBadRequest(text="Invalid address")
+    start_height = get_height_param(request, 'start', state.start_height)
+    end_height = min(get_height_param(request, 'end', state.height),
+                     state.height)
+
+    pending = state.pending(address, start_height, end_height)
+    return web.json_response({
+        'address': address,
+        'start': start_height,
+        'end': end_height,
+        'pools': pending,
+        'total': sum(pending.values())
+    })
+
+
+def get_app(pools):
+    app = web.Application()
+    app['state'] = RewardsState(pools)
+    app.router.add_get('/pools', get_pools)
+    app.router.add_get('/pending/{address}', get_pending)
+    app.on_startup.append(start_refresh)
+    app.on_cleanup.append(stop_refresh)
+    return app
+
+
+def serve():
+    api_config = config.get('api') or dict()
+    web.run_app(get_app(config['pools']),
+                host=api_config.get('host', '127.0.0.1'),
+                port=api_config.get('port', 8080))
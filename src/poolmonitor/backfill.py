@@ -0,0 +1,160 @@
+"""Rewards of many past distribution windows in a single pass, the
+`backfill` command.
+
+Each pool's transfer history is replayed once through every epoch, the
+accumulators being closed at each boundary and carried over to the next
+epoch. Each epoch gets the reward map a run with the same `-s`/`-e` would
+compute. The pool weights are measured at the end of each epoch, which
+needs an archive node.
+"""
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from .settings import config
+from .ethereum import get_web3
+from .accrual import compute_rewards, get_reward_start
+from .aleph import iter_distribution_posts, is_successful_distribution
+from .history import replay_epochs
+from .multicall import call_groups
+from .commands import get_pool_weights, get_distribution
+from .verify import get_chains
+from . import metrics
+
+LOGGER = logging.getLogger(__name__)
+
+
+def get_block_epochs(start_height, end_height, every):
+    """Consecutive epochs of `every` blocks from `start_height`, the last
+    one ending at `end_height`."""
+    return [(start, min(start + every - 1, end_height))
+            for start in range(start_height, end_height + 1, every)]
+
+
+def get_boundary_epochs(start_height, boundaries):
+    """Epochs ending at each of `boundaries`, the first starting at
+    `start_height`."""
+    epochs = list()
+    for end in sorted(boundaries):
+        epochs.append((start_height, end))
+        start_height = end + 1
+    return epochs
+
+
+def get_posted_epochs():
+    """The `(start, end)` windows of our past successful distributions."""
+    epochs = set()
+    for post in iter_distribution_posts():
+        if is_successful_distribution(post['content']):
+            for pool in post['content'].get('pools', []):
+                epochs.add((pool['start'], pool['end']))
+    return sorted(epochs)
+
+
+def replay_pool(pool, epochs):
+    """Weights, total weight, reward start and average reserves of `pool`
+    for each epoch."""
+    results = list()
+    for accrual, last_event_height, reserve_tracker in replay_epochs(
+            pool, [(get_reward_start(pool, start), end)
+                   for start, end in epochs]):
+        end_height = epochs[len(results)][1]
+        averages = None
+        if reserve_tracker is not None:
+            averages = ([average.average(end_height)
+                         for average in reserve_tracker[0]],
+                        reserve_tracker[1])
+        if end_height <= accrual.reward_start:
+            # Ended before the pool rewards started.
+            results.append((dict(), 0, accrual.reward_start, averages))
+            continue
+        results.append((accrual.finalize(end_height), accrual.total_weight,
+                        accrual.reward_start, averages))
+    return results
+
+
+def backfill(epochs, pools):
+    """Return the distribution of each of the `(start, end)` epochs."""
+    web3 = get_web3()
+    per_block = config['reward_per_block']
+    time_weighted = config.get('pool_weight_mode', 'snapshot') == 'twa'
+
+    def replay(pool):
+        with metrics.timed('replay', pool=pool['address']):
+            return replay_pool(pool, epochs)
+
+    with ThreadPoolExecutor(
+            max_workers=config.get('pool_concurrency', 4)) as executor:
+        replayed = list(executor.map(replay, pools))
+
+    distributions = list()
+    for i, (start_height, end_height) in enumerate(epochs):
+        LOGGER.info(f"Epoch {start_height} to {end_height}")
+        with metrics.timed('pool_weights'):
+            weight_results = call_groups(
+                web3, [pool['weight_calls'](pool) for pool in pools],
+                end_height)
+        if time_weighted:
+            weight_results = [
+                pool['time_weighted_results'](pool, pool_results,
+                                              *pool_replayed[i][3])
+                for pool, pool_results, pool_replayed
+                in zip(pools, weight_results, replayed)]
+        pool_weights = get_pool_weights(pools, weight_results)
+
+        results = list()
+        allocations = list()
+        for pool, pool_replayed in zip(pools, replayed):
+            weights, total_weight, reward_start, averages = pool_replayed[i]
+            rewards = compute_rewards(
+                weights, total_weight,
+                per_block*pool_weights[pool['address']],
+                end_height - reward_start)
+            results.append((rewards, start_height, end_height))
+            allocations.append((weights, reward_start))
+
+        with metrics.timed('allocation'):
+            distribution, to_distribute = get_distribution(
+                pools, results, pool_weights, per_block, allocations)
+        distributions.append(distribution)
+    return distributions
+
+
+def get_epoch_chains(args):
+    """Lists of consecutive epochs to backfill, from the command `args`."""
+    if args.from_posts:
+        # Re-runs post overlapping or repeated windows, each chain of
+        # windows not overlapping is replayed on its own.
+        return get_chains(get_posted_epochs())
+
+    web3 = get_web3()
+    start_height = args.start_height
+    if start_height == -1:
+        start_height = config['reward_start']
+    end_height = args.end_height
+    if end_height == -1:
+        end_height = web3.eth.blockNumber
+    if args.boundaries:
+        epochs = get_boundary_epochs(
+            start_height, [int(h) for h in args.boundaries.split(',')])
+    else:
+        epochs = get_block_epochs(start_height, end_height, args.every)
+    return [epochs] if epochs else []
+
+
+def run_backfill(args):
+    chains = get_epoch_chains(args)
+    if not chains:
+        LOGGER.warning("No epoch to backfill")
+        return
+
+    backfilled = list()
+    for epochs in chains:
+        backfilled.extend(zip(epochs, backfill(epochs, config['pools'])))
+    distributions = [distribution for epoch, distribution
+                     in sorted(backfilled, key=lambda item: item[0])]
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(distributions, f)
+    else:
+        print(json.dumps(distributions))
@@ -2,15 +2,12 @@ import json
 import os
 from pathlib import Path
 from .settings import config
-from .ethereum import get_web3, get_logs
+from .ethereum import get_web3
+from .history import process_transfer_history
 
 
 from web3 import Web3
-from web3._utils.events import (
-    construct_event_topic_set,
-)
 from web3.middleware import geth_poa_middleware, local_filter_middleware
-from web3.contract import get_event_data
 from web3.gas_strategies.rpc import rpc_gas_price_strategy
 
 
@@ -30,56 +27,58 @@ def set_pools():
             pool['contract'] = get_pair(Web3.toChecksumAddress(pool['address']), web3)
             pool['history_processor'] = process_pool_history
             pool['weight_processor'] = get_pool_weight
+            pool['weight_calls'] = get_pool_weight_calls
+            pool['weight_from_calls'] = compute_pool_weight
+            pool['reserve_events'] = get_reserve_events
+            pool['reserve_change'] = get_reserve_change
+            pool['time_weighted_results'] = get_time_weighted_results
 
 
 def process_pool_history(pool, per_block, start_height, end_height):
-    abi = pool['contract'].events.Transfer._get_event_abi()
-    web3 = get_web3()
-    topic = construct_event_topic_set(abi, web3.codec)
-    weights = dict()
-    balances = dict()
-    reward_start = max(pool['start_height'], config['reward_start'], start_height)
-    last_height = reward_start
-    end_height = min(web3.eth.blockNumber, end_height)
-
-    def update_weights(since, current):
-        for addr, value in balances.items():
-            if value > 0:
-                weights[addr] = weights.get(addr, 0) + (value * (current-since))
-
-    for i in get_logs(web3, pool['contract'], pool['start_height'], topics=topic):
-        evt_data = get_event_data(web3.codec, abi, i)
-        args = evt_data['args']
-        height = evt_data['blockNumber']
-        if height > end_height:
-            break
-
-        if height > reward_start:
-            update_weights(last_height, height)
-
-        balances[args['src']] = balances.get(args['src'], 0) - args.amt
-        balances[args.dst] = balances.get(args.dst, 0) + args.amt
-        last_height = height
-    
-    height = end_height
-    update_weights(last_height, height)
-    total_weight = sum(weights.values())
-    total_balance = sum([b for b in balances.values() if b > 0])
-    weights = {a: w / total_weight for a, w in weights.items() if w > 0}
-    print(weights)
-    balparts = {a: w / total_balance for a, w in balances.items() if w > 0}
-    print(balparts)
-
-    total_blocks = height - reward_start
-    reward_owed = {a: w*per_block*total_blocks for a, w in weights.items()}
-    print(reward_owed)
-    print("Total", sum(reward_owed.values()))
-    return reward_owed, start_height, end_height
+    return process_transfer_history(pool, per_block, start_height, end_height)
 
-def get_pool_weight(pool):
-    aleph_weight = pool['contract'].functions.getNormalizedWeight(
-        Web3.toChecksumAddress(config['token']['address'])).call() / (10**18)
+def get_pool_weight_calls(pool):
+    token = Web3.toChecksumAddress(config['token']['address'])
+    return [pool['contract'].functions.getNormalizedWeight(token),
+            pool['contract'].functions.getBalance(token)]
+
+
+def compute_pool_weight(pool, results):
+    normalized_weight, aleph_reserve = results
+    aleph_weight = normalized_weight / (10**18)
     pool_ratio = 1/aleph_weight
-    aleph_reserve = pool['contract'].functions.getBalance(
-        Web3.toChecksumAddress(config['token']['address'])).call()
-    return aleph_reserve * pool_ratio
\ No newline at end of file
+    return aleph_reserve * pool_ratio
+
+
+def get_reserve_events(pool):
+    events = pool['contract'].events
+    return [events.LOG_JOIN._get_event_abi(),
+            events.LOG_EXIT._get_event_abi(),
+            events.LOG_SWAP._get_event_abi()]
+
+
+def get_reserve_change(pool, evt_data):
+    # Only the token movements are logged, track the change of reserve.
+    token = config['token']['address'].lower()
+    args = evt_data['args']
+    change = 0
+    if evt_data['event'] in ('LOG_JOIN', 'LOG_SWAP') and args.tokenIn.lower() == token:
+        change += args.tokenAmountIn
+    if evt_data['event'] == 'LOG_EXIT' and args.tokenOut.lower() == token:
+        change -= args.tokenAmountOut
+    if evt_data['event'] == 'LOG_SWAP' and args.tokenOut.lower() == token:
+        change -= args.tokenAmountOut
+    if change:
+        return False, change, 0
+
+
+def get_time_weighted_results(pool, results, averages, reserves):
+    normalized_weight, aleph_reserve = results
+    # The tracked reserve is only known up to a constant, anchor it on the
+    # reserve read at the end of the window.
+    return [normalized_weight, aleph_reserve + averages[0] - reserves[0]]
+
+
+def get_pool_weight(pool):
+    return compute_pool_weight(
+        pool, [call.call() for call in get_pool_weight_calls(pool)])
\ No newline at end of file
@@ -0,0 +1,145 @@
+"""Record and replay of the node, explorer and aleph responses.
+
+In `record` mode, every JSON-RPC response given to `get_web3()`, every
+explorer API result, and the aleph posts and files read to find the past
+distributions are kept in a cassette, keyed by a hash of their request, and
+written to a gzipped JSON file at exit. In `replay` mode, responses are
+served from the cassette loaded in memory, without any network access: a
+run over the same range as the recorded one is then deterministic and only
+takes CPU time. A request missing from the cassette raises `CassetteMiss`.
+Writes (transactions, aleph posts) are never replayed, `--replay` refuses
+`--act` and requires `--no-post`.
+
+JSON-RPC error responses are recorded too, so the getLogs queries refused
+for their size are split the same way on replay. Failed requests are not.
+"""
+import atexit
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+from functools import lru_cache
+
+from web3._utils.encoding import Web3JsonEncoder
+from web3.providers.base import BaseProvider
+
+from .settings import config
+
+LOGGER = logging.getLogger(__name__)
+
+VERSION = 1
+
+
+class CassetteMiss(Exception):
+    pass
+
+
+def get_request_key(kind, request):
+    encoded = json.dumps([kind, request], cls=Web3JsonEncoder,
+                         sort_keys=True, separators=(',', ':'))
+    return hashlib.blake2b(encoded.encode(), digest_size=16).hexdigest()
+
+
+class Cassette:
+    def __init__(self, path, mode):
+        if mode not in ('record', 'replay'):
+            raise ValueError(f"Unknown cassette mode {mode}")
+        self.path = path
+        self.mode = mode
+        self.entries = dict()
+        self.lock = threading.Lock()
+        self.recorded = 0
+        if os.path.exists(path):
+            # Recording over an existing cassette extends it.
+            self.load()
+        elif mode == 'replay':
+            raise FileNotFoundError(f"No cassette at {path}")
+
+    @property
+    def replaying(self):
+        return self.mode == 'replay'
+
+    def load(self):
+        with gzip.open(self.path, 'rt') as f:
+            content = json.load(f)
+        if content.get('version') != VERSION:
+            raise ValueError(f"Unsupported cassette version in {self.path}")
+        self.entries = content['entries']
+
+    def save(self):
+        if not self.recorded:
+            return
+        tmp_path = f"{self.path}.tmp"
+        with self.lock:
+            content = {'version': VERSION, 'entries': dict(self.entries)}
+        with gzip.open(tmp_path, 'wt') as f:
+            json.dump(content, f, separators=(',', ':'))
+        os.replace(tmp_path, self.path)
+        LOGGER.info(f"Cassette {self.path} saved, {len(content['entries'])} "
+                    f"responses")
+
+    def replay(self, kind, request):
+        """Recorded response to `request`."""
+        try:
+            return self.entries[get_request_key(kind, request)]
+        except KeyError:
+            raise CassetteMiss(f"{kind} request not in {self.path}: "
+                               f"{str(request)[:200]}") from None
+
+    def record(self, kind, request, response):
+        key = get_request_key(kind, request)
+        with self.lock:
+            self.entries[key] = response
+            self.recorded += 1
+
+    def call(self, kind, request, fetch):
+        """Response to `request`, from the cassette when replaying, from
+        `fetch()` and recorded otherwise."""
+        if self.replaying:
+            return self.replay(kind, request)
+        response = fetch()
+        self.record(kind, request, response)
+        return response
+
+
+class CassetteProvider(BaseProvider):
+    """web3 provider going through a `Cassette`, to `provider` when
+    recording."""
+
+    def __init__(self, cassette, provider=None):
+        self.cassette = cassette
+        self.provider = provider
+
+    def make_request(self, method, params):
+        def fetch():
+            response = dict(self.provider.make_request(method, params))
+            response.pop('id', None)
+            return response
+        return self.cassette.call('rpc', [method, params], fetch)
+
+    def is_connected(self):
+        return self.cassette.replaying or self.provider.isConnected()
+
+    # Name of older web3 versions.
+    isConnected = is_connected
+
+
+@lru_cache(maxsize=2)
+def get_cassette():
+    """The configured cassette, or None."""
+    cassette_config = config.get('cassette') or dict()
+    mode = cassette_config.get('mode')
+    if not mode:
+        return None
+    path = cassette_config.get('path')
+    if path is None:
+        cache_path = (config.get('cache') or dict()).get('path', '.poolmonitor')
+        os.makedirs(cache_path, exist_ok=True)
+        path = os.path.join(
+            cache_path, f"cassette_{config['web3']['chain_id']}.json.gz")
+    cassette = Cassette(path, mode)
+    if mode == 'record':
+        atexit.register(cassette.save)
+    return cassette
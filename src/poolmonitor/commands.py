@@ -19,8 +19,11 @@ import argparse
 import sys
 import os
 import logging
-import math
+from concurrent.futures import ThreadPoolExecutor
+from fractions import Fraction
 from .settings import config
+from .accrual import allocate
+from . import metrics
 from .aleph import create_distribution_tx_post, get_latest_successful_distribution
         
 import hiyapyco
@@ -50,6 +53,14 @@ def parse_args(args):
         "--version",
         action="version",
         version="poolmonitor {ver}".format(ver=__version__))
+    parser.add_argument(
+        "command",
+        nargs="?",
+        choices=["run", "watch", "serve", "backfill", "verify"],
+        default="run",
+        help="run a single distribution, watch the chain and distribute "
+             "on schedule, serve the pending rewards API, compute the "
+             "rewards of past epochs, or check the past distributions")
     parser.add_argument('-c', '--config', action="store", dest="config_file")
     parser.add_argument(
         "-v",
@@ -85,6 +96,59 @@ def parse_args(args):
         help="Ending height",
         type=int,
         default=-1)
+    parser.add_argument(
+        "--every",
+        dest="every",
+        help="backfill: length of the epochs, in blocks",
+        type=int,
+        default=45000)
+    parser.add_argument(
+        "--boundaries",
+        dest="boundaries",
+        help="backfill: comma separated end heights of the epochs")
+    parser.add_argument(
+        "--from-posts",
+        dest="from_posts",
+        help="backfill: epochs of the past distribution posts",
+        action="store_true")
+    parser.add_argument(
+        "-o",
+        "--output",
+        dest="output",
+        help="backfill, verify: write the results to this JSON file")
+    parser.add_argument(
+        "--no-post",
+        dest="post",
+        help="don't post the distribution on aleph, for dry runs (can't be "
+             "used with --act)",
+        action="store_false")
+    cassette = parser.add_mutually_exclusive_group()
+    cassette.add_argument(
+        "--record",
+        dest="record",
+        metavar="CASSETTE",
+        help="record the node, explorer and aleph responses to this file")
+    cassette.add_argument(
+        "--replay",
+        dest="replay",
+        metavar="CASSETTE",
+        help="serve the node, explorer and aleph responses from this "
+             "recording, offline, requires --no-post")
+    parser.add_argument(
+        "--profile",
+        dest="profile",
+        help="record RPC calls and phase timings, print a summary at the end",
+        action="store_true")
+    parser.add_argument(
+        "--profile-output",
+        dest="profile_output",
+        help="with --profile: write the metrics to this file")
+    parser.add_argument(
+        "--profile-format",
+        dest="profile_format",
+        help="with --profile-output: json (default) or prometheus text",
+        choices=["json", "prometheus"],
+        default="json")
     return parser.parse_args(args)
 
 
@@ -99,36 +163,90 @@ def setup_logging(loglevel):
                         format=logformat, datefmt="%Y-%m-%d %H:%M:%S")
 
 
-def main(args):
-    """Main entry point allowing external calls
+def get_pool_weights(pools, weight_results):
+    """Normalized weights of `pools` from the results of their weight calls.
 
     Args:
-      args ([str]): command line parameter list
-    """
-    args = parse_args(args)
-    setup_logging(args.loglevel)
-
-    
-    default_config_file = os.path.join(Path(__file__).resolve().parent, 'config_default.yaml')
-    if args.config_file:
-        config.update(hiyapyco.load(default_config_file, args.config_file))
-    else:
-        config.update(hiyapyco.load(default_config_file))
-
-    from . import uniswap, balancer
-    from .ethereum import get_web3, transfer_tokens
-    uniswap.set_pools()
-    balancer.set_pools()
+      pools ([dict]): configured pools
+      weight_results ([list]): results of each pool's weight calls
 
+    Returns:
+      dict: pool address to its share of the rewards
+    """
     pool_weights = {
-        pool['address'] : pool['weight_processor'](pool) * pool.get('weight', 1) for pool in config['pools']
+        pool['address'] : pool['weight_from_calls'](pool, results) * pool.get('weight', 1)
+        for pool, results in zip(pools, weight_results)
     }
 
-    pool_weights = {
+    return {
         a: pw / sum(pool_weights.values()) for a, pw in pool_weights.items()
     }
 
-    per_block = config['reward_per_block']
+
+def get_start_height(start_height=-1, latest=None):
+    """First block of the reward window: `start_height` if given, or the
+    block after the last successful distribution, whose `(end_height,
+    content)` is looked up if `latest` isn't given."""
+    if start_height == -1:
+        if latest is None:
+            latest = get_latest_successful_distribution()
+        last_end_height, dist = latest
+
+        if last_end_height and dist:
+            start_height = last_end_height + 1
+        
+        else:
+            start_height = 0
+
+    return start_height
+
+
+def process_pools(pools, per_block, pool_weights, start_height, end_height):
+    """Run the history processor of each pool, side by side.
+
+    Args:
+      pools ([dict]): configured pools
+      per_block (float): rewards per block, for all pools
+      pool_weights (dict): pool address to its share of the rewards, or
+        None to give each pool the whole `per_block`
+      start_height (int): first block of the reward window
+      end_height (int): last block of the reward window
+
+    Returns:
+      list: the `(rewards, start, end)` of each pool, in the order of `pools`
+    """
+    def process_pool(pool):
+        share = 1 if pool_weights is None else pool_weights[pool['address']]
+        return pool['history_processor'](pool, per_block*share,
+                                         start_height, end_height)
+
+    # Pools are mostly waiting on the node, process them side by side and
+    # merge the results in configuration order.
+    with ThreadPoolExecutor(
+            max_workers=config.get('pool_concurrency', 4)) as executor:
+        return list(executor.map(process_pool, pools))
+
+
+def get_distribution(pools, results, pool_weights, per_block,
+                     allocations=None):
+    """Build the distribution post content and the merged rewards to send.
+
+    The amounts to send are allocated in wei with exact integers: the reward
+    per block is split between pools, and each pool's reward between its
+    holders by weight, so they add up to the reward of the window to the wei.
+
+    Args:
+      pools ([dict]): configured pools
+      results ([tuple]): `(rewards, start, end)` of each pool
+      pool_weights (dict): pool address to its share of the rewards
+      per_block (float): rewards per block, for all pools
+      allocations ([tuple]): `(weights, reward_start)` of each pool, taken
+        from `pool['reward_weights']` if not given
+
+    Returns:
+      tuple: the distribution dict and the `{address: wei amount}` to send
+    """
+    from .ethereum import to_wei
 
     distribution = dict(
         incentive="liquidity",
@@ -139,60 +257,198 @@ def main(args):
         pools=[]
     )
 
-    to_distribute = dict()
-
-    end_height = args.end_height
-
-    if end_height == -1:
-        end_height = get_web3().eth.blockNumber
-
-    start_height = args.start_height
-
-    if start_height == -1:
-        last_end_height, dist = get_latest_successful_distribution()
-
-        if last_end_height and dist:
-            start_height = last_end_height + 1
-        
-        else:
-            start_height = 0
+    if allocations is None:
+        allocations = [pool.get('reward_weights') for pool in pools]
+    pools_per_block = allocate({address: Fraction(repr(weight))
+                                for address, weight in pool_weights.items()},
+                               to_wei(per_block))
 
+    to_distribute = dict()
 
-    for pool in config['pools']:
-        rewards, start_height, end_height = \
-            pool['history_processor'](pool,
-                                      per_block*pool_weights[pool['address']],
-                                      start_height, end_height)
+    for pool, (rewards, pool_start, pool_end), allocation in zip(
+            pools, results, allocations):
         pool_info = {
             'address': pool['address'],
             'type': pool.get('type', 'uniswap'),
             'per_block': per_block*pool_weights[pool['address']],
             'distribution': rewards,
-            'start': start_height,
-            'end': end_height
+            'start': pool_start,
+            'end': pool_end
         }
-        for address, amount in rewards.items():
+        if allocation is not None:
+            weights, reward_start = allocation
+            amounts = allocate(weights, pools_per_block[pool['address']]
+                               * max(pool_end - reward_start, 0))
+        else:
+            amounts = {address: to_wei(amount)
+                       for address, amount in rewards.items()}
+        for address, amount in amounts.items():
             if address != "0x0000000000000000000000000000000000000000":
                 to_distribute[address] = to_distribute.get(address, 0) + amount
         
         distribution['pools'].append(pool_info)
 
-    if args.act:
+    return distribution, to_distribute
+
+
+def send_distribution(distribution, to_distribute, act, post=True):
+    """Send the rewards if `act` is set, then post the distribution.
+
+    Args:
+      distribution (dict): distribution post content
+      to_distribute (dict): address to wei amount to send
+      act (bool): actually send the tokens
+      post (bool): post the distribution on aleph
+    """
+    from .submitter import pack_batches, submit_batches
+    from .merkle import publish_root
+
+    if act and not post:
+        # The next window starts after the last posted distribution, and the
+        # next merkle root is built on the claims of this post.
+        raise ValueError("Sent distributions have to be posted")
+
+    merkle = config.get('distribution_mode', 'transfer') == 'merkle'
+
+    if act:
         # distribution['status'] = ''
         print("Doing distribution")
         print(distribution)
         distribution['status'] = 'distribution'
 
-        max_items = config.get('batch_size', 40)
+        if merkle:
+            # A single transaction, recipients claim with the posted proofs.
+            with metrics.timed('publish_root'):
+                publish_root(to_distribute, distribution)
+        else:
+            with metrics.timed('pack_batches'):
+                batches = pack_batches(to_distribute)
+            for i, (targets, gas) in enumerate(batches):
+                print(f"doing batch {i} of {len(targets)} items ({gas} gas)")
+
+            # Returns once every transaction is mined, failed or replaced.
+            with metrics.timed('submit_batches'):
+                submit_batches(batches, distribution)
 
-        distribution_list = list(to_distribute.items())
+    if post:
+        create_distribution_tx_post(distribution)
 
-        for i in range(math.ceil(len(to_distribute) / max_items)):
-            step_items = distribution_list[max_items*i:max_items*(i+1)]
-            print(f"doing batch {i} of {len(step_items)} items")
-            transfer_tokens(dict(step_items), metadata=distribution)
 
-    create_distribution_tx_post(distribution)
+def main(args):
+    """Main entry point allowing external calls
+
+    Args:
+      args ([str]): command line parameter list
+    """
+    args = parse_args(args)
+    setup_logging(args.loglevel)
+
+    
+    default_config_file = os.path.join(Path(__file__).resolve().parent, 'config_default.yaml')
+    if args.config_file:
+        config.update(hiyapyco.load(default_config_file, args.config_file))
+    else:
+        config.update(hiyapyco.load(default_config_file))
+
+    if args.record or args.replay:
+        config['cassette'] = {'mode': args.record and 'record' or 'replay',
+                              'path': args.record or args.replay}
+    if (config.get('cassette') or dict()).get('mode') == 'replay':
+        if args.act:
+            raise ValueError("Can't send transactions from a replay")
+        if args.post and args.command in ("run", "watch"):
+            raise ValueError("Can't post distributions from a replay, "
+                             "use --no-post")
+    if args.act and not args.post:
+        raise ValueError("Sent distributions have to be posted, "
+                         "--act can't be used with --no-post")
+
+    if not args.profile:
+        return run_command(args)
+
+    metrics.enable()
+    try:
+        return run_command(args)
+    finally:
+        print(metrics.format_summary())
+        if args.profile_output:
+            metrics.write_metrics(args.profile_output, args.profile_format)
+
+
+def run_command(args):
+    """Run the command of the parsed `args`, once configured."""
+    from . import uniswap, balancer
+    from .ethereum import get_web3
+    from .history import prefetch_transfers
+    from .multicall import call_groups
+    uniswap.set_pools()
+    balancer.set_pools()
+
+    if args.command == "watch":
+        from .watch import watch
+        return watch(args.start_height, args.act, args.post)
+
+    if args.command == "backfill":
+        from .backfill import run_backfill
+        return run_backfill(args)
+
+    if args.command == "verify":
+        from .verify import run_verify
+        return run_verify(args)
+
+    if args.command == "serve":
+        from .api import serve
+        return serve()
+
+    web3 = get_web3()
+    current_height = web3.eth.blockNumber
+
+    end_height = args.end_height
+
+    if end_height == -1 or end_height > current_height:
+        end_height = current_height
+
+    # Every pool is measured at the end of the window, in a single call.
+    # Time-weighted averages are anchored on these reserves too.
+    with metrics.timed('pool_weights'):
+        weight_results = call_groups(
+            web3, [pool['weight_calls'](pool) for pool in config['pools']],
+            end_height)
+    pool_weights = get_pool_weights(config['pools'], weight_results)
+    time_weighted = config.get('pool_weight_mode', 'snapshot') == 'twa'
+
+    per_block = config['reward_per_block']
+
+    start_height = get_start_height(args.start_height)
+
+    if (config['web3'].get('mode', 'rpc') == 'rpc'
+            and config['web3'].get('shared_scan', True)):
+        # One logs scan for every pool instead of one per pool.
+        with metrics.timed('prefetch'):
+            prefetch_transfers(web3, config['pools'], end_height)
+
+    # Time-weighted pool weights are only known once the histories are
+    # processed, the rewards are scaled afterwards.
+    with metrics.timed('pools'):
+        results = process_pools(config['pools'], per_block,
+                                None if time_weighted else pool_weights,
+                                start_height, end_height)
+
+    if time_weighted:
+        pool_weights = get_pool_weights(config['pools'], [
+            pool['time_weighted_results'](pool, pool_results,
+                                          *pool['reserve_averages'])
+            for pool, pool_results in zip(config['pools'], weight_results)])
+        results = [
+            ({a: amount*pool_weights[pool['address']]
+              for a, amount in rewards.items()}, pool_start, pool_end)
+            for pool, (rewards, pool_start, pool_end)
+            in zip(config['pools'], results)]
+
+    with metrics.timed('allocation'):
+        distribution, to_distribute = get_distribution(
+            config['pools'], results, pool_weights, per_block)
+    send_distribution(distribution, to_distribute, args.act, args.post)
 
 
 def run():
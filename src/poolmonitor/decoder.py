@@ -0,0 +1,60 @@
+"""Fast decoding of ERC20 Transfer logs.
+
+`Transfer(address,address,uint256)` always has the same layout: both
+addresses are indexed (topics 1 and 2) and the amount is the single 32-byte
+data word. Logs with that shape are decoded directly from the raw topics and
+data; anything else goes through web3's generic `get_event_data`.
+"""
+from functools import lru_cache
+
+from eth_utils import keccak, to_checksum_address
+from web3.contract import get_event_data
+
+TRANSFER_TOPIC = keccak(text="Transfer(address,address,uint256)")
+
+
+@lru_cache(maxsize=None)
+def checksum_topic_address(topic):
+    return to_checksum_address(topic[12:])
+
+
+def to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return bytes.fromhex(value[2:])
+
+
+def to_hex(value):
+    if value is None or isinstance(value, str):
+        return value
+    return '0x' + bytes(value).hex()
+
+
+def decode_transfer_event(codec, abi, log):
+    """Decode a Transfer log with the full ABI codec."""
+    evt_data = get_event_data(codec, abi, log)
+    src, dst, amount = (evt_data['args'][i['name']] for i in abi['inputs'])
+    return (evt_data['blockNumber'], evt_data['logIndex'],
+            to_hex(evt_data['blockHash']), src, dst, amount)
+
+
+def decode_transfers(codec, abi, logs):
+    """Decode a batch of Transfer logs.
+
+    Returns a list of `(height, log_index, block_hash, src, dst, amount)`
+    tuples, in the order of `logs`.
+    """
+    transfers = []
+    for log in logs:
+        topics = log['topics']
+        data = to_bytes(log['data'])
+        if (len(topics) == 3 and len(data) == 32
+                and to_bytes(topics[0]) == TRANSFER_TOPIC):
+            transfers.append((
+                log['blockNumber'], log['logIndex'], to_hex(log['blockHash']),
+                checksum_topic_address(to_bytes(topics[1])),
+                checksum_topic_address(to_bytes(topics[2])),
+                int.from_bytes(data, 'big')))
+        else:
+            transfers.append(decode_transfer_event(codec, abi, log))
+    return transfers
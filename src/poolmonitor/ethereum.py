@@ -2,7 +2,6 @@ import web3
 from web3.gas_strategies.time_based import medium_gas_price_strategy
 from web3.gas_strategies.rpc import rpc_gas_price_strategy
 from web3.exceptions import TransactionNotFound
-from web3._utils.method_formatters import log_entry_formatter
 import json
 import os
 from pathlib import Path
@@ -12,24 +11,45 @@ from eth_keys import keys
 from hexbytes import HexBytes
 from functools import lru_cache
 from .settings import config
+from .explorer import get_explorer_client
+from . import metrics
 import requests
+from collections import deque
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
 
 import logging
 LOGGER = logging.getLogger(__name__)
 
 DECIMALS = 10**18
 
-NONCE = None
+LOG_RANGE_ERRORS = [-32005, -32000, -32603]
+
+
+def to_wei(amount):
+    """Token `amount` in wei, from its shortest decimal form, so 1.4 is
+    exactly 1.4e18 wei."""
+    return int(Decimal(repr(amount)) * DECIMALS)
 
 @lru_cache(maxsize=2)
 def get_web3():
+    from .cassette import get_cassette, CassetteProvider
+    cassette = get_cassette()
     w3 = None
-    if config['web3'].get('url'):
-        w3 = web3.Web3(web3.providers.rpc.HTTPProvider(config['web3'].get('url')))
-    else:
+    if config['web3'].get('urls'):
+        from .providers import get_provider_pool
+        w3 = web3.Web3(get_provider_pool(config['web3']['urls']))
+    elif config['web3'].get('url'):
+        from .providers import HTTPProvider
+        w3 = web3.Web3(HTTPProvider(config['web3'].get('url')))
+    elif cassette is None or not cassette.replaying:
         from web3.auto.infura import w3 as iw3
-        assert w3.isConnected()
         w3 = iw3
+        assert w3.isConnected(), "Can't connect to Infura, set web3.url"
+
+    if cassette is not None:
+        # Replays don't need the node.
+        w3 = web3.Web3(CassetteProvider(cassette, w3 and w3.provider))
     
     w3.eth.setGasPriceStrategy(rpc_gas_price_strategy)
     
@@ -63,139 +83,96 @@ def get_account():
         return None
 
 def transfer_tokens(targets, metadata=None):
-    global NONCE
-    w3 = get_web3()
-    contract = get_token_contract(w3)
-    account = get_account()
+    from .submitter import pack_batches, submit_batches
+    if metadata is None:
+        metadata = dict()
+    return submit_batches(pack_batches({address: to_wei(amount)
+                                        for address, amount in targets.items()}),
+                          metadata)
 
-    addr_count = len(targets.keys())
-    total = sum(targets.values())
-    
-    LOGGER.info(f"Preparing transfer of {total} to {addr_count}")
-    gas_price = get_gas_price(config['web3']['chain_id'])
-    
-    if NONCE is None:
-        NONCE = w3.eth.getTransactionCount(account.address)
-    tx_hash = None
-    
-    success = False
-    
-    try:
-        balance = contract.functions.balanceOf(account.address).call()/DECIMALS
-        if (total >= balance):
-            raise ValueError(f"Balance not enough ({total}/{balance})")
-        
-        tx = contract.functions.batchTransfer(
-            [w3.toChecksumAddress(addr) for addr in targets.keys()],
-            [int(amount*DECIMALS) for amount in targets.values()])
-        # gas = tx.estimateGas({
-        #     'chainId': 1,
-        #     'gasPrice': gas_price,
-        #     'nonce': NONCE,
-        #     })
-        # print(gas)
-        tx = tx.buildTransaction({
-            'chainId': config['web3']['chain_id'],
-            'gas': 20000+(20000*len(targets)),
-            'gasPrice': gas_price,
-            'nonce': NONCE,
-            })
-        signed_tx = account.signTransaction(tx)
-        tx_hash = w3.eth.sendRawTransaction(signed_tx.rawTransaction).hex()
-        success = True
-        NONCE += 1
-        LOGGER.info(f"TX {tx_hash} created on ETH")
-    
-    except:
-        LOGGER.exception("Error packing ethereum TX")
-    
-    if 'targets' not in metadata:
-        metadata['targets'] = list()
-    metadata['targets'].append({
-        'success': success,
-        'status': success and 'pending' or 'failed',
-        'tx': tx_hash,
-        'chain': 'ETH',
-        'sender': account.address,
-        'targets': targets,
-        'total': total,
-        'contract_total': str(int(total*DECIMALS))
-    })
-
-    return metadata
-
-
-def get_logs_query(web3, contract,
+
+def get_logs_query(web3, address,
                    start_height, end_height, topics,
                    load_mode='rpc'):
     if load_mode == 'rpc':
-        logs = web3.eth.getLogs({'address': contract.address,
+        logs = web3.eth.getLogs({'address': address,
                                 'fromBlock': start_height,
                                 'toBlock': end_height,
                                 'topics': topics})
         for log in logs:
             yield log
     elif load_mode == 'explorer':
-        params = {
-            "module": "logs",
-            "action": "getLogs",
-            "fromBlock": start_height,
-            "toBlock": end_height,
-            "address": contract.address,
-            "apikey": config['web3']['explorer_api_key']
-        }
-        for i, topic in enumerate(topics):
-            params[f"topic{i}"] = topic
-            if i > 0:
-                params[f"topic{i-1}_{i}_opr"] = "and"
-
-        resp = requests.get(
-            "https://api.bscscan.com/api",
-            params=params
-        )
-        for item in resp.json()['result']:
-            item['blockHash'] = None
-            yield log_entry_formatter(item)
-
-
-def get_logs(web3, contract, start_height, topics=None):
-    load_mode = config['web3'].get('mode', 'rpc')
-    try:
-        logs = get_logs_query(web3, contract,
-                              start_height+1, 'latest', topics=topics,
-                              load_mode=load_mode)
-        for log in logs:
-            yield log
-    except ValueError as e:
-        # we got an error, let's try the pagination aware version.
-        if (getattr(e, 'args')
-                and len(e.args)
-                and e.args[0]['code'] not in [-32005, -32000, -32603]):
-            return
+        yield from get_explorer_client().get_logs(address, start_height,
+                                                  end_height, topics)
 
-        last_block = web3.eth.blockNumber
-#         if (start_height < config.ethereum.start_height.value):
-#             start_height = config.ethereum.start_height.value
 
-        end_height = start_height + config['web3']['big_block_range']
+def is_range_error(error):
+    """Whether the node refused a getLogs query for being too large."""
+    return (isinstance(error, ValueError)
+            and len(error.args)
+            and isinstance(error.args[0], dict)
+            and error.args[0].get('code') in LOG_RANGE_ERRORS)
 
-        while True:
-            try:
-                logs = get_logs_query(web3, contract,
-                                      start_height, end_height, topics=topics,
-                                      load_mode=load_mode)
-                for log in logs:
-                    yield log
 
-                start_height = end_height + 1
-                end_height = start_height + config['web3']['big_block_range']
+def get_logs(web3, address, start_height, topics=None, end_height='latest'):
+    """Yield the logs emitted by `address` (a single address or a list of
+    them) after `start_height`, in chain order.
 
-                if start_height > last_block:
-                    LOGGER.info("Ending big batch sync")
-                    break
+    The range is cut in windows fetched `log_concurrency` at a time. A window
+    the node refuses is split in two, and the size of the following windows
+    adapts: halved on errors or crowded windows, doubled on sparse ones.
+    """
+    load_mode = config['web3'].get('mode', 'rpc')
+    if end_height == 'latest':
+        end_height = web3.eth.blockNumber
 
+    concurrency = config['web3'].get('log_concurrency', 4)
+    target_count = config['web3'].get('log_target_count', 5000)
+    max_range = config['web3'].get('max_block_range', 500000)
+    window = config['web3']['big_block_range']
+
+    def fetch(start, end):
+        logs = list(get_logs_query(web3, address, start, end, topics=topics,
+                                   load_mode=load_mode))
+        logs.sort(key=lambda log: (log['blockNumber'], log['logIndex']))
+        return logs
+
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    pending = deque()
+    next_start = start_height + 1
+
+    try:
+        while pending or next_start <= end_height:
+            while len(pending) < concurrency and next_start <= end_height:
+                stop = min(next_start + window - 1, end_height)
+                pending.append((next_start, stop,
+                                executor.submit(fetch, next_start, stop)))
+                next_start = stop + 1
+
+            start, stop, future = pending.popleft()
+            try:
+                logs = future.result()
             except ValueError as e:
-                if e.args[0]['code'] in [-32005, -32000, -32603]:
-                    end_height = start_height + config['web3']['small_block_range']
-                else:
-                    raise
\ No newline at end of file
+                if not is_range_error(e) or start == stop:
+                    raise
+                middle = (start + stop) // 2
+                window = max(min(window, middle - start + 1), 1)
+                LOGGER.debug(f"Splitting logs query {start}-{stop}")
+                pending.appendleft((middle + 1, stop,
+                                    executor.submit(fetch, middle + 1, stop)))
+                pending.appendleft((start, middle,
+                                    executor.submit(fetch, start, middle)))
+                continue
+
+            metrics.inc('logs_fetched', len(logs), mode=load_mode)
+            if len(logs) > target_count:
+                window = max(window // 2, 1)
+            elif len(logs) < target_count // 2:
+                window = min(window * 2, max_range)
+
+            for log in logs:
+                yield log
+    finally:
+        for start, stop, future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
@@ -0,0 +1,180 @@
+"""Etherscan-like explorer API client, used by the `explorer` load mode."""
+import logging
+import threading
+import time
+from functools import lru_cache
+
+import requests
+from web3._utils.method_formatters import log_entry_formatter
+
+from .settings import config
+from .cassette import get_cassette
+from . import metrics
+
+LOGGER = logging.getLogger(__name__)
+
+INTEGER_FIELDS = ('blockNumber', 'logIndex', 'transactionIndex')
+
+
+class ExplorerError(Exception):
+    pass
+
+
+class TokenBucket:
+    """Allow `rate` acquisitions per second, with bursts up to `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                time.sleep((1 - self.tokens) / self.rate)
+
+
+class ExplorerClient:
+    def __init__(self, api_path, api_key, rate_limit=5, max_results=1000,
+                 retries=5, backoff=0.5):
+        self.api_path = api_path
+        self.api_key = api_key
+        self.max_results = max_results
+        self.retries = retries
+        self.backoff = backoff
+        self.bucket = TokenBucket(rate_limit)
+        self.local = threading.local()
+
+    @property
+    def session(self):
+        # One keep-alive session per thread, as logs windows are fetched in
+        # parallel.
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def query(self, params):
+        """Call the API, through the cassette if enabled."""
+        cassette = get_cassette()
+        if cassette is None:
+            return self.fetch(params)
+        return cassette.call('explorer', [self.api_path, params],
+                             lambda: self.fetch(params))
+
+    def fetch(self, params):
+        """Call the API, retrying with exponential backoff on network
+        errors, server errors and rate limiting."""
+        params = dict(params, apikey=self.api_key)
+        for attempt in range(self.retries + 1):
+            self.bucket.acquire()
+            started = time.perf_counter()
+            try:
+                resp = self.session.get(self.api_path, params=params,
+                                        timeout=30)
+                resp.raise_for_status()
+                content = resp.json()
+            except (requests.RequestException, ValueError) as e:
+                metrics.record_rpc(params.get('action'), self.api_path,
+                                   started, error=True)
+                error = e
+            else:
+                metrics.record_rpc(params.get('action'), self.api_path,
+                                   started, response_size=len(resp.content),
+                                   error=content.get('status') != '1')
+                if content.get('status') == '1':
+                    return content['result']
+                if content.get('message', '').startswith('No records found'):
+                    return []
+                error = ExplorerError(content.get('result')
+                                      or content.get('message'))
+
+            if attempt < self.retries:
+                delay = self.backoff * 2**attempt
+                LOGGER.info(f"Explorer query failed ({error}), "
+                            f"retrying in {delay}s")
+                time.sleep(delay)
+        raise error
+
+    def query_logs(self, address, start_height, end_height, topics, page=None):
+        params = {
+            "module": "logs",
+            "action": "getLogs",
+            "fromBlock": start_height,
+            "toBlock": end_height,
+            "address": address,
+        }
+        for i, topic in enumerate(topics or []):
+            params[f"topic{i}"] = topic
+            if i > 0:
+                params[f"topic{i-1}_{i}_opr"] = "and"
+        if page is not None:
+            params.update(page=page, offset=self.max_results)
+        return [format_log(item) for item in self.query(params)]
+
+    def get_logs(self, address, start_height, end_height, topics):
+        """Yield all the logs of the range, paging when a response is cut
+        at `max_results`."""
+        if topics and isinstance(topics[0], list):
+            # The API has no "one of" filter, query each first topic apart.
+            logs = [log for topic in topics[0]
+                    for log in self.get_logs(address, start_height, end_height,
+                                             [topic] + topics[1:])]
+            logs.sort(key=lambda log: (log['blockNumber'], log['logIndex']))
+            yield from logs
+            return
+
+        while start_height <= end_height:
+            logs = self.query_logs(address, start_height, end_height, topics)
+            if len(logs) < self.max_results:
+                yield from logs
+                return
+
+            last_block = logs[-1]['blockNumber']
+            if logs[0]['blockNumber'] == last_block:
+                # A single crowded block, go through it page by page.
+                yield from self.get_block_logs(address, last_block, topics)
+                start_height = last_block + 1
+                continue
+
+            # The last block may be incomplete, start again from it.
+            for log in logs:
+                if log['blockNumber'] < last_block:
+                    yield log
+            start_height = last_block
+
+    def get_block_logs(self, address, height, topics):
+        page = 1
+        while True:
+            logs = self.query_logs(address, height, height, topics, page=page)
+            yield from logs
+            if len(logs) < self.max_results:
+                return
+            page += 1
+
+
+def format_log(item):
+    for field in INTEGER_FIELDS:
+        if item.get(field) == '0x':
+            item[field] = '0x0'
+    item['blockHash'] = None
+    return log_entry_formatter(item)
+
+
+@lru_cache(maxsize=2)
+def get_explorer_client():
+    web3_config = config['web3']
+    return ExplorerClient(web3_config['explorer_api_path'],
+                          web3_config['explorer_api_key'],
+                          rate_limit=web3_config.get('explorer_rate_limit', 5),
+                          max_results=web3_config.get('explorer_max_results',
+                                                      1000),
+                          retries=web3_config.get('explorer_retries', 5))
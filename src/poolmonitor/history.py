@@ -0,0 +1,444 @@
+"""Transfer history processing shared by the pool types.
+
+Transfers are handled as `(height, log_index, block_hash, src, dst, amount)`
+tuples, whether they come straight from the node or from the local cache.
+
+In time-weighted mode (`pool_weight_mode: twa`), the events changing the pool
+reserves are scanned along with the transfers and kept as
+`(height, log_index, block_hash, absolute, amount0, amount1)` tuples: either
+the new reserves or the change of reserves, depending on the pool type.
+"""
+import logging
+import time
+
+from web3._utils.events import construct_event_topic_set
+from web3.contract import get_event_data
+
+from .settings import config
+from .ethereum import get_web3, get_logs
+from .accrual import (RewardAccrual, TimeWeightedAverage, compute_rewards,
+                      get_reward_start)
+from .storage import open_store
+from .index import BalanceIndex
+from .decoder import decode_transfers, to_hex
+from .pipeline import Pipeline, iter_batches
+from . import metrics
+
+LOGGER = logging.getLogger(__name__)
+
+DECODE_BATCH_SIZE = 1000
+
+
+def get_transfer_abi(pool):
+    return pool['contract'].events.Transfer._get_event_abi()
+
+
+def is_time_weighted(pool):
+    return (config.get('pool_weight_mode', 'snapshot') == 'twa'
+            and 'reserve_events' in pool)
+
+
+def get_reserve_abis(web3, pool):
+    """Return the `{topic: abi}` of the reserve events tracked for `pool`."""
+    if not is_time_weighted(pool):
+        return dict()
+    return {construct_event_topic_set(abi, web3.codec)[0]: abi
+            for abi in pool['reserve_events'](pool)}
+
+
+def get_scan_topics(web3, pool):
+    return (construct_event_topic_set(get_transfer_abi(pool), web3.codec)
+            + list(get_reserve_abis(web3, pool)))
+
+
+def decode_pool_logs(web3, pool, logs, reserves=None):
+    """Decode a batch of `pool` logs into transfers.
+
+    Reserve events, if tracked, are decoded and appended to `reserves`.
+    """
+    tracked = len(reserves or ())
+    with metrics.timed('decode', pool=pool['address']):
+        transfers = _decode_pool_logs(web3, pool, logs, reserves)
+    # The logs themselves are counted as they are fetched, by `get_logs`.
+    metrics.inc('events_decoded',
+                len(transfers) + len(reserves or ()) - tracked,
+                pool=pool['address'])
+    return transfers
+
+
+def _decode_pool_logs(web3, pool, logs, reserves):
+    reserve_abis = get_reserve_abis(web3, pool)
+    if reserve_abis:
+        transfer_logs = list()
+        for log in logs:
+            abi = reserve_abis.get(to_hex(log['topics'][0]))
+            if abi is None:
+                transfer_logs.append(log)
+                continue
+            evt_data = get_event_data(web3.codec, abi, log)
+            change = pool['reserve_change'](pool, evt_data)
+            if change is not None:
+                reserves.append((evt_data['blockNumber'], evt_data['logIndex'],
+                                 to_hex(evt_data['blockHash']), *change))
+        logs = transfer_logs
+
+    return decode_transfers(web3.codec, get_transfer_abi(pool), logs)
+
+
+def decode_batches(web3, pool, logs, end_height, reserves=None):
+    """Decode `logs` by batches, stopping after `end_height`.
+
+    The logs are fetched and decoded in a `Pipeline`, ahead of the
+    consumer.
+    """
+    pipeline = Pipeline(
+        pool['address'], iter_batches(logs, DECODE_BATCH_SIZE),
+        [('decode', lambda batch: decode_pool_logs(web3, pool, batch,
+                                                   reserves))])
+    started = time.perf_counter()
+    try:
+        for transfers in pipeline:
+            for transfer in transfers:
+                if transfer[0] > end_height:
+                    return
+                yield transfer
+    finally:
+        # Stops the scan if left early.
+        pipeline.close()
+        metrics.inc('phase_seconds', time.perf_counter() - started,
+                    phase='scan', pool=pool['address'])
+
+
+def fetch_transfers(web3, pool, after_height, end_height, reserves=None):
+    """Yield the decoded transfers of `pool` in `(after_height, end_height]`.
+
+    Reserve changes, if tracked, are appended to `reserves` on the way.
+    """
+    logs = get_logs(web3, pool['contract'].address, after_height,
+                    topics=[get_scan_topics(web3, pool)], end_height=end_height)
+    return decode_batches(web3, pool, logs, end_height, reserves)
+
+
+def find_reorg_height(store, web3, height):
+    """Walk back from `height` until the stored block hash matches the
+    chain, and return the first height known to be safe."""
+    confirmations = config['cache'].get('confirmations', 12)
+    while True:
+        known = store.last_block_hash(height)
+        if known is None:
+            return height
+        block_height, block_hash = known
+        if web3.eth.getBlock(block_height)['hash'].hex() == block_hash:
+            return height
+        LOGGER.warning(f"Reorg detected at {block_height} in {store.path}")
+        height = block_height - max(confirmations, 1)
+
+
+def get_sync_height(store, web3, pool, end_height):
+    """Return the height after which `store` has to be fetched again to
+    reach `end_height`, or None if it is up to date.
+
+    The last `confirmations` blocks already cached are always fetched again.
+    """
+    if is_time_weighted(pool) and not store.get_meta('reserves'):
+        # The cache was filled without reserve events, start it over.
+        store.rewind(pool['start_height'])
+
+    synced_height = store.synced_height
+    if synced_height is None:
+        synced_height = pool['start_height']
+    if synced_height >= end_height:
+        return None
+
+    confirmations = config['cache'].get('confirmations', 12)
+    after_height = max(synced_height - confirmations, pool['start_height'])
+    return find_reorg_height(store, web3, after_height)
+
+
+def update_store(store, after_height, transfers, end_height, reserves=None):
+    """Replace the cached transfers (and reserve changes) above
+    `after_height`.
+
+    The snapshots above `after_height` are dropped as well if the transfers
+    already cached there changed.
+    """
+    synced_height = store.synced_height or after_height
+    cached = list(store.iter_transfers(after_height, synced_height))
+    reorg = cached != [t for t in transfers if t[0] <= synced_height]
+    if reorg:
+        LOGGER.warning(f"Chain reorganized above {after_height}, "
+                       f"rewinding {store.path}")
+
+    if reserves is not None:
+        reserves = [r for r in reserves if r[0] <= end_height]
+    store.rewind(after_height, snapshots=reorg)
+    store.add_transfers(transfers, end_height, reserves)
+
+
+def sync_store(store, web3, pool, end_height):
+    """Fetch the blocks missing from `store` up to `end_height`."""
+    after_height = get_sync_height(store, web3, pool, end_height)
+    if after_height is not None:
+        reserves = list() if is_time_weighted(pool) else None
+        transfers = list(fetch_transfers(web3, pool, after_height, end_height,
+                                         reserves))
+        update_store(store, after_height, transfers, end_height, reserves)
+
+
+def prefetch_transfers(web3, pools, end_height):
+    """Fetch the new transfers of all `pools` with a single logs scan.
+
+    The scan starts at the earliest height any pool needs, and each log is
+    routed to its pool. Pools with a cache get their store updated, the
+    others keep their transfers (and reserve changes) in `pool['transfers']`
+    (and `pool['reserves']`) for `process_transfer_history`.
+    """
+    stores = dict()
+    after_heights = dict()
+    routes = dict()
+    for pool in pools:
+        address = pool['contract'].address.lower()
+        routes[address] = pool
+        store = open_store(pool)
+        if store is None:
+            after_heights[address] = pool['start_height']
+        else:
+            after_height = get_sync_height(store, web3, pool, end_height)
+            if after_height is None:
+                store.close()
+                continue
+            stores[address] = store
+            after_heights[address] = after_height
+
+    if not after_heights:
+        return
+
+    topics = {t for pool in pools for t in get_scan_topics(web3, pool)}
+    logs = get_logs(web3, [routes[a]['contract'].address for a in after_heights],
+                    min(after_heights.values()), topics=[sorted(topics)],
+                    end_height=end_height)
+    transfers = {address: list() for address in after_heights}
+    reserves = {address: list() for address in after_heights
+                if is_time_weighted(routes[address])}
+
+    def decode(batch):
+        by_pool = dict()
+        for log in batch:
+            address = log['address'].lower()
+            if log['blockNumber'] > after_heights.get(address, end_height):
+                by_pool.setdefault(address, list()).append(log)
+        return {address: decode_pool_logs(web3, routes[address], pool_logs,
+                                          reserves.get(address))
+                for address, pool_logs in by_pool.items()}
+
+    pipeline = Pipeline('prefetch', iter_batches(logs, DECODE_BATCH_SIZE),
+                        [('decode', decode)])
+    with metrics.timed('scan', pool='prefetch'):
+        for decoded in pipeline:
+            for address, pool_transfers in decoded.items():
+                transfers[address].extend(pool_transfers)
+
+    for address, pool_transfers in transfers.items():
+        pool_transfers = [t for t in pool_transfers if t[0] <= end_height]
+        pool_reserves = reserves.get(address)
+        if address in stores:
+            update_store(stores[address], after_heights[address],
+                         pool_transfers, end_height, pool_reserves)
+            stores[address].close()
+        else:
+            routes[address]['transfers'] = pool_transfers
+            routes[address]['reserves'] = pool_reserves
+
+
+def track_reserves(averages, state, reserves, end_height):
+    """Replay reserve changes from `state` into the `averages` of each
+    reserve, and return the final state."""
+    for height, log_index, block_hash, absolute, amount0, amount1 in reserves:
+        if height > end_height:
+            break
+        if absolute:
+            state = (amount0, amount1)
+        else:
+            state = (state[0] + amount0, state[1] + amount1)
+        for average, value in zip(averages, state):
+            average.update(height, value)
+    return state
+
+
+def average_reserves(state, reserves, reward_start, end_height):
+    """Replay reserve changes from `state` and return the time-weighted
+    average reserves over the reward window, with the final state."""
+    averages = [TimeWeightedAverage(reward_start, value) for value in state]
+    state = track_reserves(averages, state, reserves, end_height)
+    return [average.average(end_height) for average in averages], state
+
+
+def build_balance_index(web3, pool, end_height):
+    """Build the `BalanceIndex` of `pool` up to `end_height` and set it as
+    `pool['balance_index']`."""
+    index = BalanceIndex(pool)
+    store = open_store(pool)
+    if store is None:
+        index.add_transfers(fetch_transfers(web3, pool, pool['start_height'],
+                                            end_height), end_height)
+    else:
+        sync_store(store, web3, pool, end_height)
+        index.add_transfers(store.iter_transfers(None, end_height), end_height)
+        store.close()
+    pool['balance_index'] = index
+    return index
+
+
+def replay_epochs(pool, epochs, save_snapshots=True):
+    """Replay the transfers of `pool` once through consecutive reward
+    windows, from the cache and its latest snapshot when enabled.
+
+    `epochs` is a list of `(reward_start, end_height)`, each starting after
+    the previous one ended. For each of them, yields the accrual, not
+    finalized yet, the height of the last transfer and, in time-weighted
+    mode, the `(averages, reserve_state)` of the pool reserves. Each window
+    starts from the balances at the end of the previous one, as a run
+    restoring the snapshot taken there would, and a snapshot is saved at
+    each end when the cache is enabled, unless `save_snapshots` is False.
+
+    With `balance_index` enabled, the whole history is replayed (snapshots
+    are not used) to build the pool `BalanceIndex` in the same pass, and it
+    is set as `pool['balance_index']`.
+    """
+    for (start, end), (next_start, next_end) in zip(epochs, epochs[1:]):
+        if next_start <= end:
+            raise ValueError(f"Epochs must be consecutive, got {start}-{end} "
+                             f"then {next_start}-{next_end}")
+
+    web3 = get_web3()
+    reward_start, end_height = epochs[0][0], epochs[-1][1]
+    accrual = RewardAccrual(reward_start)
+    last_event_height = None
+    time_weighted = is_time_weighted(pool)
+    reserve_state = (0, 0)
+    reserves = list() if time_weighted else None
+    index = None
+    if config.get('balance_index', False):
+        index = BalanceIndex(pool)
+
+    store = open_store(pool)
+    if store is None:
+        transfers = pool.pop('transfers', None)
+        if transfers is None:
+            # Reserve changes are appended as the transfers are decoded.
+            transfers = fetch_transfers(web3, pool, pool['start_height'],
+                                        end_height, reserves)
+        else:
+            reserves = pool.pop('reserves', None)
+    else:
+        sync_store(store, web3, pool, end_height)
+        after_height = None
+        snapshot = index is None and store.load_snapshot(reward_start) or None
+        if snapshot is not None and time_weighted:
+            saved_state = store.load_reserve_snapshot(snapshot[0])
+            if saved_state is None:
+                snapshot = None
+            else:
+                reserve_state = saved_state
+        if snapshot is not None:
+            after_height, last_event_height, balances = snapshot
+            accrual.restore(balances, last_event_height)
+        transfers = store.iter_transfers(after_height, end_height)
+        if time_weighted:
+            reserves = list(store.iter_reserves(after_height, end_height))
+
+    averages = None
+    if time_weighted:
+        averages = [TimeWeightedAverage(reward_start, value)
+                    for value in reserve_state]
+    tracked = 0
+    epoch = 0
+
+    def close_epoch():
+        nonlocal reserve_state, tracked
+        epoch_end = epochs[epoch][1]
+        reserve_tracker = None
+        if time_weighted:
+            ended = tracked
+            while ended < len(reserves) and reserves[ended][0] <= epoch_end:
+                ended += 1
+            reserve_state = track_reserves(averages, reserve_state,
+                                           reserves[tracked:ended], epoch_end)
+            tracked = ended
+            reserve_tracker = (averages, reserve_state)
+        if store is not None and save_snapshots:
+            store.save_snapshot(epoch_end, last_event_height, accrual.balances,
+                                time_weighted and reserve_state or None)
+        return accrual, last_event_height, reserve_tracker
+
+    def open_epoch():
+        nonlocal accrual, averages
+        epoch_start = epochs[epoch][0]
+        balances = accrual.balances
+        accrual = RewardAccrual(epoch_start)
+        accrual.restore(balances, last_event_height)
+        if time_weighted:
+            averages = [TimeWeightedAverage(epoch_start, value)
+                        for value in reserve_state]
+
+    try:
+        for height, log_index, block_hash, src, dst, amount in transfers:
+            while height > epochs[epoch][1]:
+                yield close_epoch()
+                epoch += 1
+                open_epoch()
+            accrual.transfer(height, src, dst, amount)
+            if index is not None:
+                index.transfer(height, src, dst, amount)
+            last_event_height = height
+
+        while True:
+            yield close_epoch()
+            epoch += 1
+            if epoch == len(epochs):
+                break
+            open_epoch()
+    finally:
+        if store is not None:
+            store.close()
+
+    if index is not None:
+        index.height = end_height
+        pool['balance_index'] = index
+
+
+def replay_history(pool, reward_start, end_height):
+    """Replay the transfers of `pool` up to `end_height`, as a single
+    `replay_epochs` window."""
+    return list(replay_epochs(pool, [(reward_start, end_height)]))[-1]
+
+
+def process_transfer_history(pool, per_block, start_height, end_height):
+    reward_start = get_reward_start(pool, start_height)
+    with metrics.timed('replay', pool=pool['address']):
+        accrual, last_event_height, reserve_tracker = replay_history(
+            pool, reward_start, end_height)
+
+    if reserve_tracker is not None:
+        averages, reserve_state = reserve_tracker
+        pool['reserve_averages'] = (
+            [average.average(end_height) for average in averages],
+            reserve_state)
+
+    weights = accrual.finalize(end_height)
+    if LOGGER.isEnabledFor(logging.DEBUG):
+        shares = {a: w / accrual.total_weight for a, w in weights.items()}
+        LOGGER.debug(f"{pool['address']} weight shares: {shares}")
+        balparts = {a: w / accrual.supply
+                    for a, w in accrual.balances.items() if w > 0}
+        LOGGER.debug(f"{pool['address']} balance shares: {balparts}")
+
+    # Allocated exactly in wei along the other pools by `get_distribution`.
+    pool['reward_weights'] = (weights, reward_start)
+
+    total_blocks = end_height - reward_start
+    reward_owed = compute_rewards(weights, accrual.total_weight, per_block, total_blocks)
+    LOGGER.debug(f"{pool['address']} rewards: {reward_owed}")
+    LOGGER.info(f"{pool['address']} total rewards "
+                f"{sum(reward_owed.values())}")
+    return reward_owed, start_height, end_height
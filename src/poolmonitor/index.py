@@ -0,0 +1,164 @@
+"""Balance and balance-block indexes of a pool.
+
+`BalanceIndex` keeps, for every address, the sorted heights at which its
+balance changed and the balance after each change, so the balance of any
+address at any height is a bisect away. The history processors build one
+during the Transfer scan when `balance_index` is enabled, and expose it as
+`pool['balance_index']`.
+
+`RewardIndex` also keeps, for each change, the cumulative balance-blocks
+accrued up to it. The balance-blocks of an address between two heights are
+then the difference of two prefix sums: a query costs O(log n) in the number
+of changes of that address, whatever the range. A timeline of the positive
+supply gives the total weight the same way, so rewards match what
+`process_transfer_history` computes for the same window.
+"""
+from array import array
+from bisect import bisect_right
+
+from .accrual import get_reward_start
+
+
+class BalanceTimeline:
+    """A value changing in steps, heights in an array and values (too big
+    for fixed-size integers) in a list."""
+    __slots__ = ('heights', 'values')
+
+    def __init__(self):
+        self.heights = array('q')
+        self.values = list()
+
+    @property
+    def value(self):
+        return self.values[-1] if self.values else 0
+
+    def set(self, height, value):
+        """Set the value from `height` on, heights coming in order."""
+        if self.heights and self.heights[-1] == height:
+            self.values[-1] = value
+            return
+        self.heights.append(height)
+        self.values.append(value)
+
+    def value_at(self, height):
+        i = bisect_right(self.heights, height) - 1
+        return self.values[i] if i >= 0 else 0
+
+
+class Timeline(BalanceTimeline):
+    """A `BalanceTimeline` with the running area under its positive part."""
+    __slots__ = ('areas',)
+
+    def __init__(self):
+        super().__init__()
+        self.areas = list()
+
+    def set(self, height, value):
+        if self.heights and self.heights[-1] == height:
+            self.values[-1] = value
+            return
+        area = 0
+        if self.heights:
+            area = (self.areas[-1]
+                    + max(self.values[-1], 0) * (height - self.heights[-1]))
+        self.heights.append(height)
+        self.values.append(value)
+        self.areas.append(area)
+
+    def area(self, height):
+        """Area from the first change up to `height`."""
+        i = bisect_right(self.heights, height) - 1
+        if i < 0:
+            return 0
+        return self.areas[i] + max(self.values[i], 0) * (height - self.heights[i])
+
+    def weight(self, start, end):
+        """Balance-blocks over `[start, end]`."""
+        return self.area(end) - self.area(start)
+
+
+class BalanceIndex:
+    """Balance timelines of every address of a pool, fed with its
+    transfers."""
+    timeline_class = BalanceTimeline
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.timelines = dict()
+        self.height = None
+
+    def move(self, height, addr, delta):
+        """Change the balance of `addr` by `delta` at `height`, return the
+        balances before and after."""
+        timeline = self.timelines.get(addr)
+        if timeline is None:
+            timeline = self.timelines[addr] = self.timeline_class()
+        before = timeline.value
+        timeline.set(height, before + delta)
+        return before, before + delta
+
+    def transfer(self, height, src, dst, amount):
+        self.move(height, src, -amount)
+        self.move(height, dst, amount)
+
+    def add_transfers(self, transfers, height):
+        """Index `(height, log_index, block_hash, src, dst, amount)`
+        transfers, the chain being scanned up to `height`."""
+        for event_height, log_index, block_hash, src, dst, amount in transfers:
+            self.transfer(event_height, src, dst, amount)
+        self.height = height
+
+    def balance_at(self, address, height):
+        """Balance of `address` after the transfers of block `height`."""
+        timeline = self.timelines.get(address)
+        return timeline.value_at(height) if timeline is not None else 0
+
+    def holders_at(self, height, top=None):
+        """Positive balances at `height`, largest first, the `top` ones
+        only if given."""
+        holders = dict()
+        for addr, timeline in self.timelines.items():
+            balance = timeline.value_at(height)
+            if balance > 0:
+                holders[addr] = balance
+        ranked = sorted(holders.items(), key=lambda item: item[1],
+                        reverse=True)
+        return dict(ranked[:top] if top else ranked)
+
+
+class RewardIndex(BalanceIndex):
+    """A `BalanceIndex` answering reward queries."""
+    timeline_class = Timeline
+
+    def __init__(self, pool):
+        super().__init__(pool)
+        self.supply = Timeline()
+        self.transfer_heights = array('q')
+
+    def transfer(self, height, src, dst, amount):
+        for addr, delta in ((src, -amount), (dst, amount)):
+            before, after = self.move(height, addr, delta)
+            self.supply.set(height, self.supply.value
+                            + max(after, 0) - max(before, 0))
+        if not self.transfer_heights or self.transfer_heights[-1] != height:
+            self.transfer_heights.append(height)
+
+    def get_origin(self, reward_start):
+        """Height the accrual clock opens at for a window starting at
+        `reward_start`: the last transfer at or before it, as in
+        `RewardAccrual`."""
+        i = bisect_right(self.transfer_heights, reward_start) - 1
+        return self.transfer_heights[i] if i >= 0 else reward_start
+
+    def pending(self, address, start_height, end_height, per_block):
+        """Rewards of `address` for the `[start_height, end_height]` window."""
+        reward_start = get_reward_start(self.pool, start_height)
+        timeline = self.timelines.get(address)
+        if timeline is None or end_height <= reward_start:
+            return 0
+        origin = self.get_origin(reward_start)
+        total_weight = self.supply.weight(origin, end_height)
+        if not total_weight:
+            return 0
+        weight = timeline.weight(origin, end_height)
+        return (weight / total_weight) * per_block * (end_height - reward_start)
@@ -0,0 +1,100 @@
+"""Compact encoding of the per-address maps of a distribution.
+
+With `aleph.store_maps` enabled, the pools `distribution`, the batches
+`targets` and the merkle `claims` are moved out of the distribution post
+into a single gzipped JSON file stored on aleph, and the post only keeps a
+summary and the file hash under `maps`.
+
+In the file, every address is written once in an `addresses` table and the
+maps are flat `[address index, amount, ...]` lists.
+"""
+import gzip
+import json
+
+ENCODING = 'json+gzip'
+
+
+class AddressTable:
+    def __init__(self):
+        self.addresses = list()
+        self.indexes = dict()
+
+    def encode(self, mapping):
+        encoded = list()
+        for address, amount in mapping.items():
+            index = self.indexes.get(address)
+            if index is None:
+                index = self.indexes[address] = len(self.addresses)
+                self.addresses.append(address)
+            encoded.append(index)
+            encoded.append(amount)
+        return encoded
+
+
+def decode_map(addresses, encoded):
+    return {addresses[encoded[i]]: encoded[i+1]
+            for i in range(0, len(encoded), 2)}
+
+
+def split_distribution(distribution):
+    """Return the summary of `distribution` and its maps, encoded."""
+    table = AddressTable()
+    summary = dict(distribution)
+    pools = list()
+    summary['pools'] = list()
+    for pool_info in distribution.get('pools', []):
+        pool_info = dict(pool_info)
+        rewards = pool_info.pop('distribution')
+        pool_info['distribution_count'] = len(rewards)
+        pools.append(table.encode(rewards))
+        summary['pools'].append(pool_info)
+
+    targets = list()
+    summary['targets'] = list()
+    for entry in distribution.get('targets', []):
+        entry = dict(entry)
+        entry_targets = entry.pop('targets')
+        entry['targets_count'] = len(entry_targets)
+        targets.append(table.encode(entry_targets))
+        summary['targets'].append(entry)
+    if 'targets' not in distribution:
+        del summary['targets']
+
+    claims = None
+    if 'merkle' in distribution:
+        summary['merkle'] = dict(distribution['merkle'])
+        claims = summary['merkle'].pop('claims')
+
+    content = json.dumps({
+        'addresses': table.addresses,
+        'pools': pools,
+        'targets': targets,
+        'claims': claims
+    }, separators=(',', ':')).encode()
+    return summary, gzip.compress(content)
+
+
+def join_distribution(summary, data):
+    """Return the full distribution from its summary and its maps file."""
+    maps = json.loads(gzip.decompress(data))
+    addresses = maps['addresses']
+    distribution = dict(summary)
+    distribution.pop('maps', None)
+    distribution['pools'] = list()
+    for pool_info, encoded in zip(summary.get('pools', []), maps['pools']):
+        pool_info = dict(pool_info)
+        pool_info.pop('distribution_count', None)
+        pool_info['distribution'] = decode_map(addresses, encoded)
+        distribution['pools'].append(pool_info)
+
+    if 'targets' in summary:
+        distribution['targets'] = list()
+        for entry, encoded in zip(summary['targets'], maps['targets']):
+            entry = dict(entry)
+            entry.pop('targets_count', None)
+            entry['targets'] = decode_map(addresses, encoded)
+            distribution['targets'].append(entry)
+
+    if maps['claims'] is not None:
+        distribution['merkle'] = dict(summary['merkle'], claims=maps['claims'])
+    return distribution
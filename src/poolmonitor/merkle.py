@@ -0,0 +1,220 @@
+"""Merkle tree of a distribution, for the `merkle` distribution mode.
+
+Instead of sending tokens to every recipient, a single transaction publishes
+the root of a tree over the distribution and recipients claim from the
+distributor contract with a proof.
+
+Amounts in the tree are cumulative: each leaf holds the total, in wei, an
+address earned in every merkle distribution so far, taken from the claims of
+the latest successful one plus the rewards of the current window. The
+distributor is expected to keep the amount already claimed by each account,
+`claim(account, cumulativeAmount, proof)` paying the difference, so
+replacing the root never takes back what the previous one granted and
+addresses can claim several distributions at once.
+
+Leaves are sorted by address and hold the double
+`keccak256(keccak256(abi.encode(account, amount)))`, so a leaf can't be
+mistaken for an inner node. Inner nodes hash their two children in sorted
+order (as OpenZeppelin's `MerkleProof` expects), and an odd node is carried
+up to the next level as is.
+"""
+import json
+import logging
+import os
+from functools import lru_cache
+from pathlib import Path
+
+from eth_hash.auto import keccak
+from eth_utils import to_bytes
+
+from .settings import config
+from .ethereum import DECIMALS, get_web3, get_account, get_gas_price
+from .aleph import (iter_distribution_posts, is_successful_distribution,
+                    get_full_distribution)
+
+LOGGER = logging.getLogger(__name__)
+
+
+def encode_leaf(account, amount):
+    # abi.encode of (address, uint256), without going through the generic
+    # encoder: it dominates the tree building time otherwise.
+    return keccak(keccak(bytes(12) + bytes.fromhex(account[2:])
+                         + amount.to_bytes(32, 'big')))
+
+
+def hash_pair(left, right):
+    if right < left:
+        left, right = right, left
+    return keccak(left + right)
+
+
+class MerkleTree:
+    def __init__(self, amounts):
+        """Build the tree of `amounts`, an `{address: wei amount}` dict.
+
+        Addresses are kept lowercase, checksumming hundreds of thousands of
+        them costs more than building the tree.
+        """
+        self.amounts = {addr.lower(): int(amount)
+                        for addr, amount in amounts.items()}
+        self.accounts = sorted(self.amounts)
+        self.indexes = {addr: i for i, addr in enumerate(self.accounts)}
+
+        level = [encode_leaf(addr, self.amounts[addr])
+                 for addr in self.accounts]
+        self.levels = [level]
+        while len(level) > 1:
+            parents = [hash_pair(level[i], level[i+1])
+                       for i in range(0, len(level) - 1, 2)]
+            if len(level) % 2:
+                parents.append(level[-1])
+            level = parents
+            self.levels.append(level)
+
+    @property
+    def root(self):
+        if not self.accounts:
+            return bytes(32)
+        return self.levels[-1][0]
+
+    def proof(self, address, levels=None):
+        """Sibling hashes from the leaf of `address` up to the root."""
+        position = self.indexes[address.lower()]
+        proof = []
+        for level in (levels or self.levels)[:-1]:
+            sibling = position ^ 1
+            if sibling < len(level):
+                proof.append(level[sibling])
+            position //= 2
+        return proof
+
+    def claim(self, address, levels=None):
+        """Arguments of the distributor `claim` call for `address`."""
+        address = address.lower()
+        proof = self.proof(address, levels)
+        if levels is None:
+            proof = ['0x' + node.hex() for node in proof]
+        return {
+            'amount': str(self.amounts[address]),
+            'proof': proof
+        }
+
+    def to_dict(self):
+        # Nodes are shared by many proofs, only format each one once.
+        levels = [['0x' + node.hex() for node in level]
+                  for level in self.levels]
+        return {
+            'root': '0x' + self.root.hex(),
+            'leaves': len(self.accounts),
+            'claims': {addr: self.claim(addr, levels)
+                       for addr in self.accounts}
+        }
+
+
+def verify_proof(root, account, amount, proof):
+    node = encode_leaf(account.lower(), int(amount))
+    for sibling in proof:
+        node = hash_pair(node, to_bytes(hexstr=sibling)
+                         if isinstance(sibling, str) else sibling)
+    return node == root
+
+
+def get_previous_amounts():
+    """Cumulative `{address: wei amount}` of the latest successful merkle
+    distribution, empty if there is none."""
+    for post in iter_distribution_posts():
+        content = post['content']
+        if 'merkle' in content and is_successful_distribution(content):
+            claims = get_full_distribution(content)['merkle']['claims']
+            return {address: int(claim['amount'])
+                    for address, claim in claims.items()}
+    return dict()
+
+
+def get_cumulative_amounts(to_distribute, previous):
+    """Add the `to_distribute` wei amounts of the window to the `previous`
+    cumulative ones."""
+    amounts = {address.lower(): amount for address, amount in previous.items()}
+    for address, amount in to_distribute.items():
+        address = address.lower()
+        amounts[address] = amounts.get(address, 0) + amount
+    return amounts
+
+
+def get_distribution_tree(to_distribute, previous=None):
+    """Tree of the cumulative amounts after distributing `to_distribute`,
+    `previous` being looked up in the posts if not given."""
+    if previous is None:
+        previous = get_previous_amounts()
+    return MerkleTree(get_cumulative_amounts(to_distribute, previous))
+
+
+@lru_cache(maxsize=2)
+def get_distributor_abi():
+    return json.load(open(os.path.join(Path(__file__).resolve().parent, 'abi/MerkleDistributor.json')))
+
+
+def get_distributor_contract(web3):
+    return web3.eth.contract(
+        web3.toChecksumAddress(config['merkle']['distributor_address']),
+        abi=get_distributor_abi())
+
+
+def publish_root(to_distribute, metadata, previous=None):
+    """Publish the root of the tree of the cumulative amounts after
+    distributing `to_distribute`, an `{address: wei amount}` dict, on the
+    distributor contract, and record the transaction and the claims in
+    `metadata`.
+
+    The recorded `targets` are the amounts of this window, the claims the
+    cumulative ones. `previous` are the cumulative amounts of the previous
+    distribution, looked up in the posts if not given.
+    """
+    web3 = get_web3()
+    account = get_account()
+    tree = get_distribution_tree(to_distribute, previous)
+    total = sum(to_distribute.values())
+    entry = {
+        'success': False,
+        'status': 'failed',
+        'tx': None,
+        'chain': 'ETH',
+        'sender': account.address,
+        'targets': {a: amount / DECIMALS
+                    for a, amount in to_distribute.items()},
+        'total': total / DECIMALS,
+        'contract_total': str(total),
+        'merkle_root': '0x' + tree.root.hex()
+    }
+    metadata.setdefault('targets', list()).append(entry)
+    metadata['merkle'] = tree.to_dict()
+
+    try:
+        tx = get_distributor_contract(web3).functions.setMerkleRoot(tree.root)
+        tx = tx.buildTransaction({
+            'chainId': config['web3']['chain_id'],
+            'gasPrice': get_gas_price(config['web3']['chain_id']),
+            'nonce': web3.eth.getTransactionCount(account.address, 'pending'),
+            })
+        signed_tx = account.signTransaction(tx)
+        tx_hash = web3.eth.sendRawTransaction(signed_tx.rawTransaction).hex()
+    except Exception:
+        LOGGER.exception("Error publishing merkle root")
+        return metadata
+
+    LOGGER.info(f"TX {tx_hash} created on ETH")
+    entry['tx'] = tx_hash
+    entry['status'] = 'pending'
+    try:
+        receipt = web3.eth.waitForTransactionReceipt(
+            tx_hash,
+            timeout=(config.get('transactions') or dict()).get(
+                'receipt_timeout', 1800))
+    except Exception:
+        LOGGER.exception(f"Error following TX {tx_hash}")
+        return metadata
+
+    entry['success'] = receipt['status'] == 1
+    entry['status'] = entry['success'] and 'mined' or 'failed'
+    LOGGER.info(f"TX {tx_hash} {entry['status']}")
+    return metadata
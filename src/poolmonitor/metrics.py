@@ -0,0 +1,261 @@
+"""Run instrumentation, enabled by `--profile`.
+
+Records counters (RPC calls, errors and bytes per method and endpoint, logs
+fetched, transfer and reserve events decoded per pool), latency histograms
+per RPC method and endpoint, and the wall time of each phase of a run, per
+pool when it applies. The summary is printed at the end of the run and the
+metrics can be written as JSON or in the Prometheus text format.
+
+When disabled, which is the default, every recording function returns
+after a single flag check.
+"""
+import json
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+from urllib.parse import urlparse
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60)
+
+PREFIX = 'poolmonitor_'
+
+
+class Histogram:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the `q` quantile."""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS + (float('inf'),),
+                                self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def to_dict(self):
+        return {'buckets': dict(zip([str(b) for b in LATENCY_BUCKETS]
+                                    + ['+Inf'], self.counts)),
+                'sum': self.sum, 'count': self.count}
+
+
+class Metrics:
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.counters = dict()
+        self.histograms = dict()
+        self.started = time.monotonic()
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+            self.started = time.monotonic()
+
+
+metrics = Metrics()
+
+
+def enable():
+    metrics.reset()
+    metrics.enabled = True
+
+
+def is_enabled():
+    return metrics.enabled
+
+
+def inc(name, value=1, **labels):
+    """Add `value` to the counter `name`."""
+    if not metrics.enabled:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with metrics.lock:
+        metrics.counters[key] = metrics.counters.get(key, 0) + value
+
+
+def observe(name, value, **labels):
+    """Record `value`, in seconds, in the histogram `name`."""
+    if not metrics.enabled:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with metrics.lock:
+        histogram = metrics.histograms.get(key)
+        if histogram is None:
+            histogram = metrics.histograms[key] = Histogram()
+        histogram.observe(value)
+
+
+@contextmanager
+def _timed(phase, labels):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        inc('phase_seconds', time.perf_counter() - started,
+            phase=phase, **labels)
+        inc('phase_calls', phase=phase, **labels)
+
+
+def timed(phase, **labels):
+    """Context manager adding its wall time to `phase`."""
+    if not metrics.enabled:
+        return nullcontext()
+    return _timed(phase, labels)
+
+
+def record_rpc(method, endpoint, started, request_size=0, response_size=0,
+               error=False):
+    """Record an RPC call to `endpoint` started at `started`
+    (`time.perf_counter()`)."""
+    if not metrics.enabled:
+        return
+    latency = time.perf_counter() - started
+    # Only the host, URLs often hold API keys.
+    endpoint = urlparse(endpoint).netloc or endpoint
+    inc('rpc_requests', method=method, endpoint=endpoint)
+    inc('rpc_request_bytes', request_size, method=method, endpoint=endpoint)
+    inc('rpc_response_bytes', response_size, method=method,
+        endpoint=endpoint)
+    if error:
+        inc('rpc_errors', method=method, endpoint=endpoint)
+    observe('rpc_latency_seconds', latency, method=method, endpoint=endpoint)
+
+
+def get_counters(name):
+    with metrics.lock:
+        return {labels: value for (key, labels), value
+                in metrics.counters.items() if key == name}
+
+
+def to_dict():
+    with metrics.lock:
+        return {
+            'wall_seconds': time.monotonic() - metrics.started,
+            'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                         for (name, labels), value in metrics.counters.items()],
+            'histograms': [{'name': name, 'labels': dict(labels),
+                            **histogram.to_dict()}
+                           for (name, labels), histogram
+                           in metrics.histograms.items()]
+        }
+
+
+def format_labels(labels, **extra):
+    labels = list(labels) + list(extra.items())
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (key, str(value).replace('"', '\\"'))
+                          for key, value in labels) + '}'
+
+
+def to_prometheus():
+    """The metrics in the Prometheus text exposition format."""
+    lines = list()
+    with metrics.lock:
+        names = sorted({name for name, labels in metrics.counters})
+        for name in names:
+            lines.append(f"# TYPE {PREFIX}{name}_total counter")
+            for (key, labels), value in metrics.counters.items():
+                if key == name:
+                    lines.append(f"{PREFIX}{name}_total"
+                                 f"{format_labels(labels)} {value}")
+        names = sorted({name for name, labels in metrics.histograms})
+        for name in names:
+            lines.append(f"# TYPE {PREFIX}{name} histogram")
+            for (key, labels), histogram in metrics.histograms.items():
+                if key != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(
+                        [str(b) for b in LATENCY_BUCKETS] + ['+Inf'],
+                        histogram.counts):
+                    cumulative += count
+                    lines.append(f"{PREFIX}{name}_bucket"
+                                 f"{format_labels(labels, le=bound)} "
+                                 f"{cumulative}")
+                lines.append(f"{PREFIX}{name}_sum{format_labels(labels)} "
+                             f"{histogram.sum}")
+                lines.append(f"{PREFIX}{name}_count{format_labels(labels)} "
+                             f"{histogram.count}")
+    return '\n'.join(lines) + '\n'
+
+
+def write_metrics(path, output_format='json'):
+    with open(path, 'w') as f:
+        if output_format == 'prometheus':
+            f.write(to_prometheus())
+        else:
+            json.dump(to_dict(), f, indent=2)
+
+
+def format_summary():
+    """Summary tables of the RPC calls, phases and throughput."""
+    lines = [f"Wall time: {time.monotonic() - metrics.started:.2f}s", ""]
+
+    requests = get_counters('rpc_requests')
+    if requests:
+        errors = get_counters('rpc_errors')
+        received = get_counters('rpc_response_bytes')
+        with metrics.lock:
+            histograms = {labels: histogram for (name, labels), histogram
+                          in metrics.histograms.items()
+                          if name == 'rpc_latency_seconds'}
+        lines.append(f"{'RPC method':<28} {'endpoint':<28} {'calls':>7} "
+                     f"{'errors':>6} {'MiB in':>8} {'mean':>7} {'p50<':>6} "
+                     f"{'p95<':>6}")
+        for labels, calls in sorted(requests.items(),
+                                    key=lambda item: -item[1]):
+            histogram = histograms[labels]
+            label_values = dict(labels)
+            lines.append(
+                f"{label_values['method']:<28} {label_values['endpoint']:<28} "
+                f"{calls:>7} {errors.get(labels, 0):>6} "
+                f"{received.get(labels, 0) / 2**20:>8.2f} "
+                f"{histogram.sum / histogram.count:>6.3f}s "
+                f"{histogram.quantile(0.5):>5}s {histogram.quantile(0.95):>5}s")
+        lines.append("")
+
+    phases = get_counters('phase_seconds')
+    if phases:
+        calls = get_counters('phase_calls')
+        lines.append(f"{'phase':<20} {'pool':<44} {'calls':>6} {'seconds':>9}")
+        for labels, seconds in sorted(phases.items(),
+                                      key=lambda item: -item[1]):
+            label_values = dict(labels)
+            lines.append(f"{label_values['phase']:<20} "
+                         f"{label_values.get('pool', '-'):<44} "
+                         f"{calls.get(labels, 0):>6} {seconds:>8.2f}s")
+        lines.append("")
+
+    rates = list()
+    logs = sum(get_counters('logs_fetched').values())
+    scan_seconds = sum(seconds for labels, seconds in phases.items()
+                       if dict(labels)['phase'] == 'scan')
+    if logs and scan_seconds:
+        rates.append(f"{'logs':<8} {'scans':<44} {logs:>9} "
+                     f"{logs / scan_seconds:>10,.0f} /s")
+    for labels, count in get_counters('events_decoded').items():
+        seconds = phases.get(tuple(sorted(dict(labels, phase='decode').items())))
+        if seconds:
+            rates.append(f"{'events':<8} {dict(labels)['pool']:<44} "
+                         f"{count:>9} {count / seconds:>10,.0f} /s")
+    if rates:
+        lines.append("Throughput, over the scans wall time and the decoding "
+                     "time:")
+        lines.extend(rates)
+    return '\n'.join(lines)
@@ -0,0 +1,55 @@
+"""Batched contract reads through a Multicall contract.
+
+Every view call is sent in a single `aggregate` eth_call pinned to one block,
+so all pools are measured at the same height in one round trip.
+"""
+import json
+import os
+from functools import lru_cache
+from pathlib import Path
+
+from web3._utils.abi import get_abi_output_types
+
+from .settings import config
+
+
+@lru_cache(maxsize=2)
+def get_multicall_abi():
+    return json.load(open(os.path.join(Path(__file__).resolve().parent, 'abi/Multicall.json')))
+
+
+def decode_output(web3, function, data):
+    values = web3.codec.decode_abi(get_abi_output_types(function.abi), data)
+    if len(values) == 1:
+        return values[0]
+    return list(values)
+
+
+def call_all(web3, calls, block_identifier='latest'):
+    """Run the bound contract `calls` at `block_identifier`.
+
+    Returns their outputs, decoded like `ContractFunction.call()` would. Falls
+    back to one eth_call per function if no `multicall_address` is set.
+    """
+    address = config['web3'].get('multicall_address')
+    if not address:
+        return [call.call(block_identifier=block_identifier) for call in calls]
+
+    multicall = web3.eth.contract(web3.toChecksumAddress(address),
+                                  abi=get_multicall_abi())
+    block_number, return_data = multicall.functions.aggregate(
+        [(call.address, call._encode_transaction_data()) for call in calls]
+    ).call(block_identifier=block_identifier)
+    return [decode_output(web3, call, data)
+            for call, data in zip(calls, return_data)]
+
+
+def call_groups(web3, groups, block_identifier='latest'):
+    """Like `call_all`, for a list of call lists, in a single batch."""
+    results = call_all(web3, [call for calls in groups for call in calls],
+                       block_identifier)
+    grouped = []
+    for calls in groups:
+        grouped.append(results[:len(calls)])
+        results = results[len(calls):]
+    return grouped
@@ -0,0 +1,161 @@
+"""Threaded pipeline between the logs scan and its consumer.
+
+The source (batches of logs from `get_logs`) is iterated in its own thread,
+each stage runs in its own thread too, and the consumer iterates over the
+output of the last stage. Stages are linked by queues of at most
+`pipeline.queue_size` items: a stage that gets ahead blocks until the next
+one catches up, so the fetch of the next windows overlaps the decoding and
+the accrual of the previous ones without buffering the whole scan.
+
+Closing the pipeline, or leaving the loop over it, stops every thread at
+its next item. An exception in a thread is raised again in the consumer.
+
+The depth of each queue tells which stage is the bottleneck: full queues
+in front of a stage mean that stage is the slow one, empty ones that it is
+starved. `queue_depths()` returns the current depths of the running
+pipelines, and each pipeline logs its average depths when closed.
+"""
+import logging
+import queue
+import threading
+from itertools import islice
+
+from .settings import config
+
+LOGGER = logging.getLogger(__name__)
+
+DONE = object()
+
+RUNNING = set()
+RUNNING_LOCK = threading.Lock()
+
+
+class StageError:
+    def __init__(self, error):
+        self.error = error
+
+
+def iter_batches(items, size):
+    items = iter(items)
+    while True:
+        batch = list(islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+
+class Pipeline:
+    """Run `source` and the `(name, function)` `stages` in threads, iterate
+    over the results of the last stage."""
+
+    def __init__(self, name, source, stages, queue_size=None):
+        if queue_size is None:
+            queue_size = (config.get('pipeline') or dict()).get(
+                'queue_size', 4)
+        self.name = name
+        self.source = source
+        self.stages = stages
+        self.names = ['fetch'] + [stage_name for stage_name, _ in stages]
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in self.names]
+        self.stopped = threading.Event()
+        self.threads = list()
+        self.samples = 0
+        self.depth_sums = [0] * len(self.queues)
+
+    def put(self, output, item):
+        """Put `item` in `output` unless stopped, return False if stopped."""
+        while not self.stopped.is_set():
+            try:
+                output.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def run_source(self, output):
+        try:
+            for item in self.source:
+                if not self.put(output, item):
+                    break
+            else:
+                self.put(output, DONE)
+        except Exception as e:
+            self.put(output, StageError(e))
+        finally:
+            # Closed from its own thread, it may be running when stopped.
+            close = getattr(self.source, 'close', None)
+            if close is not None:
+                close()
+
+    def run_stage(self, function, input, output):
+        while not self.stopped.is_set():
+            try:
+                item = input.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is DONE or isinstance(item, StageError):
+                self.put(output, item)
+                return
+            try:
+                result = function(item)
+            except Exception as e:
+                self.put(output, StageError(e))
+                return
+            if not self.put(output, result):
+                return
+
+    def start(self):
+        self.threads.append(threading.Thread(
+            target=self.run_source, args=(self.queues[0],), daemon=True,
+            name=f"{self.name}-fetch"))
+        for i, (stage_name, function) in enumerate(self.stages):
+            self.threads.append(threading.Thread(
+                target=self.run_stage,
+                args=(function, self.queues[i], self.queues[i+1]),
+                daemon=True, name=f"{self.name}-{stage_name}"))
+        with RUNNING_LOCK:
+            RUNNING.add(self)
+        for thread in self.threads:
+            thread.start()
+
+    def depths(self):
+        """Items waiting after each stage, by stage name."""
+        return {name: output.qsize()
+                for name, output in zip(self.names, self.queues)}
+
+    def __iter__(self):
+        if not self.threads:
+            self.start()
+        try:
+            while True:
+                for i, output in enumerate(self.queues):
+                    self.depth_sums[i] += output.qsize()
+                self.samples += 1
+                item = self.queues[-1].get()
+                if item is DONE:
+                    return
+                if isinstance(item, StageError):
+                    raise item.error
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop every thread, they exit at their next item."""
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        with RUNNING_LOCK:
+            RUNNING.discard(self)
+        if self.samples:
+            averages = ", ".join(
+                f"{name} {depth_sum / self.samples:.1f}"
+                for name, depth_sum in zip(self.names, self.depth_sums))
+            LOGGER.debug(f"Pipeline {self.name} average queue depths: "
+                         f"{averages}")
+
+
+def queue_depths():
+    """Queue depths of the running pipelines, by pipeline name."""
+    with RUNNING_LOCK:
+        return {pipeline.name: pipeline.depths() for pipeline in RUNNING}
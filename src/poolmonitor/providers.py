@@ -0,0 +1,211 @@
+"""Pool of JSON-RPC endpoints behind a single web3 provider.
+
+With several `web3.urls` configured, requests are spread over the endpoints
+by health score: their recent median latency, inflated by their error rate
+and by the requests already in flight on them. An endpoint failing
+`max_failures` times in a row is dropped for `cooldown` seconds, and the
+request goes on to the next one.
+
+Read-only requests (`eth_getLogs`, `eth_call`, ...) are hedged: if the
+answer takes longer than the `hedge_percentile` of the endpoint's recent
+latencies, the same request is sent to the next best endpoint and the first
+answer wins. JSON-RPC errors are answers from the node, not failures.
+"""
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import (ThreadPoolExecutor, FIRST_COMPLETED,
+                                wait as wait_futures)
+
+from web3._utils.request import make_post_request
+from web3.providers.base import BaseProvider
+from web3.providers import rpc
+
+from .settings import config
+from . import metrics
+
+LOGGER = logging.getLogger(__name__)
+
+HEDGED_METHODS = {'eth_getLogs', 'eth_call', 'eth_blockNumber',
+                  'eth_getBlockByNumber', 'eth_getBlockByHash',
+                  'eth_getTransactionReceipt', 'eth_getTransactionCount',
+                  'eth_getBalance', 'eth_chainId', 'eth_gasPrice',
+                  'eth_estimateGas'}
+
+
+class HTTPProvider(rpc.HTTPProvider):
+    """`HTTPProvider` recording its calls in the metrics when enabled."""
+
+    def make_request(self, method, params):
+        if not metrics.is_enabled():
+            return super().make_request(method, params)
+        started = time.perf_counter()
+        request_data = self.encode_rpc_request(method, params)
+        try:
+            raw_response = make_post_request(self.endpoint_uri, request_data,
+                                             **self.get_request_kwargs())
+        except Exception:
+            metrics.record_rpc(method, self.endpoint_uri, started,
+                               len(request_data), error=True)
+            raise
+        response = self.decode_rpc_response(raw_response)
+        metrics.record_rpc(method, self.endpoint_uri, started,
+                           len(request_data), len(raw_response),
+                           error='error' in response)
+        return response
+
+
+class Endpoint:
+    """An RPC endpoint and its recent health."""
+
+    def __init__(self, provider, latency_window=100, max_failures=3,
+                 cooldown=60):
+        self.provider = provider
+        self.name = getattr(provider, 'endpoint_uri', None) or repr(provider)
+        self.latencies = deque(maxlen=latency_window)
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.error_rate = 0.0
+        self.failures = 0
+        self.in_flight = 0
+        self.cooling_until = 0
+        self.lock = threading.Lock()
+
+    @property
+    def available(self):
+        return time.monotonic() >= self.cooling_until
+
+    def latency(self, percentile=50, default=None):
+        """Recent latency at `percentile`, or `default` without enough
+        samples."""
+        with self.lock:
+            if len(self.latencies) < 5:
+                return default
+            latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) * percentile // 100,
+                             len(latencies) - 1)]
+
+    @property
+    def score(self):
+        """Lower is better."""
+        return (self.latency(default=0.1)
+                * (1 + 10 * self.error_rate) * (1 + self.in_flight))
+
+    def request(self, method, params):
+        with self.lock:
+            self.in_flight += 1
+        started = time.monotonic()
+        try:
+            response = self.provider.make_request(method, params)
+        except Exception:
+            with self.lock:
+                self.in_flight -= 1
+                self.error_rate = self.error_rate * 0.9 + 0.1
+                self.failures += 1
+                if self.failures >= self.max_failures:
+                    self.cooling_until = time.monotonic() + self.cooldown
+                    self.failures = 0
+                    LOGGER.warning(f"RPC endpoint {self.name} failing, "
+                                   f"dropped for {self.cooldown}s")
+            raise
+        with self.lock:
+            self.in_flight -= 1
+            self.error_rate *= 0.9
+            self.failures = 0
+            self.latencies.append(time.monotonic() - started)
+        return response
+
+
+class ProviderPool(BaseProvider):
+    """web3 provider sending each request to the healthiest endpoint, with
+    failover and hedging."""
+
+    def __init__(self, providers, hedge_percentile=95, hedge_delay=2.0,
+                 max_hedges=1, max_failures=3, cooldown=60, max_workers=16):
+        self.endpoints = [Endpoint(provider, max_failures=max_failures,
+                                   cooldown=cooldown)
+                          for provider in providers]
+        self.hedge_percentile = hedge_percentile
+        self.hedge_delay = hedge_delay
+        self.max_hedges = max_hedges
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def choose(self, exclude=()):
+        """The best endpoint not in `exclude`, the one back the soonest if
+        they are all cooling down, None if none is left."""
+        candidates = [endpoint for endpoint in self.endpoints
+                      if endpoint not in exclude]
+        if not candidates:
+            return None
+        available = [endpoint for endpoint in candidates
+                     if endpoint.available]
+        if not available:
+            return min(candidates, key=lambda endpoint: endpoint.cooling_until)
+        return min(available, key=lambda endpoint: endpoint.score)
+
+    def make_request(self, method, params):
+        hedged = method in HEDGED_METHODS
+        tried = list()
+        futures = dict()
+        hedges = 0
+        error = None
+
+        def send():
+            endpoint = self.choose(tried)
+            if endpoint is None:
+                return None
+            tried.append(endpoint)
+            futures[self.executor.submit(endpoint.request, method,
+                                         params)] = endpoint
+            return endpoint
+
+        endpoint = send()
+        while futures:
+            timeout = None
+            if hedged and hedges < self.max_hedges \
+                    and len(tried) < len(self.endpoints):
+                timeout = endpoint.latency(self.hedge_percentile,
+                                           self.hedge_delay)
+            done, _ = wait_futures(futures, timeout=timeout,
+                                   return_when=FIRST_COMPLETED)
+            if not done:
+                LOGGER.debug(f"{method} slow on {endpoint.name}, hedging")
+                hedges += 1
+                endpoint = send() or endpoint
+                continue
+
+            for future in done:
+                failed = futures.pop(future)
+                try:
+                    # The slower requests still running are left to finish,
+                    # their answer only counts for the endpoint stats.
+                    return future.result()
+                except Exception as e:
+                    LOGGER.debug(f"{method} failed on {failed.name}: {e!r}")
+                    error = e
+            if not futures:
+                endpoint = send()
+        raise error
+
+    def is_connected(self):
+        return any(getattr(endpoint.provider, 'is_connected',
+                           endpoint.provider.isConnected)()
+                   for endpoint in self.endpoints)
+
+    # Name of older web3 versions.
+    isConnected = is_connected
+
+
+def get_provider_pool(urls):
+    pool_config = config.get('rpc_pool') or dict()
+    providers = [HTTPProvider(url, request_kwargs={
+        'timeout': pool_config.get('timeout', 30)}) for url in urls]
+    return ProviderPool(
+        providers,
+        hedge_percentile=pool_config.get('hedge_percentile', 95),
+        hedge_delay=pool_config.get('hedge_delay', 2.0),
+        max_hedges=pool_config.get('max_hedges', 1),
+        max_failures=pool_config.get('max_failures', 3),
+        cooldown=pool_config.get('cooldown', 60),
+        max_workers=pool_config.get('max_workers', 16))
@@ -0,0 +1,194 @@
+"""Local cache of decoded Transfer events and balance snapshots.
+
+Each pool gets its own SQLite file holding every Transfer seen so far (as
+`(height, log_index, block_hash, src, dst, amount)` rows), the height up to
+which the chain has been scanned, and balance snapshots taken at the end of
+each distribution window. In time-weighted mode, pool reserve changes
+(`(height, log_index, block_hash, absolute, amount0, amount1)` rows) and
+reserve snapshots are kept alongside.
+"""
+import json
+import os
+import sqlite3
+from pathlib import Path
+
+from .settings import config
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS transfers (
+    height INTEGER NOT NULL,
+    log_index INTEGER NOT NULL,
+    block_hash TEXT,
+    src TEXT NOT NULL,
+    dst TEXT NOT NULL,
+    amount TEXT NOT NULL,
+    PRIMARY KEY (height, log_index)
+);
+CREATE TABLE IF NOT EXISTS snapshots (
+    height INTEGER PRIMARY KEY,
+    last_height INTEGER,
+    balances TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS reserves (
+    height INTEGER NOT NULL,
+    log_index INTEGER NOT NULL,
+    block_hash TEXT,
+    absolute INTEGER NOT NULL,
+    amount0 TEXT NOT NULL,
+    amount1 TEXT NOT NULL,
+    PRIMARY KEY (height, log_index)
+);
+CREATE TABLE IF NOT EXISTS reserve_snapshots (
+    height INTEGER PRIMARY KEY,
+    amount0 TEXT NOT NULL,
+    amount1 TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class TransferStore:
+    """SQLite-backed Transfer history of a single pool."""
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def get_meta(self, key, default=None):
+        row = self.db.execute(
+            "SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_meta(self, key, value):
+        self.db.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+            (key, json.dumps(value)))
+
+    @property
+    def synced_height(self):
+        return self.get_meta('synced_height')
+
+    def add_transfers(self, transfers, synced_height, reserves=None):
+        """Store decoded transfers (and reserve changes, if tracked) and mark
+        the chain scanned up to `synced_height`.
+
+        The `reserves` meta flag tells whether the reserve changes were
+        tracked all along: a sync without them clears it.
+        """
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO transfers VALUES (?, ?, ?, ?, ?, ?)",
+                ((height, log_index, block_hash, src, dst, str(amount))
+                 for height, log_index, block_hash, src, dst, amount
+                 in transfers))
+            if reserves is not None:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO reserves VALUES (?, ?, ?, ?, ?, ?)",
+                    ((height, log_index, block_hash, absolute,
+                      str(amount0), str(amount1))
+                     for height, log_index, block_hash, absolute,
+                     amount0, amount1 in reserves))
+            self.set_meta('reserves', reserves is not None)
+            self.set_meta('synced_height', synced_height)
+
+    def iter_transfers(self, after=None, until=None):
+        query = "SELECT * FROM transfers WHERE height > ?"
+        params = [-1 if after is None else after]
+        if until is not None:
+            query += " AND height <= ?"
+            params.append(until)
+        query += " ORDER BY height, log_index"
+        for height, log_index, block_hash, src, dst, amount \
+                in self.db.execute(query, params):
+            yield height, log_index, block_hash, src, dst, int(amount)
+
+    def iter_reserves(self, after=None, until=None):
+        query = "SELECT * FROM reserves WHERE height > ?"
+        params = [-1 if after is None else after]
+        if until is not None:
+            query += " AND height <= ?"
+            params.append(until)
+        query += " ORDER BY height, log_index"
+        for height, log_index, block_hash, absolute, amount0, amount1 \
+                in self.db.execute(query, params):
+            yield (height, log_index, block_hash, bool(absolute),
+                   int(amount0), int(amount1))
+
+    def last_block_hash(self, until):
+        """Return the `(height, block_hash)` of the latest stored transfer
+        at or below `until`."""
+        return self.db.execute(
+            "SELECT height, block_hash FROM transfers WHERE height <= ? "
+            "AND block_hash IS NOT NULL ORDER BY height DESC LIMIT 1",
+            (until,)).fetchone()
+
+    def rewind(self, height, snapshots=True):
+        """Forget the transfers (and snapshots, unless told otherwise)
+        above `height`."""
+        with self.db:
+            self.db.execute("DELETE FROM transfers WHERE height > ?", (height,))
+            self.db.execute("DELETE FROM reserves WHERE height > ?", (height,))
+            if snapshots:
+                self.db.execute("DELETE FROM snapshots WHERE height > ?",
+                                (height,))
+                self.db.execute(
+                    "DELETE FROM reserve_snapshots WHERE height > ?", (height,))
+            if (self.synced_height or 0) > height:
+                self.set_meta('synced_height', height)
+
+    def save_snapshot(self, height, last_height, balances, reserves=None):
+        """Record `balances` after every transfer up to `height` included.
+
+        `last_height` is the height of the last of those transfers.
+        `reserves` is the `(amount0, amount1)` reserve state at `height`, in
+        time-weighted mode.
+        """
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?)",
+                (height, last_height,
+                 json.dumps({a: str(b) for a, b in balances.items()})))
+            if reserves is not None:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO reserve_snapshots VALUES (?, ?, ?)",
+                    (height, str(reserves[0]), str(reserves[1])))
+
+    def load_snapshot(self, max_height):
+        """Return the latest `(height, last_height, balances)` snapshot at
+        or below `max_height`, or None."""
+        row = self.db.execute(
+            "SELECT height, last_height, balances FROM snapshots "
+            "WHERE height <= ? ORDER BY height DESC LIMIT 1",
+            (max_height,)).fetchone()
+        if row is None:
+            return None
+        height, last_height, balances = row
+        return height, last_height, {a: int(b) for a, b
+                                     in json.loads(balances).items()}
+
+    def load_reserve_snapshot(self, height):
+        """Return the `(amount0, amount1)` reserve state saved at `height`,
+        or None."""
+        row = self.db.execute(
+            "SELECT amount0, amount1 FROM reserve_snapshots WHERE height = ?",
+            (height,)).fetchone()
+        return row and (int(row[0]), int(row[1]))
+
+
+def open_store(pool):
+    """Open the cache of `pool`, or return None if caching is disabled."""
+    cache_config = config.get('cache') or dict()
+    if not cache_config.get('enabled', False):
+        return None
+
+    path = Path(cache_config.get('path', '.poolmonitor'))
+    os.makedirs(path, exist_ok=True)
+    name = f"{config['web3']['chain_id']}_{pool['address'].lower()}.sqlite3"
+    return TransferStore(str(path / name))
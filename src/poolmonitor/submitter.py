@@ -0,0 +1,280 @@
+"""Packing and submission of the batchTransfer transactions of a
+distribution.
+
+Recipients are packed into batches by estimated gas: sending tokens to an
+address that never held any costs a new storage slot, a lot more than
+topping up an existing holder. Batches are filled up to a gas ceiling and
+get a gas limit from `estimateGas`, with a margin.
+
+All batches are signed up front with consecutive nonces, broadcast one after
+the other without waiting for each to be mined, then followed by a receipt
+poller running in the background. The poller updates each target's status
+in the distribution metadata (`mined`, `failed` or `replaced`) and re-sends
+transactions stuck for too long with a higher gas price.
+"""
+import logging
+import threading
+import time
+
+from web3.exceptions import TransactionNotFound
+
+from .settings import config
+from .ethereum import (DECIMALS, get_web3, get_account, get_token_contract,
+                       get_gas_price)
+from .multicall import call_all
+
+LOGGER = logging.getLogger(__name__)
+
+
+class BatchSubmitter:
+    def __init__(self, web3, account, contract, metadata):
+        self.web3 = web3
+        self.account = account
+        self.contract = contract
+        self.metadata = metadata
+        self.pending = list()
+        self.lock = threading.Lock()
+        self.poller = None
+
+        tx_config = config.get('transactions') or dict()
+        self.poll_interval = tx_config.get('poll_interval', 5)
+        self.receipt_timeout = tx_config.get('receipt_timeout', 1800)
+        self.replace_after = tx_config.get('replace_after', 300)
+        self.gas_bump = tx_config.get('gas_bump', 1.125)
+        self.max_replacements = tx_config.get('max_replacements', 3)
+
+    def sign(self, targets, gas, nonce, gas_price):
+        tx = get_batch_transfer(self.web3, self.contract, targets)
+        tx = tx.buildTransaction({
+            'chainId': config['web3']['chain_id'],
+            'gas': gas,
+            'gasPrice': gas_price,
+            'nonce': nonce,
+            })
+        return self.account.signTransaction(tx)
+
+    def record(self, targets, tx_hash=None):
+        total = sum(targets.values())
+        entry = {
+            'success': tx_hash is not None,
+            'status': tx_hash and 'pending' or 'failed',
+            'tx': tx_hash,
+            'chain': 'ETH',
+            'sender': self.account.address,
+            'targets': {a: amount / DECIMALS for a, amount in targets.items()},
+            'total': total / DECIMALS,
+            'contract_total': str(total)
+        }
+        self.metadata.setdefault('targets', list()).append(entry)
+        return entry
+
+    def submit(self, batches):
+        """Sign and broadcast every `(targets, gas)` batch, then start
+        following them."""
+        total = sum(sum(targets.values()) for targets, gas in batches)
+        LOGGER.info(f"Preparing transfer of {total / DECIMALS} in "
+                    f"{len(batches)} batches")
+
+        try:
+            balance = self.contract.functions.balanceOf(
+                self.account.address).call()
+            if total >= balance:
+                raise ValueError(f"Balance not enough "
+                                 f"({total / DECIMALS}/{balance / DECIMALS})")
+
+            nonce = self.web3.eth.getTransactionCount(self.account.address,
+                                                      'pending')
+            gas_price = get_gas_price(config['web3']['chain_id'])
+            signed = [self.sign(targets, gas, nonce + i, gas_price)
+                      for i, (targets, gas) in enumerate(batches)]
+        except Exception:
+            LOGGER.exception("Error packing ethereum TX")
+            for targets, gas in batches:
+                self.record(targets)
+            return
+
+        for i, ((targets, gas), signed_tx) in enumerate(zip(batches, signed)):
+            try:
+                tx_hash = self.web3.eth.sendRawTransaction(
+                    signed_tx.rawTransaction).hex()
+            except Exception:
+                # Later nonces could never be mined, don't send them.
+                LOGGER.exception("Error sending ethereum TX")
+                for remaining, gas in batches[i:]:
+                    self.record(remaining)
+                break
+
+            LOGGER.info(f"TX {tx_hash} created on ETH")
+            with self.lock:
+                self.pending.append({
+                    'entry': self.record(targets, tx_hash),
+                    'targets': targets,
+                    'gas': gas,
+                    'nonce': nonce + i,
+                    'gas_price': gas_price,
+                    'hashes': [tx_hash],
+                    'sent_at': time.monotonic(),
+                })
+
+        if self.pending:
+            self.poller = threading.Thread(target=self.poll, daemon=True)
+            self.poller.start()
+
+    def poll(self):
+        deadline = time.monotonic() + self.receipt_timeout
+        while time.monotonic() < deadline:
+            with self.lock:
+                if not self.pending:
+                    return
+                for tracked in list(self.pending):
+                    try:
+                        if self.check(tracked):
+                            self.pending.remove(tracked)
+                    except Exception:
+                        LOGGER.exception(f"Error following TX {tracked['hashes'][-1]}")
+            time.sleep(self.poll_interval)
+        LOGGER.warning(f"{len(self.pending)} TX still pending")
+
+    def check(self, tracked):
+        """Update a pending transaction, return True once it is settled."""
+        entry = tracked['entry']
+        # Read the nonce first, so a TX mined meanwhile is not mistaken for
+        # a replaced one.
+        used_nonce = self.web3.eth.getTransactionCount(
+            self.account.address) > tracked['nonce']
+
+        for tx_hash in reversed(tracked['hashes']):
+            try:
+                receipt = self.web3.eth.getTransactionReceipt(tx_hash)
+            except TransactionNotFound:
+                continue
+            if receipt is None:
+                continue
+            entry['tx'] = tx_hash
+            entry['success'] = receipt['status'] == 1
+            entry['status'] = entry['success'] and 'mined' or 'failed'
+            LOGGER.info(f"TX {tx_hash} {entry['status']}")
+            return True
+
+        if used_nonce:
+            LOGGER.warning(f"TX {tracked['hashes'][-1]} replaced by another TX")
+            entry['success'] = False
+            entry['status'] = 'replaced'
+            return True
+
+        if (time.monotonic() - tracked['sent_at'] > self.replace_after
+                and len(tracked['hashes']) <= self.max_replacements):
+            self.replace(tracked)
+        return False
+
+    def replace(self, tracked):
+        gas_price = int(tracked['gas_price'] * self.gas_bump) + 1
+        signed_tx = self.sign(tracked['targets'], tracked['gas'],
+                              tracked['nonce'], gas_price)
+        tx_hash = self.web3.eth.sendRawTransaction(
+            signed_tx.rawTransaction).hex()
+        LOGGER.info(f"TX {tracked['hashes'][-1]} stuck, replaced by {tx_hash} "
+                    f"at gas price {gas_price}")
+        tracked['gas_price'] = gas_price
+        tracked['hashes'].append(tx_hash)
+        tracked['sent_at'] = time.monotonic()
+        tracked['entry']['tx'] = tx_hash
+
+    def wait(self):
+        """Block until every transaction is settled or the poller gives up."""
+        if self.poller is not None:
+            self.poller.join()
+
+
+def get_batch_transfer(web3, contract, targets):
+    return contract.functions.batchTransfer(
+        [web3.toChecksumAddress(addr) for addr in targets.keys()],
+        list(targets.values()))
+
+
+def get_holders(web3, contract, addresses, chunk_size=500):
+    """Return the set of `addresses` already holding tokens."""
+    holders = set()
+    for i in range(0, len(addresses), chunk_size):
+        chunk = addresses[i:i+chunk_size]
+        balances = call_all(web3, [
+            contract.functions.balanceOf(web3.toChecksumAddress(addr))
+            for addr in chunk])
+        holders.update(addr for addr, balance in zip(chunk, balances)
+                       if balance > 0)
+    return holders
+
+
+def estimate_batch_gas(web3, contract, account, targets):
+    """Gas limit of a batch, from `estimateGas` with the configured margin,
+    or None if the node can't estimate it."""
+    gas_config = config.get('gas') or dict()
+    try:
+        estimate = get_batch_transfer(web3, contract, targets).estimateGas(
+            {'from': account.address})
+    except Exception:
+        LOGGER.exception("Can't estimate batch gas")
+        return None
+    return int(estimate * gas_config.get('margin', 1.1))
+
+
+def pack_batches(to_distribute, web3=None, contract=None, account=None):
+    """Split the `{address: wei amount}` to distribute into `(targets, gas)`
+    batches filled up to the configured gas ceiling.
+
+    Batches are filled with the gas model: a fixed cost per transaction plus
+    a cost per recipient, higher for recipients not holding tokens yet. Each
+    batch is then estimated by the node, and split if it goes over the
+    ceiling.
+    """
+    web3 = web3 or get_web3()
+    contract = contract or get_token_contract(web3)
+    account = account or get_account()
+
+    gas_config = config.get('gas') or dict()
+    ceiling = gas_config.get('ceiling', 7000000)
+    base_gas = gas_config.get('base', 40000)
+    holder_gas = gas_config.get('existing_holder', 12000)
+    new_holder_gas = gas_config.get('new_holder', 30000)
+    max_items = config.get('batch_size')
+
+    holders = get_holders(web3, contract, list(to_distribute.keys()))
+
+    planned = list()
+    targets, gas = dict(), base_gas
+    for address, amount in to_distribute.items():
+        cost = address in holders and holder_gas or new_holder_gas
+        if targets and (gas + cost > ceiling
+                        or (max_items and len(targets) >= max_items)):
+            planned.append((targets, gas))
+            targets, gas = dict(), base_gas
+        targets[address] = amount
+        gas += cost
+    if targets:
+        planned.append((targets, gas))
+
+    batches = list()
+    while planned:
+        targets, modeled_gas = planned.pop(0)
+        gas = estimate_batch_gas(web3, contract, account, targets)
+        if gas is not None and gas > ceiling and len(targets) > 1:
+            items = list(targets.items())
+            middle = len(items) // 2
+            planned[:0] = [(dict(items[:middle]), None),
+                           (dict(items[middle:]), None)]
+            continue
+        if gas is None:
+            gas = modeled_gas or ceiling
+        batches.append((targets, gas))
+    return batches
+
+
+def submit_batches(batches, metadata):
+    """Send the `(targets, gas)` batches of a distribution and wait for
+    their receipts, recording them in `metadata`."""
+    web3 = get_web3()
+    submitter = BatchSubmitter(web3, get_account(), get_token_contract(web3),
+                               metadata)
+    submitter.submit(batches)
+    submitter.wait()
+    return metadata
@@ -0,0 +1,195 @@
+"""Recompute past distributions and compare them with their posts, the
+`verify` command.
+
+Every `incentive-distribution` post is checked pool by pool: the rewards of
+its `start`/`end` window are recomputed from the cached transfers with the
+posted `per_block`, and compared per address within `verify.tolerance`.
+
+The windows of each pool are split into chains that don't overlap, and the
+chains into chunks replayed by `replay_epochs` in a process pool, so each
+worker makes a single pass over the history of its chunk.
+"""
+import json
+import logging
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from .settings import config
+from .ethereum import get_web3
+from .cassette import get_cassette
+from .accrual import compute_rewards, get_reward_start
+from .aleph import (iter_distribution_posts, is_successful_distribution,
+                    get_full_distribution)
+from .history import replay_epochs, sync_store
+from .storage import open_store
+
+LOGGER = logging.getLogger(__name__)
+
+CONFIG_TYPES = (str, int, float, bool, type(None), list, dict)
+
+
+def get_plain_config():
+    """Copy of the configuration without the runtime pool hooks, to set up
+    the worker processes."""
+    plain = dict(config)
+    plain['pools'] = [{key: value for key, value in pool.items()
+                       if isinstance(value, CONFIG_TYPES)}
+                      for pool in config['pools']]
+    return plain
+
+
+def init_worker(plain_config):
+    from . import uniswap, balancer
+    config.clear()
+    config.update(plain_config)
+    if (config.get('cassette') or dict()).get('mode') == 'record':
+        # Workers exit without saving, the parent records what it fetches:
+        # the logs, filling the caches the workers read.
+        config['cassette'] = None
+    # Don't share the parent connections.
+    get_web3.cache_clear()
+    get_cassette.cache_clear()
+    uniswap.set_pools()
+    balancer.set_pools()
+
+
+def replay_chunk(address, epochs):
+    """Return the `(weights, total_weight, reward_start)` of the `(start,
+    end)` epochs of a pool, in a worker.
+
+    The cache is only read: several workers may replay the same pool.
+    """
+    pool = [pool for pool in config['pools'] if pool['address'] == address][0]
+    results = dict()
+    for (start, end), (accrual, last_event_height, reserve_tracker) in zip(
+            epochs, replay_epochs(pool, [(get_reward_start(pool, start), end)
+                                         for start, end in epochs],
+                                  save_snapshots=False)):
+        if end <= accrual.reward_start:
+            results[(start, end)] = (dict(), 0, accrual.reward_start)
+        else:
+            results[(start, end)] = (accrual.finalize(end),
+                                     accrual.total_weight, accrual.reward_start)
+    return address, results
+
+
+def get_chains(windows):
+    """Split `(start, end)` windows into lists of consecutive windows not
+    overlapping."""
+    chains = list()
+    for window in sorted(windows):
+        for chain in chains:
+            if chain[-1][1] < window[0]:
+                chain.append(window)
+                break
+        else:
+            chains.append([window])
+    return chains
+
+
+def get_chunks(chains, count):
+    """Split the chains into about `count` chunks in total."""
+    total = sum(len(chain) for chain in chains)
+    size = max(math.ceil(total / max(count, 1)), 1)
+    return [chain[i:i+size] for chain in chains
+            for i in range(0, len(chain), size)]
+
+
+def compare_rewards(posted, computed, tolerance):
+    """Return the `{address: (posted, computed)}` amounts that differ."""
+    differences = dict()
+    for address in set(posted) | set(computed):
+        posted_amount = posted.get(address, 0)
+        computed_amount = computed.get(address, 0)
+        if not math.isclose(posted_amount, computed_amount,
+                            rel_tol=tolerance, abs_tol=tolerance):
+            differences[address] = (posted_amount, computed_amount)
+    return differences
+
+
+def verify(posts, pools):
+    """Check the pools of every post, return a report entry per post pool."""
+    cache_config = config.get('cache') or dict()
+    if (not cache_config.get('enabled', False)
+            and (config.get('cassette') or dict()).get('mode') == 'record'):
+        # The workers would fetch the logs outside of the cassette.
+        raise ValueError("Recording verify requires the cache to be enabled")
+
+    verify_config = config.get('verify') or dict()
+    tolerance = verify_config.get('tolerance', 1e-9)
+    workers = verify_config.get('processes') or None
+
+    known = {pool['address']: pool for pool in pools}
+    windows = dict()
+    for post in posts:
+        for pool_info in post['content'].get('pools', []):
+            if pool_info['address'] in known:
+                windows.setdefault(pool_info['address'], set()).add(
+                    (pool_info['start'], pool_info['end']))
+
+    # Fill the caches once, the workers then only read them (they don't
+    # save snapshots).
+    web3 = get_web3()
+    for address, pool_windows in windows.items():
+        store = open_store(known[address])
+        if store is None:
+            LOGGER.warning("Cache disabled, every worker will fetch the logs")
+            break
+        sync_store(store, web3, known[address],
+                   max(end for start, end in pool_windows))
+        store.close()
+
+    tasks = [(address, chunk) for address, pool_windows in windows.items()
+             for chunk in get_chunks(get_chains(pool_windows),
+                                     workers or os.cpu_count())]
+    replayed = {address: dict() for address in windows}
+    if tasks:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                 initargs=(get_plain_config(),)) as executor:
+            for address, results in executor.map(replay_chunk, *zip(*tasks)):
+                replayed[address].update(results)
+
+    report = list()
+    for post in posts:
+        content = get_full_distribution(post['content'])
+        for pool_info in content.get('pools', []):
+            entry = {
+                'hash': post.get('item_hash'),
+                'pool': pool_info['address'],
+                'start': pool_info['start'],
+                'end': pool_info['end'],
+                'successful': is_successful_distribution(content),
+            }
+            if pool_info['address'] not in known:
+                entry.update(ok=False, error="unknown pool")
+                report.append(entry)
+                continue
+            weights, total_weight, reward_start = replayed[
+                pool_info['address']][(pool_info['start'], pool_info['end'])]
+            computed = compute_rewards(weights, total_weight,
+                                       pool_info['per_block'],
+                                       pool_info['end'] - reward_start)
+            differences = compare_rewards(pool_info['distribution'], computed,
+                                          tolerance)
+            entry.update(ok=not differences, differences=differences)
+            report.append(entry)
+    return report
+
+
+def run_verify(args):
+    posts = list(iter_distribution_posts())
+    report = verify(posts, config['pools'])
+    for entry in report:
+        status = entry['ok'] and "OK" or "MISMATCH"
+        print(f"{status} {entry['hash']} {entry['pool']} "
+              f"{entry['start']}-{entry['end']}: "
+              f"{len(entry.get('differences', {}))} differences "
+              f"{entry.get('error', '')}")
+    failed = [entry for entry in report if not entry['ok']]
+    print(f"{len(report) - len(failed)}/{len(report)} pool distributions "
+          f"match")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f)
+    return report
@@ -0,0 +1,316 @@
+"""Long-running distribution daemon, the `watch` command.
+
+The accrual state of every pool is kept in memory and only the transfers of
+new blocks are applied to it. Blocks are applied once they are
+`confirmations` deep, so short reorgs never reach the state. A deeper one is
+noticed on the hash of the last applied block, and the pool is then replayed
+again from the cache.
+
+Distributions are sent on a block and/or time schedule straight from that
+state, which is checkpointed to disk so a restart resumes from the last
+checkpoint instead of replaying the whole history.
+"""
+import json
+import logging
+import os
+import time
+from pathlib import Path
+
+from .settings import config
+from .ethereum import get_web3
+from .accrual import (RewardAccrual, TimeWeightedAverage, compute_rewards,
+                      get_reward_start)
+from .history import (fetch_transfers, replay_history, track_reserves,
+                      build_balance_index)
+from .multicall import call_groups
+from .commands import (get_start_height, get_pool_weights, get_distribution,
+                       send_distribution)
+
+LOGGER = logging.getLogger(__name__)
+
+
+def get_block_hash(web3, height):
+    return web3.eth.getBlock(height)['hash'].hex()
+
+
+class PoolWatcher:
+    """Accrual state of a pool over the current reward window, applied up
+    to `height`."""
+
+    def __init__(self, pool, start_height):
+        self.pool = pool
+        self.reward_start = get_reward_start(pool, start_height)
+        self.accrual = RewardAccrual(self.reward_start)
+        self.last_event_height = None
+        self.averages = None
+        self.reserve_state = None
+        self.height = None
+        self.block_hash = None
+
+    def rebuild(self, web3, height):
+        """Replay the pool history up to `height`."""
+        self.accrual, self.last_event_height, reserve_tracker = \
+            replay_history(self.pool, self.reward_start, height)
+        if reserve_tracker is not None:
+            self.averages, self.reserve_state = reserve_tracker
+        self.height = height
+        self.block_hash = get_block_hash(web3, height)
+
+    def advance(self, web3, height):
+        """Apply the transfers of the blocks up to `height`."""
+        if get_block_hash(web3, self.height) != self.block_hash:
+            LOGGER.warning(f"Block {self.height} reorganized, replaying "
+                           f"{self.pool['address']}")
+            self.rebuild(web3, height)
+            return
+
+        # Fetch everything first, a failed fetch must leave the state as is.
+        reserves = list() if self.averages is not None else None
+        transfers = list(fetch_transfers(web3, self.pool, self.height, height,
+                                         reserves))
+        block_hash = get_block_hash(web3, height)
+
+        for event_height, log_index, event_hash, src, dst, amount in transfers:
+            self.accrual.transfer(event_height, src, dst, amount)
+            self.last_event_height = event_height
+        if 'balance_index' in self.pool:
+            self.pool['balance_index'].add_transfers(transfers, height)
+        if reserves is not None:
+            self.reserve_state = track_reserves(
+                self.averages, self.reserve_state, reserves, height)
+        self.height = height
+        self.block_hash = block_hash
+
+    def close_window(self, start_height):
+        """Finalize the window at the current height and open the next one
+        at `start_height`.
+
+        Returns the weights, total weight and reward start of the closed
+        window, and its average reserves in time-weighted mode.
+        """
+        end_height = self.height
+        weights = self.accrual.finalize(end_height)
+        closed = (weights, self.accrual.total_weight, self.reward_start,
+                  self.averages and [average.average(end_height)
+                                     for average in self.averages])
+
+        # Same state as a run restoring the snapshot taken at `end_height`.
+        self.reward_start = get_reward_start(self.pool, start_height)
+        accrual = RewardAccrual(self.reward_start)
+        accrual.restore(self.accrual.balances, self.last_event_height)
+        self.accrual = accrual
+        if self.averages is not None:
+            self.averages = [TimeWeightedAverage(self.reward_start, value)
+                             for value in self.reserve_state]
+        return closed
+
+    def to_dict(self):
+        return {
+            'reward_start': self.reward_start,
+            'height': self.height,
+            'block_hash': self.block_hash,
+            'last_event_height': self.last_event_height,
+            'accrual': self.accrual.to_dict(),
+            'averages': self.averages and [average.to_dict()
+                                           for average in self.averages],
+            'reserve_state': self.reserve_state and [
+                str(value) for value in self.reserve_state]
+        }
+
+    def load(self, state):
+        self.reward_start = state['reward_start']
+        self.height = state['height']
+        self.block_hash = state['block_hash']
+        self.last_event_height = state['last_event_height']
+        self.accrual = RewardAccrual.from_dict(state['accrual'])
+        if state['averages'] is not None:
+            self.averages = [TimeWeightedAverage.from_dict(average)
+                             for average in state['averages']]
+            self.reserve_state = tuple(int(value)
+                                       for value in state['reserve_state'])
+
+
+class Watcher:
+    def __init__(self, pools, act=False, post=True):
+        watch_config = config.get('watch') or dict()
+        self.pools = pools
+        self.act = act
+        self.post = post
+        self.confirmations = watch_config.get('confirmations', 12)
+        self.poll_interval = watch_config.get('poll_interval', 15)
+        self.checkpoint_interval = watch_config.get('checkpoint_interval', 300)
+        self.every_blocks = watch_config.get('every_blocks')
+        self.every_seconds = watch_config.get('every_seconds')
+        self.checkpoint_path = get_checkpoint_path()
+        self.window_start = None
+        self.window_opened = None
+        self.watchers = None
+        self.checkpointed = time.monotonic()
+
+    @property
+    def height(self):
+        return min(watcher.height for watcher in self.watchers)
+
+    def start(self, web3, start_height):
+        """Resume from the checkpoint, or replay the histories from the
+        start of the current window."""
+        safe_height = web3.eth.blockNumber - self.confirmations
+        if self.load_checkpoint():
+            LOGGER.info(f"Resuming from checkpoint at {self.height}")
+            if config.get('balance_index', False):
+                # Not part of the checkpoint, built again from the cache.
+                for watcher in self.watchers:
+                    build_balance_index(web3, watcher.pool, watcher.height)
+            return
+
+        self.window_start = get_start_height(start_height)
+        self.window_opened = time.time()
+        self.watchers = [PoolWatcher(pool, self.window_start)
+                         for pool in self.pools]
+        target = min(safe_height, self.due_height or safe_height)
+        for watcher in self.watchers:
+            watcher.rebuild(web3, target)
+        self.save_checkpoint()
+
+    @property
+    def due_height(self):
+        if not self.every_blocks:
+            return None
+        return self.window_start + self.every_blocks
+
+    def is_due(self):
+        heights = {watcher.height for watcher in self.watchers}
+        if len(heights) > 1 or self.height <= self.window_start:
+            # Wait until every pool is at the same height.
+            return False
+        if self.due_height is not None and self.height >= self.due_height:
+            return True
+        return bool(self.every_seconds
+                    and time.time() >= self.window_opened + self.every_seconds)
+
+    def poll(self, web3):
+        """Apply the newly confirmed blocks, distribute when due.
+
+        Returns True once caught up with the chain.
+        """
+        safe_height = web3.eth.blockNumber - self.confirmations
+        target = min(safe_height, self.due_height or safe_height)
+        for watcher in self.watchers:
+            if target > watcher.height:
+                watcher.advance(web3, target)
+
+        if self.is_due():
+            self.distribute(web3)
+        elif time.monotonic() - self.checkpointed >= self.checkpoint_interval:
+            self.save_checkpoint()
+        return target >= safe_height
+
+    def distribute(self, web3):
+        end_height = self.height
+        start_height = self.window_start
+        LOGGER.info(f"Distributing {start_height} to {end_height}")
+
+        weight_results = call_groups(
+            web3, [pool['weight_calls'](pool) for pool in self.pools],
+            end_height)
+        closed = [watcher.close_window(end_height + 1)
+                  for watcher in self.watchers]
+        self.window_start = end_height + 1
+        self.window_opened = time.time()
+        # Checkpoint the new window before sending: a crash then loses a
+        # distribution, which can be sent again by hand, instead of paying
+        # it twice on restart.
+        self.save_checkpoint()
+
+        per_block = config['reward_per_block']
+        time_weighted = config.get('pool_weight_mode', 'snapshot') == 'twa'
+        if time_weighted:
+            pool_weights = get_pool_weights(self.pools, [
+                pool['time_weighted_results'](pool, pool_results,
+                                              window[3], watcher.reserve_state)
+                for pool, pool_results, watcher, window
+                in zip(self.pools, weight_results, self.watchers, closed)])
+        else:
+            pool_weights = get_pool_weights(self.pools, weight_results)
+
+        results = list()
+        allocations = list()
+        for pool, (weights, total_weight, reward_start, averages) \
+                in zip(self.pools, closed):
+            rewards = compute_rewards(
+                weights, total_weight,
+                per_block*pool_weights[pool['address']],
+                end_height - reward_start)
+            results.append((rewards, start_height, end_height))
+            allocations.append((weights, reward_start))
+
+        distribution, to_distribute = get_distribution(
+            self.pools, results, pool_weights, per_block, allocations)
+        send_distribution(distribution, to_distribute, self.act, self.post)
+
+    def save_checkpoint(self):
+        state = {
+            'chain_id': config['web3']['chain_id'],
+            'window_start': self.window_start,
+            'window_opened': self.window_opened,
+            'pools': {watcher.pool['address'].lower(): watcher.to_dict()
+                      for watcher in self.watchers}
+        }
+        tmp_path = f"{self.checkpoint_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.checkpoint_path)
+        self.checkpointed = time.monotonic()
+
+    def load_checkpoint(self):
+        if not os.path.exists(self.checkpoint_path):
+            return False
+        with open(self.checkpoint_path) as f:
+            state = json.load(f)
+
+        addresses = [pool['address'].lower() for pool in self.pools]
+        if (state['chain_id'] != config['web3']['chain_id']
+                or sorted(state['pools']) != sorted(addresses)):
+            LOGGER.warning("Checkpoint doesn't match the configured pools, "
+                           "ignoring it")
+            return False
+
+        self.window_start = state['window_start']
+        self.window_opened = state['window_opened']
+        self.watchers = list()
+        for pool in self.pools:
+            watcher = PoolWatcher(pool, self.window_start)
+            watcher.load(state['pools'][pool['address'].lower()])
+            self.watchers.append(watcher)
+        return True
+
+
+def get_checkpoint_path():
+    watch_config = config.get('watch') or dict()
+    path = watch_config.get('checkpoint_path')
+    if path is None:
+        cache_path = Path((config.get('cache') or dict()).get(
+            'path', '.poolmonitor'))
+        os.makedirs(cache_path, exist_ok=True)
+        path = cache_path / f"watch_{config['web3']['chain_id']}.json"
+    return str(path)
+
+
+def watch(start_height=-1, act=False, post=True):
+    """Follow the chain and distribute on schedule, until interrupted."""
+    web3 = get_web3()
+    watcher = Watcher(config['pools'], act, post)
+    watcher.start(web3, start_height)
+
+    try:
+        while True:
+            try:
+                caught_up = watcher.poll(web3)
+            except Exception:
+                LOGGER.exception("Error following the chain")
+                caught_up = True
+            if caught_up:
+                time.sleep(watcher.poll_interval)
+    except KeyboardInterrupt:
+        LOGGER.info("Stopping, saving checkpoint")
+        watcher.save_checkpoint()
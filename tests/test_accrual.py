@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+import random
+
+import pytest
+from poolmonitor.accrual import (RewardAccrual, TimeWeightedAverage,
+                                 compute_rewards, allocate)
+
+__author__ = "Moshe Malawach"
+__copyright__ = "Moshe Malawach"
+__license__ = "mit"
+
+ZERO = "0x0000000000000000000000000000000000000000"
+
+
+def sweep_rewards(events, reward_start, end_height, per_block):
+    """Reference implementation: the historical per-event holder sweep."""
+    weights = dict()
+    balances = dict()
+    last_height = reward_start
+
+    def update_weights(since, current):
+        for addr, value in balances.items():
+            if value > 0:
+                weights[addr] = weights.get(addr, 0) + (value * (current-since))
+
+    for height, src, dst, amount in events:
+        if height > end_height:
+            break
+        if height > reward_start:
+            update_weights(last_height, height)
+        balances[src] = balances.get(src, 0) - amount
+        balances[dst] = balances.get(dst, 0) + amount
+        last_height = height
+
+    update_weights(last_height, end_height)
+    total_weight = sum(weights.values())
+    weights = {a: w / total_weight for a, w in weights.items() if w > 0}
+    total_blocks = end_height - reward_start
+    return {a: w*per_block*total_blocks for a, w in weights.items()}
+
+
+def accrual_rewards(events, reward_start, end_height, per_block):
+    accrual = RewardAccrual(reward_start)
+    for height, src, dst, amount in events:
+        if height > end_height:
+            break
+        accrual.transfer(height, src, dst, amount)
+    weights = accrual.finalize(end_height)
+    return compute_rewards(weights, accrual.total_weight, per_block,
+                           end_height - reward_start)
+
+
+def synthetic_history(seed, holders=30, count=400, start=1000, span=5000):
+    rnd = random.Random(seed)
+    addresses = [f"0x{i:040x}" for i in range(1, holders + 1)]
+    balances = dict()
+    heights = sorted(rnd.randrange(start, start + span) for _ in range(count))
+    events = []
+    for height in heights:
+        holding = [a for a, b in balances.items() if b > 0]
+        if not holding or rnd.random() < 0.3:
+            src, amount = ZERO, rnd.randrange(1, 10**21)
+        else:
+            src = rnd.choice(holding)
+            amount = rnd.randrange(1, balances[src] + 1)
+        dst = ZERO if rnd.random() < 0.1 else rnd.choice(addresses)
+        balances[src] = balances.get(src, 0) - amount
+        balances[dst] = balances.get(dst, 0) + amount
+        events.append((height, src, dst, amount))
+    return events
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_accrual_matches_sweep(seed):
+    events = synthetic_history(seed)
+    rnd = random.Random(seed)
+    reward_start = rnd.randrange(900, 4000)
+    end_height = rnd.randrange(reward_start, 7000)
+    assert (accrual_rewards(events, reward_start, end_height, 1.4)
+            == sweep_rewards(events, reward_start, end_height, 1.4))
+
+
+def test_accrual_total_weight():
+    events = synthetic_history(42)
+    accrual = RewardAccrual(2000)
+    for event in events:
+        accrual.transfer(*event)
+    weights = accrual.finalize(6500)
+    assert accrual.total_weight == sum(weights.values())
+    assert accrual.supply == sum(b for b in accrual.balances.values() if b > 0)
+
+
+def test_accrual_without_events():
+    accrual = RewardAccrual(100)
+    assert accrual.finalize(200) == {}
+    assert compute_rewards({}, accrual.total_weight, 1.4, 100) == {}
+
+
+def test_time_weighted_average():
+    average = TimeWeightedAverage(1500, 10)
+    average.update(1000, 100)
+    average.update(2000, 300)
+    average.update(2000, 200)
+    assert average.average(3000) == (100*500 + 200*1000) / 1500
+    assert TimeWeightedAverage(10, 7).average(10) == 7
+
+
+def test_accrual_state_roundtrip():
+    events = synthetic_history(7)
+    accrual = RewardAccrual(3000)
+    for event in events[:200]:
+        accrual.transfer(*event)
+    resumed = RewardAccrual.from_dict(accrual.to_dict())
+    for event in events[200:]:
+        accrual.transfer(*event)
+        resumed.transfer(*event)
+    assert resumed.finalize(6500) == accrual.finalize(6500)
+    assert resumed.total_weight == accrual.total_weight
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_allocate_matches_rewards(seed):
+    events = synthetic_history(seed)
+    accrual = RewardAccrual(2000)
+    for event in events:
+        accrual.transfer(*event)
+    weights = accrual.finalize(6500)
+    total = 14 * 10**17 * 4500
+    amounts = allocate(weights, total)
+    assert sum(amounts.values()) == total
+    rewards = compute_rewards(weights, accrual.total_weight, 1.4, 4500)
+    for addr, amount in amounts.items():
+        assert abs(amount - rewards[addr] * 10**18) <= 1 + total * 1e-15
+
+
+def test_allocate_remainders():
+    assert allocate({'a': 1, 'b': 1, 'c': 1}, 10) == {'a': 4, 'b': 3, 'c': 3}
+    assert allocate({'a': 1, 'b': 2, 'c': 3}, 7) == {'a': 1, 'b': 2, 'c': 4}
+    assert allocate({'a': 0, 'b': 5}, 3) == {'a': 0, 'b': 3}
+    assert allocate({}, 10) == {}
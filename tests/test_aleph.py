@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+from poolmonitor import aleph
+from poolmonitor.aleph import get_latest_successful_distribution
+from poolmonitor.settings import config
+
+__author__ = "Moshe Malawach"
+__copyright__ = "Moshe Malawach"
+__license__ = "mit"
+
+
+def make_post(item_hash, end=None, success=True):
+    content = {'status': 'distribution', 'targets': [{'success': success}],
+               'pools': [] if end is None else [{'end': end - 1}, {'end': end}]}
+    return {'item_hash': item_hash, 'content': content}
+
+
+class FakePosts:
+    """Posts of the aleph API, newest first, recording the pages read."""
+
+    def __init__(self, posts):
+        self.posts = posts
+        self.pages = list()
+
+    def __call__(self, pagination, page, **query):
+        self.pages.append(page)
+        return {'posts': self.posts[(page - 1) * pagination:page * pagination]}
+
+
+@pytest.fixture
+def posts(monkeypatch, tmp_path):
+    monkeypatch.setitem(config, 'aleph', {'api_server': 'https://aleph',
+                                          'page_size': 2})
+    monkeypatch.setitem(config, 'web3', {'chain_id': 1})
+    monkeypatch.setitem(config, 'cache', {'enabled': True,
+                                          'path': str(tmp_path)})
+    monkeypatch.setattr(aleph, 'get_aleph_address', lambda: '0xsender')
+    fake = FakePosts([])
+    monkeypatch.setattr(aleph, 'get_posts', fake)
+    return fake
+
+
+def test_latest_across_pages(posts):
+    posts.posts = [make_post('failed', 400, success=False),
+                   make_post('calculation', 350),
+                   make_post('last', 300),
+                   make_post('previous', 200),
+                   make_post('older', 100)]
+    posts.posts[1]['content']['status'] = 'calculation'
+    assert get_latest_successful_distribution() == (
+        300, posts.posts[2]['content'])
+    # Stopped at the first successful one.
+    assert posts.pages == [1, 2]
+
+
+def test_latest_none(posts):
+    posts.posts = [make_post('failed', 400, success=False)] * 4
+    assert get_latest_successful_distribution() == (0, None)
+    # Read up to the short page.
+    assert posts.pages == [1, 2, 3]
+
+
+def test_latest_cached(posts):
+    posts.posts = [make_post('last', 300), make_post('previous', 200)]
+    assert get_latest_successful_distribution()[0] == 300
+
+    # Found by its hash, the cached content is used and no further page
+    # is read.
+    posts.posts = [make_post('failed', 400, success=False),
+                   make_post('failed', 400, success=False),
+                   {'item_hash': 'last', 'content': {}},
+                   make_post('previous', 200)]
+    posts.pages.clear()
+    end_height, content = get_latest_successful_distribution()
+    assert (end_height, content['pools'][-1]['end']) == (300, 300)
+    assert posts.pages == [1, 2]
+
+    # A newer successful distribution replaces it.
+    posts.posts.insert(0, make_post('new', 500))
+    assert get_latest_successful_distribution()[0] == 500
+    posts.posts = [{'item_hash': 'new', 'content': {}}]
+    assert get_latest_successful_distribution()[0] == 500
+
+
+def test_latest_without_cache(posts, monkeypatch, tmp_path):
+    monkeypatch.setitem(config, 'cache', {'enabled': False})
+    posts.posts = [make_post('last', 300)]
+    assert get_latest_successful_distribution()[0] == 300
+    assert not list(tmp_path.iterdir())
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+from web3 import Web3
+from poolmonitor import api, aleph
+from poolmonitor.settings import config
+
+__author__ = "Moshe Malawach"
+__copyright__ = "Moshe Malawach"
+__license__ = "mit"
+
+ZERO = "0x0000000000000000000000000000000000000000"
+HOLDER = Web3.toChecksumAddress("0x" + "ab" * 20)
+POOLS = [{'address': "0x" + "11" * 20, 'start_height': 0},
+         {'address': "0x" + "22" * 20, 'start_height': 0}]
+
+
+class FakeEth:
+    blockNumber = 1012
+
+
+class FakeWeb3:
+    eth = FakeEth()
+
+
+@pytest.fixture
+def stubbed(monkeypatch, tmp_path):
+    monkeypatch.setitem(config, 'reward_start', 0)
+    monkeypatch.setitem(config, 'reward_per_block', 2)
+    monkeypatch.setitem(config, 'web3', {'chain_id': 1})
+    monkeypatch.setitem(config, 'aleph', {'api_server': 'https://aleph'})
+    monkeypatch.setitem(config, 'cache', {'enabled': False})
+    monkeypatch.setitem(config, 'api', {'confirmations': 12,
+                                        'refresh_interval': 3600})
+
+    async def get_posts(**query):
+        return {'posts': [{'item_hash': 'last', 'content': {
+            'status': 'distribution', 'targets': [{'success': True}],
+            'pools': [{'end': 499}]}}]}
+
+    # Only the asynchronous aleph client is usable from the server.
+    def no_sync_posts(**query):
+        raise AssertionError("synchronous get_posts called")
+
+    monkeypatch.setattr(aleph, 'async_get_posts', get_posts)
+    monkeypatch.setattr(aleph, 'get_posts', no_sync_posts)
+    monkeypatch.setattr(aleph, 'get_aleph_address', lambda: '0xsender')
+    monkeypatch.setattr(api, 'get_web3', lambda: FakeWeb3())
+    monkeypatch.setattr(api, 'fetch_new_transfers',
+                        lambda web3, pool, after, end:
+                        [(100, 0, None, ZERO, HOLDER, 10)])
+    monkeypatch.setattr(api, 'call_groups',
+                        lambda web3, groups, height: [[1], [3]])
+    pools = [dict(pool, weight_calls=lambda pool: [],
+                  weight_from_calls=lambda pool, results: results[0])
+             for pool in POOLS]
+    return pools
+
+
+def test_serve_start(stubbed):
+    async def run():
+        app = api.get_app(stubbed)
+        # Runs the startup hooks, start_refresh among them.
+        async with TestClient(TestServer(app)) as client:
+            state = app['state']
+            assert state.height == 1000
+            assert state.start_height == 500
+
+            resp = await client.get('/pools')
+            pools = await resp.json()
+            assert pools['start'] == 500
+            assert [pool['weight'] for pool in pools['pools']] == [0.25, 0.75]
+
+            resp = await client.get(f'/pending/{HOLDER.lower()}')
+            pending = await resp.json()
+            assert pending['start'] == 500 and pending['end'] == 1000
+            # Sole holder of both pools over 500 blocks.
+            assert pending['pools'] == {POOLS[0]['address']: 250,
+                                        POOLS[1]['address']: 750}
+            assert pending['total'] == 1000
+
+    asyncio.run(run())
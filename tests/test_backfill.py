@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+import json
+from types import SimpleNamespace
+
+from poolmonitor import backfill
+from poolmonitor.settings import config
+
+__author__ = "Moshe Malawach"
+__copyright__ = "Moshe Malawach"
+__license__ = "mit"
+
+
+def make_post(windows, success=True):
+    return {'content': {
+        'status': 'distribution', 'targets': [{'success': success}],
+        'pools': [{'start': start, 'end': end} for start, end in windows]}}
+
+
+def test_backfill_from_posts(monkeypatch, tmp_path):
+    # Newest first: a re-run overlapping the previous windows, a repeated
+    # window and a failed distribution.
+    posts = [make_post([(150, 300)]),
+             make_post([(201, 300), (201, 300)]),
+             make_post([(101, 200)]),
+             make_post([(0, 100)]),
+             make_post([(50, 120)], success=False)]
+    monkeypatch.setattr(backfill, 'iter_distribution_posts',
+                        lambda: iter(posts))
+    replayed = list()
+
+    def fake_backfill(epochs, pools):
+        # replay_epochs refuses windows that aren't consecutive.
+        for (start, end), (next_start, next_end) in zip(epochs, epochs[1:]):
+            assert next_start > end
+        replayed.append(epochs)
+        return [{'window': list(epoch)} for epoch in epochs]
+
+    monkeypatch.setattr(backfill, 'backfill', fake_backfill)
+    monkeypatch.setitem(config, 'pools', [])
+    output = tmp_path / 'backfill.json'
+    backfill.run_backfill(SimpleNamespace(from_posts=True,
+                                          output=str(output)))
+
+    assert replayed == [[(0, 100), (101, 200), (201, 300)], [(150, 300)]]
+    with open(output) as f:
+        assert [d['window'] for d in json.load(f)] == [
+            [0, 100], [101, 200], [150, 300], [201, 300]]
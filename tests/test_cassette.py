@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+from web3.providers.base import BaseProvider
+from poolmonitor import aleph
+from poolmonitor.aleph import get_latest_successful_distribution
+from poolmonitor.cassette import Cassette, CassetteMiss, CassetteProvider
+from poolmonitor.commands import main
+from poolmonitor.settings import config
+from poolmonitor.verify import verify
+
+__author__ = "Moshe Malawach"
+__copyright__ = "Moshe Malawach"
+__license__ = "mit"
+
+
+class FakeProvider(BaseProvider):
+    def __init__(self):
+        self.calls = 0
+
+    def make_request(self, method, params):
+        self.calls += 1
+        if method == 'eth_getLogs':
+            return {'jsonrpc': '2.0', 'id': self.calls,
+                    'error': {'code': -32005, 'message': 'too many'}}
+        return {'jsonrpc': '2.0', 'id': self.calls, 'result': hex(self.calls)}
+
+
+def test_record_replay(tmp_path):
+    path = str(tmp_path / 'cassette.json.gz')
+    node = FakeProvider()
+    provider = CassetteProvider(Cassette(path, 'record'), node)
+    assert provider.make_request('eth_blockNumber', [])['result'] == '0x1'
+    error = provider.make_request('eth_getLogs', [{'fromBlock': '0x1'}])
+    assert error['error']['code'] == -32005
+    provider.cassette.save()
+
+    replay = CassetteProvider(Cassette(path, 'replay'))
+    assert replay.is_connected()
+    assert replay.make_request('eth_blockNumber', [])['result'] == '0x1'
+    assert replay.make_request(
+        'eth_getLogs', [{'fromBlock': '0x1'}])['error']['code'] == -32005
+    with pytest.raises(CassetteMiss):
+        replay.make_request('eth_getLogs', [{'fromBlock': '0x2'}])
+    assert node.calls == 2
+
+
+def test_missing_cassette(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        Cassette(str(tmp_path / 'missing.json.gz'), 'replay')
+
+
+def test_aleph_lookups(tmp_path, monkeypatch):
+    path = str(tmp_path / 'cassette.json.gz')
+    monkeypatch.setitem(config, 'aleph', {'api_server': 'https://aleph',
+                                          'page_size': 2})
+    monkeypatch.setitem(config, 'web3', {'chain_id': 1})
+    monkeypatch.setitem(config, 'cache', {'enabled': False})
+    monkeypatch.setattr(aleph, 'get_aleph_address', lambda: '0xsender')
+    latest = {'item_hash': 'last', 'content': {
+        'status': 'distribution', 'targets': [{'success': True}],
+        'pools': [{'end': 300}]}}
+    monkeypatch.setattr(aleph, 'get_posts',
+                        lambda **query: {'posts': [latest]})
+    monkeypatch.setattr(aleph, 'fetch_stored_file', lambda file_hash: b'\x00')
+
+    cassette = Cassette(path, 'record')
+    monkeypatch.setattr(aleph, 'get_cassette', lambda: cassette)
+    assert get_latest_successful_distribution()[0] == 300
+    assert aleph.get_stored_file.__wrapped__('maps') == b'\x00'
+    cassette.save()
+
+    def offline(*args, **kwargs):
+        raise AssertionError("aleph queried while replaying")
+
+    monkeypatch.setattr(aleph, 'get_posts', offline)
+    monkeypatch.setattr(aleph, 'fetch_stored_file', offline)
+    cassette = Cassette(path, 'replay')
+    assert get_latest_successful_distribution() == (300, latest['content'])
+    assert aleph.get_stored_file.__wrapped__('maps') == b'\x00'
+    with pytest.raises(CassetteMiss):
+        aleph.get_stored_file.__wrapped__('other')
+
+
+def test_replay_refuses_writes(tmp_path):
+    saved = dict(config)
+    try:
+        for args, error in ((['--act', '--no-post'], "transactions"),
+                            ([], "post"), (['watch'], "post")):
+            with pytest.raises(ValueError, match=error):
+                main(['--replay', str(tmp_path / 'cassette.json.gz')] + args)
+    finally:
+        config.clear()
+        config.update(saved)
+
+
+
+def test_verify_record_requires_cache(monkeypatch):
+    monkeypatch.setitem(config, 'cache', {'enabled': False})
+    monkeypatch.setitem(config, 'cassette', {'mode': 'record', 'path': None})
+    with pytest.raises(ValueError, match="cache"):
+        verify([], [])
+
+
+def test_record_or_replay():
+    with pytest.raises(SystemExit):
+        main(['--record', 'a.json.gz', '--replay', 'b.json.gz'])
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+import pytest
+from poolmonitor.settings import config
+from poolmonitor.commands import main, process_pools, send_distribution
+
+__author__ = "Moshe Malawach"
+__copyright__ = "Moshe Malawach"
+__license__ = "mit"
+
+
+def make_pool(address, delay):
+    def process(pool, per_block, start_height, end_height):
+        # The first pools finish last.
+        time.sleep(delay)
+        return {address: per_block}, start_height, end_height
+    return {'address': address, 'history_processor': process}
+
+
+def test_process_pools_order():
+    pools = [make_pool(f"0x{i}", 0.05 * (4 - i)) for i in range(4)]
+    weights = {pool['address']: 0.25 for pool in pools}
+    results = process_pools(pools, 4, weights, 10, 20)
+    assert results == [({pool['address']: 1}, 10, 20) for pool in pools]
+
+
+def test_process_pools_unweighted():
+    pools = [make_pool("0xa", 0), make_pool("0xb", 0)]
+    assert process_pools(pools, 4, None, 10, 20) == [
+        ({"0xa": 4}, 10, 20), ({"0xb": 4}, 10, 20)]
+
+
+@pytest.mark.parametrize('mode', ['transfer', 'merkle'])
+def test_send_unposted_refused(monkeypatch, mode):
+    monkeypatch.setitem(config, 'distribution_mode', mode)
+    # The next window would start after the last posted one, paying this
+    # one again.
+    with pytest.raises(ValueError, match="posted"):
+        send_distribution({}, {"0xa": 1}, act=True, post=False)
+
+
+def test_main_unposted_refused():
+    saved = dict(config)
+    try:
+        with pytest.raises(ValueError, match="--no-post"):
+            main(['--act', '--no-post'])
+    finally:
+        config.clear()
+        config.update(saved)
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+from web3 import Web3
+from web3._utils.method_formatters import log_entry_formatter
+
+from poolmonitor.balancer import get_contract_abi
+from poolmonitor.decoder import (TRANSFER_TOPIC, decode_transfers,
+                                 decode_transfer_event)
+
+__author__ = "Moshe Malawach"
+__copyright__ = "Moshe Malawach"
+__license__ = "mit"
+
+ABI = [item for item in get_contract_abi() if item.get('name') == 'Transfer'][0]
+
+
+def make_log(i, src, dst, amount):
+    return log_entry_formatter({
+        'address': '0x4C34a687906092ec11CC04DDF30b71e29747Ed76',
+        'blockNumber': hex(100 + i),
+        'blockHash': '0x%064x' % (100 + i),
+        'transactionHash': '0x%064x' % i,
+        'transactionIndex': '0x0',
+        'logIndex': hex(i),
+        'removed': False,
+        'topics': ['0x' + TRANSFER_TOPIC.hex(),
+                   '0x%064x' % src, '0x%064x' % dst],
+        'data': '0x%064x' % amount,
+    })
+
+
+def test_fast_path_matches_get_event_data():
+    codec = Web3().codec
+    logs = [make_log(0, 0, 0xabcdef, 10**24),
+            make_log(1, 0xabcdef, 0x1234 << 140, 1),
+            make_log(2, 0x1234 << 140, 0, 0)]
+    assert decode_transfers(codec, ABI, logs) == [
+        decode_transfer_event(codec, ABI, log) for log in logs]
+    assert decode_transfers(codec, ABI, logs)[0][3:] == (
+        '0x0000000000000000000000000000000000000000',
+        '0x0000000000000000000000000000000000abcDeF', 10**24)
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+import pytest
+from poolmonitor import metrics
+from poolmonitor.settings import config
+from poolmonitor.ethereum import get_logs
+
+__author__ = "Moshe Malawach"
+__copyright__ = "Moshe Malawach"
+__license__ = "mit"
+
+
+class FakeEth:
+    """Node refusing getLogs queries of more than `max_results` logs."""
+
+    def __init__(self, logs, height, max_results):
+        self.logs = logs
+        self.blockNumber = height
+        self.max_results = max_results
+        self.queries = list()
+        self.lock = threading.Lock()
+
+    def getLogs(self, query):
+        start, end = query['fromBlock'], query['toBlock']
+        with self.lock:
+            self.queries.append((start, end))
+        # Later windows answer first.
+        time.sleep(0.001 * (self.blockNumber - start) / self.blockNumber)
+        logs = [log for log in self.logs if start <= log['blockNumber'] <= end]
+        if len(logs) > self.max_results:
+            raise ValueError({'code': -32005,
+                              'message': 'query returned more than '
+                                         f'{self.max_results} results'})
+        # Unordered within the response.
+        return logs[::-1]
+
+
+class FakeWeb3:
+    def __init__(self, eth):
+        self.eth = eth
+
+
+def make_logs(heights):
+    return [{'blockNumber': height, 'logIndex': i}
+            for height in heights for i in range(3)]
+
+
+@pytest.fixture
+def web3_config(monkeypatch):
+    monkeypatch.setitem(config, 'web3', {
+        'mode': 'rpc', 'big_block_range': 1000, 'log_concurrency': 4,
+        'log_target_count': 20, 'max_block_range': 4000})
+
+
+def test_get_logs_split(web3_config):
+    # Crowded around 500, sparse elsewhere.
+    logs = make_logs(sorted(set(range(480, 520)) | set(range(0, 10000, 97))))
+    eth = FakeEth(logs, 10000, 30)
+    fetched = list(get_logs(FakeWeb3(eth), 'pool', -1))
+    assert fetched == logs
+    # Refused ranges were split down to accepted ones.
+    assert any(end - start < 999 for start, end in eth.queries)
+    # Sparse windows grow.
+    assert any(end - start > 999 for start, end in eth.queries)
+
+
+def test_get_logs_counted(web3_config):
+    logs = make_logs(range(0, 3000, 10))
+    metrics.enable()
+    try:
+        # Counted as fetched, even if the consumer drops them.
+        assert len(list(get_logs(FakeWeb3(FakeEth(logs, 3000, 100)),
+                                 'pool', -1))) == 900
+        assert metrics.get_counters('logs_fetched') == {
+            (('mode', 'rpc'),): 900}
+    finally:
+        metrics.metrics.enabled = False
+        metrics.metrics.reset()
+
+
+def test_get_logs_range(web3_config):
+    logs = make_logs(range(0, 3000, 10))
+    eth = FakeEth(logs, 5000, 1000)
+    fetched = list(get_logs(FakeWeb3(eth), 'pool', 100, end_height=2000))
+    assert fetched == [log for log in logs
+                       if 100 < log['blockNumber'] <= 2000]
+
+
+def test_get_logs_single_block_too_large(web3_config):
+    eth = FakeEth(make_logs([50] * 20), 100, 10)
+    with pytest.raises(ValueError) as error:
+        list(get_logs(FakeWeb3(eth), 'pool', -1))
+    assert error.value.args[0]['code'] == -32005
+    assert (50, 50) in eth.queries
+
+
+def test_get_logs_other_errors(web3_config):
+    class BrokenEth(FakeEth):
+        def getLogs(self, query):
+            raise ValueError({'code': -32601, 'message': 'method not found'})
+
+    with pytest.raises(ValueError):
+        list(get_logs(FakeWeb3(BrokenEth([], 100, 10)), 'pool', -1))
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+import pytest
+import requests
+from poolmonitor import explorer
+from poolmonitor.explorer import ExplorerClient, ExplorerError, TokenBucket
+
+__author__ = "Moshe Malawach"
+__copyright__ = "Moshe Malawach"
+__license__ = "mit"
+
+ADDRESS = "0x" + "11" * 20
+TOPIC = "0x" + "22" * 32
+RATE_LIMITED = {'status': '0', 'message': 'NOTOK',
+                'result': 'Max rate limit reached'}
+
+
+class FakeResponse:
+    def __init__(self, content, status_code=200):
+        self.content_dict = content
+        self.content = b'x' * 100
+        self.status_code = status_code
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} error")
+
+    def json(self):
+        return self.content_dict
+
+
+class FakeSession:
+    """Explorer cutting its logs responses at `max_results`, answering
+    `failures` with rate limiting first."""
+
+    def __init__(self, heights, max_results, failures=()):
+        self.logs = [{'address': ADDRESS, 'topics': [TOPIC], 'data': '0x',
+                      'blockNumber': hex(height),
+                      'logIndex': hex(i) if i else '0x',
+                      'transactionHash': '0x%064x' % (height * 100 + i),
+                      'transactionIndex': '0x'}
+                     for i, height in enumerate(heights)]
+        self.max_results = max_results
+        self.failures = list(failures)
+        self.requests = list()
+
+    def get(self, path, params, timeout):
+        self.requests.append(params)
+        if self.failures:
+            return self.failures.pop(0)
+        logs = [dict(log) for log in self.logs
+                if params['fromBlock'] <= int(log['blockNumber'], 16)
+                <= params['toBlock']]
+        page = params.get('page', 1)
+        logs = logs[(page - 1) * self.max_results:page * self.max_results]
+        if not logs:
+            return FakeResponse({'status': '0', 'message': 'No records found',
+                                 'result': []})
+        return FakeResponse({'status': '1', 'message': 'OK', 'result': logs})
+
+
+@pytest.fixture(autouse=True)
+def no_cassette(monkeypatch):
+    monkeypatch.setattr(explorer, 'get_cassette', lambda: None)
+
+
+def make_client(session, max_results=5, retries=3):
+    client = ExplorerClient('https://explorer/api', 'key', rate_limit=1000,
+                            max_results=max_results, retries=retries,
+                            backoff=0)
+    client.local.session = session
+    return client
+
+
+def test_paging():
+    # Responses cut in the middle of blocks, and a block of 12 logs.
+    heights = [1, 2, 2, 3, 3, 3, 4, 5, 5] + [6] * 12 + [7, 8]
+    session = FakeSession(heights, 5)
+    client = make_client(session)
+    logs = list(client.get_logs(ADDRESS, 0, 10, [TOPIC]))
+    assert [log['blockNumber'] for log in logs] == heights
+    assert len({log['transactionHash'] for log in logs}) == len(heights)
+    # The crowded block was read page by page.
+    assert [r['page'] for r in session.requests if 'page' in r] == [1, 2, 3]
+
+
+def test_retry_rate_limited():
+    session = FakeSession([1, 2], 5,
+                          [FakeResponse(RATE_LIMITED), FakeResponse({}, 502)])
+    client = make_client(session)
+    logs = list(client.get_logs(ADDRESS, 0, 10, [TOPIC]))
+    assert len(logs) == 2
+    assert len(session.requests) == 3
+    assert session.requests[0]['apikey'] == 'key'
+
+
+def test_retries_exhausted():
+    session = FakeSession([1], 5, [FakeResponse(RATE_LIMITED)] * 3)
+    with pytest.raises(ExplorerError):
+        list(make_client(session, retries=2).get_logs(ADDRESS, 0, 10,
+                                                      [TOPIC]))
+    assert len(session.requests) == 3
+
+
+def test_token_bucket():
+    bucket = TokenBucket(100, capacity=5)
+    started = time.monotonic()
+    for _ in range(5):
+        bucket.acquire()
+    # The burst goes through at once.
+    assert time.monotonic() - started < 0.05
+    for _ in range(10):
+        bucket.acquire()
+    assert time.monotonic() - started >= 0.09
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+from eth_abi import encode_abi
+from eth_utils import event_abi_to_log_topic
+from web3 import Web3
+from web3._utils.method_formatters import log_entry_formatter
+
+from poolmonitor import balancer, history, metrics, uniswap
+from poolmonitor.settings import config
+from poolmonitor.accrual import TimeWeightedAverage
+from poolmonitor.storage import TransferStore
+from poolmonitor.history import (_decode_pool_logs, average_reserves,
+                                 decode_pool_logs, get_sync_height,
+                                 prefetch_transfers, track_reserves)
+
+__author__ = "Moshe Malawach"
+__copyright__ = "Moshe Malawach"
+__license__ = "mit"
+
+TOKEN = "0x27702a26126e0B3702af63Ee09aC4d1A084EF628"
+OTHER = "0x6B175474E89094C44Da98b954EedeAC495271d0F"
+CALLER = "0x00000000000000000000000000000000000000A1"
+POOL = "0x4C34a687906092ec11CC04DDF30b71e29747Ed76"
+SECOND_POOL = "0xA478c2975Ab1Ea89e8196811F51A7B7Ade33eB11"
+UNKNOWN_POOL = "0x0d4a11d5EEaaC28EC3F61d100daF4d40471f1852"
+
+
+@pytest.fixture
+def twa_config(monkeypatch):
+    monkeypatch.setitem(config, 'pool_weight_mode', 'twa')
+    monkeypatch.setitem(config, 'token', {'address': TOKEN})
+
+
+def make_pool(module, address=POOL):
+    web3 = Web3()
+    return {'address': address,
+            'contract': web3.eth.contract(address,
+                                          abi=module.get_contract_abi()),
+            'reserve_events': module.get_reserve_events,
+            'reserve_change': module.get_reserve_change}
+
+
+def make_log(pool, event, height, log_index, **args):
+    """Raw log of `event`, as returned by the node."""
+    abi = getattr(pool['contract'].events, event)._get_event_abi()
+    indexed = [i for i in abi['inputs'] if i['indexed']]
+    data = [i for i in abi['inputs'] if not i['indexed']]
+    topics = [event_abi_to_log_topic(abi)] + [
+        encode_abi([i['type']], [args[i['name']]]) for i in indexed]
+    return log_entry_formatter({
+        'address': pool['address'],
+        'blockNumber': hex(height),
+        'blockHash': '0x%064x' % height,
+        'transactionHash': '0x%064x' % log_index,
+        'transactionIndex': '0x0',
+        'logIndex': hex(log_index),
+        'removed': False,
+        'topics': ['0x' + topic.hex() for topic in topics],
+        'data': '0x' + encode_abi([i['type'] for i in data],
+                                  [args[i['name']] for i in data]).hex(),
+    })
+
+
+def test_decode_uniswap_sync(twa_config):
+    pool = make_pool(uniswap)
+    logs = [make_log(pool, 'Transfer', 10, 0, **{'from': CALLER, 'to': POOL,
+                                                 'value': 5}),
+            make_log(pool, 'Sync', 10, 1, reserve0=100, reserve1=200),
+            make_log(pool, 'Sync', 12, 0, reserve0=90, reserve1=230)]
+    reserves = list()
+    transfers = _decode_pool_logs(Web3(), pool, logs, reserves)
+    assert transfers == [(10, 0, '0x%064x' % 10, CALLER, POOL, 5)]
+    assert reserves == [(10, 1, '0x%064x' % 10, True, 100, 200),
+                        (12, 0, '0x%064x' % 12, True, 90, 230)]
+
+
+def test_decode_balancer_events(twa_config):
+    pool = make_pool(balancer)
+    logs = [make_log(pool, 'LOG_JOIN', 10, 0, caller=CALLER, tokenIn=TOKEN,
+                     tokenAmountIn=100),
+            # Other tokens don't change the tracked reserve.
+            make_log(pool, 'LOG_JOIN', 10, 1, caller=CALLER, tokenIn=OTHER,
+                     tokenAmountIn=50),
+            make_log(pool, 'LOG_EXIT', 11, 0, caller=CALLER, tokenOut=TOKEN,
+                     tokenAmountOut=30),
+            make_log(pool, 'LOG_SWAP', 12, 0, caller=CALLER, tokenIn=OTHER,
+                     tokenOut=TOKEN, tokenAmountIn=7, tokenAmountOut=20),
+            make_log(pool, 'LOG_SWAP', 13, 0, caller=CALLER, tokenIn=TOKEN,
+                     tokenOut=OTHER, tokenAmountIn=15, tokenAmountOut=3)]
+    reserves = list()
+    assert _decode_pool_logs(Web3(), pool, logs, reserves) == []
+    assert [r[:2] + r[3:] for r in reserves] == [
+        (10, 0, False, 100, 0), (11, 0, False, -30, 0),
+        (12, 0, False, -20, 0), (13, 0, False, 15, 0)]
+
+
+def test_decode_counted(twa_config):
+    pool = make_pool(balancer)
+    logs = [make_log(pool, 'Transfer', 9, 0, src=CALLER, dst=POOL, amt=5),
+            make_log(pool, 'LOG_JOIN', 10, 0, caller=CALLER, tokenIn=TOKEN,
+                     tokenAmountIn=100),
+            make_log(pool, 'LOG_JOIN', 10, 1, caller=CALLER, tokenIn=OTHER,
+                     tokenAmountIn=50)]
+    reserves = [(1, 0, None, True, 1, 0)]
+    metrics.enable()
+    try:
+        decode_pool_logs(Web3(), pool, logs, reserves)
+        # The transfer and the tracked reserve change, not the logs.
+        assert metrics.get_counters('events_decoded') == {
+            (('pool', POOL),): 2}
+    finally:
+        metrics.metrics.enabled = False
+        metrics.metrics.reset()
+
+
+def test_decode_snapshot_mode(monkeypatch):
+    monkeypatch.setitem(config, 'pool_weight_mode', 'snapshot')
+    pool = make_pool(uniswap)
+    logs = [make_log(pool, 'Transfer', 10, 0, **{'from': CALLER, 'to': POOL,
+                                                 'value': 5})]
+    assert len(_decode_pool_logs(Web3(), pool, logs, None)) == 1
+
+
+def test_track_reserves():
+    reserves = [(110, 0, None, False, 50, 0),
+                (120, 0, None, True, 400, 20),
+                (130, 0, None, False, -100, 5),
+                (150, 0, None, True, 1, 1)]
+    averages = [TimeWeightedAverage(100, 100), TimeWeightedAverage(100, 10)]
+    state = track_reserves(averages, (100, 10), reserves, 140)
+    assert state == (300, 25)
+    assert averages[0].average(140) == (
+        100*10 + 150*10 + 400*10 + 300*10) / 40
+    assert averages[1].average(140) == (10*10 + 10*10 + 20*10 + 25*10) / 40
+
+
+def test_average_reserves():
+    reserves = [(90, 0, None, True, 1000, 0),
+                (110, 0, None, False, 100, 0),
+                (200, 0, None, False, 100, 0)]
+    # Changes before the window move the starting state, not the average.
+    averages, state = average_reserves((0, 0), reserves, 100, 150)
+    assert state == (1100, 0)
+    assert averages == [(1000*10 + 1100*40) / 50, 0]
+
+
+def test_uniswap_time_weighted_results():
+    results = [(10, 20, 1234), TOKEN, OTHER]
+    assert uniswap.get_time_weighted_results(None, results, [4.5, 9.5],
+                                             (3, 8)) == [
+        (4.5, 9.5, 1234), TOKEN, OTHER]
+
+
+def test_balancer_time_weighted_results():
+    # The tracked reserve is relative, anchored on the reserve read at the
+    # end of the window.
+    results = [2 * 10**17, 1000]
+    assert balancer.get_time_weighted_results(None, results, [-50.5, 0],
+                                              (-20, 0)) == [
+        2 * 10**17, 1000 - 50.5 + 20]
+
+
+def test_sync_height_after_snapshot_mode(twa_config, monkeypatch, tmp_path):
+    monkeypatch.setitem(config, 'cache', {'confirmations': 0})
+    pool = dict(make_pool(uniswap), start_height=5)
+    store = TransferStore(str(tmp_path / "pool.sqlite3"))
+    store.add_transfers([], 100, [(50, 0, None, True, 1, 2)])
+    assert get_sync_height(store, None, pool, 200) == 100
+    # Synced up to 150 in snapshot mode, the reserves miss 100-150.
+    store.add_transfers([], 150)
+    assert get_sync_height(store, None, pool, 200) == 5
+    assert list(store.iter_reserves()) == []
+
+
+def test_prefetch_transfers(monkeypatch):
+    monkeypatch.setitem(config, 'pool_weight_mode', 'snapshot')
+    monkeypatch.setitem(config, 'cache', {'enabled': False})
+    pools = [dict(make_pool(uniswap), start_height=100),
+             dict(make_pool(uniswap, SECOND_POOL), start_height=200)]
+    unknown = make_pool(uniswap, UNKNOWN_POOL)
+
+    def transfer(pool, height, value, lower=False):
+        log = make_log(pool, 'Transfer', height, 0,
+                       **{'from': CALLER, 'to': POOL, 'value': value})
+        if lower:
+            log = dict(log, address=log['address'].lower())
+        return log
+
+    logs = [transfer(pools[0], 150, 1),
+            # Before the start of the second pool.
+            transfer(pools[1], 150, 2),
+            transfer(unknown, 160, 3),
+            transfer(pools[1], 250, 4, lower=True),
+            transfer(pools[0], 300, 5, lower=True),
+            # After the end of the window.
+            transfer(pools[0], 301, 6)]
+    queries = list()
+
+    def get_logs(web3, addresses, start_height, topics=None,
+                 end_height='latest'):
+        queries.append((addresses, start_height, end_height))
+        return iter(logs)
+
+    monkeypatch.setattr(history, 'get_logs', get_logs)
+    prefetch_transfers(Web3(), pools, 300)
+    # A single scan from the earliest start.
+    assert queries == [([POOL, SECOND_POOL], 100, 300)]
+    assert [t[0] for t in pools[0]['transfers']] == [150, 300]
+    assert [t[-1] for t in pools[0]['transfers']] == [1, 5]
+    assert [t[-1] for t in pools[1]['transfers']] == [4]
+    assert pools[0]['reserves'] is None
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+import random
+
+import pytest
+from poolmonitor.settings import config
+from poolmonitor.index import BalanceIndex, RewardIndex
+
+from test_accrual import synthetic_history, accrual_rewards
+
+__author__ = "Moshe Malawach"
+__copyright__ = "Moshe Malawach"
+__license__ = "mit"
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_index_matches_accrual(seed, monkeypatch):
+    monkeypatch.setitem(config, 'reward_start', 0)
+    events = synthetic_history(seed)
+    index = RewardIndex({'start_height': 900})
+    index.add_transfers([(h, 0, None, s, d, a) for h, s, d, a in events], 7000)
+
+    rnd = random.Random(seed)
+    for _ in range(10):
+        start = rnd.randrange(900, 6000)
+        end = rnd.randrange(start, 7000)
+        expected = accrual_rewards(events, start, end, 1.4)
+        pending = {a: index.pending(a, start, end, 1.4)
+                   for a in index.timelines}
+        assert {a: r for a, r in pending.items() if r} == expected
+
+
+def test_balance_index_lookups():
+    events = synthetic_history(3)
+    index = BalanceIndex({'start_height': 900})
+    index.add_transfers([(h, 0, None, s, d, a) for h, s, d, a in events], 7000)
+
+    for height in (999, 1500, 3333, 6000):
+        balances = dict()
+        for h, src, dst, amount in events:
+            if h > height:
+                break
+            balances[src] = balances.get(src, 0) - amount
+            balances[dst] = balances.get(dst, 0) + amount
+        for address, balance in balances.items():
+            assert index.balance_at(address, height) == balance
+        holders = index.holders_at(height)
+        assert holders == {a: b for a, b in balances.items() if b > 0}
+        assert list(index.holders_at(height, top=3).values()) == \
+            sorted(holders.values(), reverse=True)[:3]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+
+from poolmonitor.maps import split_distribution, join_distribution
+
+__author__ = "Moshe Malawach"
+__copyright__ = "Moshe Malawach"
+__license__ = "mit"
+
+
+def test_distribution_maps_roundtrip():
+    rewards = {f"0x{i:040x}": i * 0.37 for i in range(1, 200)}
+    distribution = {
+        'incentive': 'liquidity',
+        'status': 'distribution',
+        'pools': [{'address': '0xpool', 'start': 10, 'end': 20,
+                   'per_block': 1.4, 'distribution': rewards}],
+        'targets': [{'success': True, 'tx': '0x01', 'total': 1.5,
+                     'targets': dict(list(rewards.items())[:100])},
+                    {'success': False, 'tx': None, 'total': 2.5,
+                     'targets': dict(list(rewards.items())[100:])}],
+        'merkle': {'root': '0x00', 'leaves': 1,
+                   'claims': {'0x01': {'index': 0, 'amount': '1',
+                                       'proof': []}}}
+    }
+    summary, data = split_distribution(distribution)
+    assert 'distribution' not in summary['pools'][0]
+    assert summary['pools'][0]['distribution_count'] == len(rewards)
+    assert [entry['success'] for entry in summary['targets']] == [True, False]
+    assert 'claims' not in summary['merkle']
+    assert len(data) < len(repr(distribution)) / 2
+    assert join_distribution(summary, data) == distribution
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+from poolmonitor import merkle
+from poolmonitor.merkle import (MerkleTree, verify_proof,
+                                get_distribution_tree, get_previous_amounts)
+
+__author__ = "Moshe Malawach"
+__copyright__ = "Moshe Malawach"
+__license__ = "mit"
+
+
+@pytest.mark.parametrize("count", [1, 2, 3, 7, 64, 101])
+def test_merkle_proofs(count):
+    amounts = {f"0x{i*7919:040x}": i * 10**18 + 1 for i in range(1, count + 1)}
+    tree = MerkleTree(amounts)
+    for address, amount in amounts.items():
+        claim = tree.claim(address)
+        assert int(claim['amount']) == amount
+        assert verify_proof(tree.root, address, amount, claim['proof'])
+        assert not verify_proof(tree.root, address, amount + 1,
+                                claim['proof'])
+
+
+def test_merkle_leaves_sorted():
+    amounts = {"0x00000000000000000000000000000000000000ff": 1,
+               "0x00000000000000000000000000000000000000aa": 2}
+    tree = MerkleTree(amounts)
+    assert tree.accounts[0] == "0x00000000000000000000000000000000000000aa"
+    assert MerkleTree(dict(reversed(list(amounts.items())))).root == tree.root
+
+
+def test_merkle_cumulative(monkeypatch):
+    first = {"0x00000000000000000000000000000000000000aA": 5,
+             "0x00000000000000000000000000000000000000bb": 7}
+    tree = get_distribution_tree(first, dict())
+    post = {'item_hash': 'first', 'content': {
+        'status': 'distribution', 'targets': [{'success': True}],
+        'merkle': tree.to_dict()}}
+    failed = {'item_hash': 'failed', 'content': {
+        'status': 'distribution', 'targets': [{'success': False}],
+        'merkle': get_distribution_tree({"0x" + "cc" * 20: 1}, dict()).to_dict()}}
+    monkeypatch.setattr(merkle, 'iter_distribution_posts',
+                        lambda: iter([failed, post]))
+
+    # Failed distributions are skipped.
+    previous = get_previous_amounts()
+    assert previous == {"0x00000000000000000000000000000000000000aa": 5,
+                        "0x00000000000000000000000000000000000000bb": 7}
+
+    second = {"0x00000000000000000000000000000000000000AA": 3,
+              "0x00000000000000000000000000000000000000dd": 1}
+    tree = get_distribution_tree(second, previous)
+    assert tree.amounts == {"0x00000000000000000000000000000000000000aa": 8,
+                            "0x00000000000000000000000000000000000000bb": 7,
+                            "0x00000000000000000000000000000000000000dd": 1}
+    for address, amount in tree.amounts.items():
+        assert verify_proof(tree.root, address, amount,
+                            tree.claim(address)['proof'])
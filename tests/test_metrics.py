@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+import json
+import time
+
+import pytest
+from poolmonitor import metrics
+
+__author__ = "Moshe Malawach"
+__copyright__ = "Moshe Malawach"
+__license__ = "mit"
+
+
+@pytest.fixture
+def enabled():
+    metrics.enable()
+    yield
+    metrics.metrics.enabled = False
+    metrics.metrics.reset()
+
+
+def test_disabled_records_nothing():
+    metrics.inc('logs_fetched', 10, pool='a')
+    with metrics.timed('replay', pool='a'):
+        pass
+    metrics.record_rpc('eth_call', 'http://node', time.perf_counter())
+    assert metrics.to_dict()['counters'] == []
+    assert metrics.to_dict()['histograms'] == []
+
+
+def test_metrics_records(enabled, tmp_path):
+    for latency in (0.003, 0.2, 0.2, 7):
+        metrics.record_rpc('eth_getLogs', 'https://node.example/v3/secret',
+                           time.perf_counter() - latency, 100, 2000)
+    metrics.record_rpc('eth_call', 'https://node.example/v3/secret',
+                       time.perf_counter(), error=True)
+    metrics.inc('logs_fetched', 1000, pool='a')
+    with metrics.timed('decode', pool='a'):
+        metrics.inc('events_decoded', 1000, pool='a')
+
+    requests = metrics.get_counters('rpc_requests')
+    assert requests[(('endpoint', 'node.example'),
+                     ('method', 'eth_getLogs'))] == 4
+    histogram = metrics.metrics.histograms[
+        ('rpc_latency_seconds', (('endpoint', 'node.example'),
+                                 ('method', 'eth_getLogs')))]
+    assert histogram.count == 4
+    assert histogram.quantile(0.5) == 0.25
+    assert histogram.quantile(0.95) == 10
+
+    prometheus = metrics.to_prometheus()
+    assert ('poolmonitor_rpc_errors_total{endpoint="node.example",'
+            'method="eth_call"} 1') in prometheus
+    assert ('poolmonitor_rpc_latency_seconds_bucket{endpoint="node.example",'
+            'method="eth_getLogs",le="+Inf"} 4') in prometheus
+    assert 'secret' not in prometheus
+
+    summary = metrics.format_summary()
+    assert 'eth_getLogs' in summary and 'decode' in summary
+
+    path = tmp_path / 'metrics.json'
+    metrics.write_metrics(path)
+    assert json.load(open(path))['counters']
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+import pytest
+from poolmonitor.pipeline import Pipeline, iter_batches, queue_depths
+
+__author__ = "Moshe Malawach"
+__copyright__ = "Moshe Malawach"
+__license__ = "mit"
+
+
+def test_pipeline_order():
+    pipeline = Pipeline('test', iter_batches(range(10), 3),
+                        [('sum', sum), ('double', lambda x: 2 * x)])
+    assert list(pipeline) == [6, 24, 42, 18]
+
+
+def test_pipeline_error():
+    def fail(batch):
+        raise ValueError("bad batch")
+    with pytest.raises(ValueError):
+        list(Pipeline('test', iter_batches(range(10), 3), [('fail', fail)]))
+
+
+def test_pipeline_backpressure_and_close():
+    produced = list()
+    closed = threading.Event()
+
+    def source():
+        try:
+            for i in range(1000):
+                produced.append(i)
+                yield i
+        finally:
+            closed.set()
+
+    pipeline = Pipeline('test', source(), [('noop', lambda x: x)],
+                        queue_size=2)
+    items = iter(pipeline)
+    assert next(items) == 0
+    time.sleep(0.3)
+    # Two queues of two items, one in each thread.
+    assert len(produced) <= 7
+    assert 'test' in queue_depths()
+    items.close()
+    assert closed.wait(1)
+    assert 'test' not in queue_depths()
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+import pytest
+from web3.providers.base import BaseProvider
+from poolmonitor.providers import ProviderPool
+
+__author__ = "Moshe Malawach"
+__copyright__ = "Moshe Malawach"
+__license__ = "mit"
+
+
+class FakeProvider(BaseProvider):
+    def __init__(self, name, delay=0, fail=False):
+        self.endpoint_uri = name
+        self.delay = delay
+        self.fail = fail
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def make_request(self, method, params):
+        with self.lock:
+            self.calls += 1
+        time.sleep(self.delay)
+        if self.fail:
+            raise ConnectionError(self.endpoint_uri)
+        return {'jsonrpc': '2.0', 'id': 1, 'result': self.endpoint_uri}
+
+
+def test_failover():
+    down, up = FakeProvider('down', fail=True), FakeProvider('up')
+    pool = ProviderPool([down, up])
+    for _ in range(5):
+        assert pool.make_request('eth_blockNumber', [])['result'] == 'up'
+    # Scored down after its failure, the healthy endpoint gets the rest.
+    assert down.calls == 1
+
+
+def test_cooldown():
+    down = FakeProvider('down', fail=True)
+    pool = ProviderPool([down], max_failures=2, cooldown=60)
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            pool.make_request('eth_call', [])
+    assert not pool.endpoints[0].available
+
+
+def test_all_failing():
+    pool = ProviderPool([FakeProvider('a', fail=True),
+                         FakeProvider('b', fail=True)])
+    with pytest.raises(ConnectionError):
+        pool.make_request('eth_call', [])
+
+
+def test_hedged_request():
+    slow, fast = FakeProvider('slow', delay=1), FakeProvider('fast')
+    pool = ProviderPool([slow, fast], hedge_delay=0.05)
+    pool.endpoints[1].error_rate = 0.5
+    started = time.monotonic()
+    assert pool.make_request('eth_getLogs', [{}])['result'] == 'fast'
+    assert time.monotonic() - started < 0.5
+    assert slow.calls == fast.calls == 1
+
+
+def test_writes_not_hedged():
+    slow, fast = FakeProvider('slow', delay=0.2), FakeProvider('fast')
+    pool = ProviderPool([slow, fast], hedge_delay=0.05)
+    pool.endpoints[1].error_rate = 0.5
+    assert pool.make_request('eth_sendRawTransaction', ['0x'])['result'] \
+        == 'slow'
+    assert fast.calls == 0
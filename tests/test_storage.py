@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+from poolmonitor.storage import TransferStore
+
+__author__ = "Moshe Malawach"
+__copyright__ = "Moshe Malawach"
+__license__ = "mit"
+
+ALICE = "0x00000000000000000000000000000000000000a1"
+BOB = "0x00000000000000000000000000000000000000b0"
+ZERO = "0x0000000000000000000000000000000000000000"
+
+
+def make_store(tmp_path):
+    store = TransferStore(str(tmp_path / "pool.sqlite3"))
+    store.add_transfers([
+        (10, 0, "0xaa", ZERO, ALICE, 10**30),
+        (12, 3, "0xbb", ALICE, BOB, 5),
+        (12, 1, "0xbb", ZERO, BOB, 7),
+        (20, 0, "0xcc", BOB, ALICE, 2),
+    ], 25)
+    return store
+
+
+def test_transfers_roundtrip(tmp_path):
+    store = make_store(tmp_path)
+    assert store.synced_height == 25
+    assert [t[:2] for t in store.iter_transfers()] == [
+        (10, 0), (12, 1), (12, 3), (20, 0)]
+    assert list(store.iter_transfers(10, 12))[-1] == (
+        12, 3, "0xbb", ALICE, BOB, 5)
+    assert store.last_block_hash(19) == (12, "0xbb")
+
+
+def test_rewind_keeps_snapshots_unless_asked(tmp_path):
+    store = make_store(tmp_path)
+    store.save_snapshot(15, 12, {ALICE: 10**30 - 5, BOB: 12})
+    store.save_snapshot(22, 20, {ALICE: 10**30 - 3, BOB: 10})
+
+    store.rewind(18, snapshots=False)
+    assert store.synced_height == 18
+    assert [t[0] for t in store.iter_transfers()] == [10, 12, 12]
+    assert store.load_snapshot(100)[0] == 22
+
+    assert store.load_snapshot(21) == (15, 12, {ALICE: 10**30 - 5, BOB: 12})
+    assert store.load_snapshot(14) is None
+
+    store.rewind(12)
+    assert store.load_snapshot(100) is None
+
+
+def test_reserves_flag(tmp_path):
+    store = TransferStore(str(tmp_path / "pool.sqlite3"))
+    store.add_transfers([], 10, [(5, 0, "0xaa", True, 1, 2)])
+    assert store.get_meta('reserves') is True
+    # Synced without the reserve changes, the reserves table has a gap.
+    store.add_transfers([], 20)
+    assert store.get_meta('reserves') is False
+
+
+def test_reserves_roundtrip(tmp_path):
+    store = make_store(tmp_path)
+    store.add_transfers([], 30, [(12, 2, "0xbb", True, 10**20, 7),
+                                 (21, 0, "0xdd", False, -5, 0),
+                                 (11, 0, "0xab", True, 1, 2)])
+    assert list(store.iter_reserves()) == [
+        (11, 0, "0xab", True, 1, 2), (12, 2, "0xbb", True, 10**20, 7),
+        (21, 0, "0xdd", False, -5, 0)]
+    assert list(store.iter_reserves(11, 20)) == [
+        (12, 2, "0xbb", True, 10**20, 7)]
+
+    store.save_snapshot(15, 12, {ALICE: 1}, (10**20, 7))
+    store.save_snapshot(22, 20, {ALICE: 1})
+    assert store.load_reserve_snapshot(15) == (10**20, 7)
+    assert store.load_reserve_snapshot(22) is None
+
+    store.rewind(14)
+    assert [r[0] for r in store.iter_reserves()] == [11, 12]
+    assert store.load_reserve_snapshot(15) is None
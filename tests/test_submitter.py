@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+
+from types import SimpleNamespace
+
+import pytest
+from hexbytes import HexBytes
+from web3.exceptions import TransactionNotFound
+from poolmonitor import submitter
+from poolmonitor.settings import config
+from poolmonitor.submitter import BatchSubmitter
+
+__author__ = "Moshe Malawach"
+__copyright__ = "Moshe Malawach"
+__license__ = "mit"
+
+SENDER = "0x" + "aa" * 20
+GAS_PRICE = 100
+
+
+class FakeFunction:
+    def __init__(self, contract, name, args):
+        self.contract = contract
+        self.name = name
+        self.args = args
+
+    def call(self):
+        return self.contract.balance
+
+    def buildTransaction(self, tx):
+        return dict(tx, data=(self.name, self.args))
+
+    def estimateGas(self, tx):
+        return self.contract.estimate(*self.args)
+
+
+class FakeContract:
+    def __init__(self, balance=10**30, estimate=None):
+        self.balance = balance
+        self.estimate = estimate
+        self.functions = SimpleNamespace(
+            balanceOf=lambda *args: FakeFunction(self, 'balanceOf', args),
+            batchTransfer=lambda *args: FakeFunction(self, 'batchTransfer',
+                                                     args))
+
+
+class FakeAccount:
+    address = SENDER
+
+    def signTransaction(self, tx):
+        return SimpleNamespace(rawTransaction=tx)
+
+
+class FakeEth:
+    """Chain mining, at each nonce, the best priced transaction paying at
+    least `min_gas_price`.
+
+    Nonces in `reverts` are mined failed, those in `taken` by a transaction
+    sent from elsewhere, and sending a transaction with a nonce in
+    `send_errors` fails.
+    """
+
+    def __init__(self, nonce=0, min_gas_price=0, reverts=(), taken=(),
+                 send_errors=()):
+        self.nonce = nonce
+        self.min_gas_price = min_gas_price
+        self.reverts = reverts
+        self.taken = taken
+        self.send_errors = send_errors
+        self.sent = list()
+        self.receipts = dict()
+
+    def getTransactionCount(self, address, block_identifier='latest'):
+        return self.nonce
+
+    def sendRawTransaction(self, tx):
+        if tx['nonce'] in self.send_errors:
+            raise ValueError({'code': -32000, 'message': 'nonce too low'})
+        tx_hash = HexBytes(len(self.sent).to_bytes(32, 'big'))
+        self.sent.append((tx_hash.hex(), tx))
+        self.mine()
+        return tx_hash
+
+    def mine(self):
+        while True:
+            if self.nonce in self.taken:
+                self.nonce += 1
+                continue
+            candidates = [(tx['gasPrice'], tx_hash)
+                          for tx_hash, tx in self.sent
+                          if tx['nonce'] == self.nonce
+                          and tx['gasPrice'] >= self.min_gas_price]
+            if not candidates:
+                return
+            gas_price, tx_hash = max(candidates)
+            self.receipts[tx_hash] = {
+                'status': 0 if self.nonce in self.reverts else 1}
+            self.nonce += 1
+
+    def getTransactionReceipt(self, tx_hash):
+        if tx_hash not in self.receipts:
+            raise TransactionNotFound(tx_hash)
+        return self.receipts[tx_hash]
+
+
+class FakeWeb3:
+    def __init__(self, eth):
+        self.eth = eth
+
+    def toChecksumAddress(self, address):
+        return address
+
+
+@pytest.fixture
+def tx_config(monkeypatch):
+    monkeypatch.setitem(config, 'web3', {'chain_id': 1})
+    monkeypatch.setitem(config, 'transactions', {
+        'poll_interval': 0.01, 'receipt_timeout': 2, 'replace_after': 0,
+        'gas_bump': 1.125, 'max_replacements': 2})
+    monkeypatch.setattr(submitter, 'get_gas_price', lambda chain_id: GAS_PRICE)
+
+
+def make_batches(count):
+    return [({f"0x{i:040x}": (i + 1) * 10**18}, 50000) for i in range(count)]
+
+
+def submit(eth, batches, contract=None):
+    metadata = dict()
+    batch_submitter = BatchSubmitter(FakeWeb3(eth), FakeAccount(),
+                                     contract or FakeContract(), metadata)
+    batch_submitter.submit(batches)
+    batch_submitter.wait()
+    return metadata
+
+
+def test_submit_mined(tx_config):
+    eth = FakeEth(nonce=7)
+    metadata = submit(eth, make_batches(3))
+    # Signed up front with consecutive nonces from the pending count.
+    assert [tx['nonce'] for tx_hash, tx in eth.sent] == [7, 8, 9]
+    assert all(tx['gasPrice'] == GAS_PRICE for tx_hash, tx in eth.sent)
+    assert [(entry['status'], entry['success'], entry['tx'])
+            for entry in metadata['targets']] == [
+        ('mined', True, tx_hash) for tx_hash, tx in eth.sent]
+    assert metadata['targets'][1]['contract_total'] == str(2 * 10**18)
+    assert metadata['targets'][1]['total'] == 2
+
+
+def test_submit_failed_and_replaced(tx_config):
+    eth = FakeEth(nonce=0, reverts={0}, taken={1})
+    metadata = submit(eth, make_batches(3))
+    assert [(entry['status'], entry['success'])
+            for entry in metadata['targets']] == [
+        ('failed', False), ('replaced', False), ('mined', True)]
+
+
+def test_submit_gas_bump(tx_config):
+    # Only mined once the gas price is bumped once.
+    eth = FakeEth(min_gas_price=GAS_PRICE + 1)
+    metadata = submit(eth, make_batches(2))
+    assert [(tx['nonce'], tx['gasPrice']) for tx_hash, tx in eth.sent] == [
+        (0, GAS_PRICE), (1, GAS_PRICE), (0, 113), (1, 113)]
+    assert [(entry['status'], entry['tx']) for entry in metadata['targets']] \
+        == [('mined', eth.sent[2][0]), ('mined', eth.sent[3][0])]
+
+
+def test_submit_dropped(tx_config, monkeypatch):
+    monkeypatch.setitem(config['transactions'], 'receipt_timeout', 0.2)
+    eth = FakeEth(min_gas_price=10**9)
+    metadata = submit(eth, make_batches(1))
+    # Replaced up to `max_replacements` times, then left pending.
+    assert len(eth.sent) == 3
+    entry, = metadata['targets']
+    assert entry['status'] == 'pending'
+    assert entry['tx'] == eth.sent[-1][0]
+
+
+def test_submit_send_error(tx_config):
+    eth = FakeEth(send_errors={1})
+    metadata = submit(eth, make_batches(3))
+    # The later nonces could never be mined, they are not sent.
+    assert [tx['nonce'] for tx_hash, tx in eth.sent] == [0]
+    assert [(entry['status'], entry['success'])
+            for entry in metadata['targets']] == [
+        ('mined', True), ('failed', False), ('failed', False)]
+
+
+def test_submit_balance_too_low(tx_config):
+    eth = FakeEth()
+    metadata = submit(eth, make_batches(2), FakeContract(balance=10**18))
+    assert not eth.sent
+    assert [entry['status'] for entry in metadata['targets']] == [
+        'failed', 'failed']
+
+
+@pytest.fixture
+def gas_config(monkeypatch):
+    monkeypatch.setitem(config, 'gas', {
+        'ceiling': 200000, 'base': 40000, 'existing_holder': 12000,
+        'new_holder': 30000, 'margin': 1})
+    monkeypatch.setitem(config, 'batch_size', None)
+
+
+def pack(monkeypatch, to_distribute, holders, estimate=None):
+    def no_estimate(addresses, amounts):
+        raise ValueError("execution reverted")
+
+    monkeypatch.setattr(submitter, 'get_holders',
+                        lambda web3, contract, addresses: set(holders))
+    return submitter.pack_batches(
+        to_distribute, FakeWeb3(FakeEth()),
+        FakeContract(estimate=estimate or no_estimate), FakeAccount())
+
+
+def get_amounts(count):
+    return {f"0x{i:040x}": i + 1 for i in range(count)}
+
+
+def test_pack_batches_gas(gas_config, monkeypatch):
+    to_distribute = get_amounts(50)
+    holders = list(to_distribute)[::2]
+    batches = pack(monkeypatch, to_distribute, holders)
+    assert all(gas <= 200000 for targets, gas in batches)
+    # Modeled gas, as the node can't estimate.
+    for targets, gas in batches:
+        assert gas == 40000 + sum(address in holders and 12000 or 30000
+                                  for address in targets)
+    merged = dict()
+    for targets, gas in batches:
+        merged.update(targets)
+    assert list(merged.items()) == list(to_distribute.items())
+
+
+def test_pack_batches_new_holders(gas_config, monkeypatch):
+    to_distribute = get_amounts(26)
+    # (200000 - 40000) // 12000 existing holders fit, 5 new ones.
+    batches = pack(monkeypatch, to_distribute, to_distribute)
+    assert [len(targets) for targets, gas in batches] == [13, 13]
+    batches = pack(monkeypatch, to_distribute, [])
+    assert [len(targets) for targets, gas in batches] == [5, 5, 5, 5, 5, 1]
+
+
+def test_pack_batches_size(gas_config, monkeypatch):
+    monkeypatch.setitem(config, 'batch_size', 4)
+    batches = pack(monkeypatch, get_amounts(10), get_amounts(10))
+    assert [len(targets) for targets, gas in batches] == [4, 4, 2]
+
+
+def test_pack_batches_estimate_split(gas_config, monkeypatch):
+    # The node estimates twice the model, batches are split to fit.
+    def estimate(addresses, amounts):
+        return 2 * (40000 + 12000 * len(addresses))
+
+    batches = pack(monkeypatch, get_amounts(13), get_amounts(13), estimate)
+    assert [len(targets) for targets, gas in batches] == [3, 3, 3, 4]
+    assert all(gas <= 200000 for targets, gas in batches)
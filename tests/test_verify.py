@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+import sys
+from pathlib import Path
+
+import pytest
+import yaml
+import poolmonitor
+from poolmonitor import uniswap
+from poolmonitor.settings import config
+from poolmonitor.cassette import get_cassette
+from poolmonitor.storage import open_store
+from poolmonitor.ethereum import get_web3, get_token_contract
+from poolmonitor.commands import process_pools, get_distribution
+from poolmonitor.verify import verify, get_chains
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'benchmarks'))
+from synthetic_chain import SyntheticChain, serve, TOKEN, MULTICALL  # noqa
+
+__author__ = "Moshe Malawach"
+__copyright__ = "Moshe Malawach"
+__license__ = "mit"
+
+
+def clear_connections():
+    get_web3.cache_clear()
+    get_token_contract.cache_clear()
+    get_cassette.cache_clear()
+
+
+@pytest.fixture
+def synthetic(tmp_path):
+    chain = SyntheticChain(holders=40, events=1500, blocks=6000, pools=2)
+    server = serve(chain)
+    saved = dict(config)
+    with open(Path(poolmonitor.__file__).parent / 'config_default.yaml') as f:
+        config.update(yaml.safe_load(f))
+    config['web3'].update(url=server.url, urls=[], mode='rpc', chain_id=1,
+                          multicall_address=MULTICALL, big_block_range=2000)
+    config['pools'] = [{'address': pool.address,
+                        'start_height': chain.start_height,
+                        'type': 'uniswap'}
+                       for pool in chain.pools.values()]
+    config['reward_start'] = chain.start_height
+    config['token']['address'] = TOKEN
+    config['cache'].update(enabled=True, path=str(tmp_path / 'cache'))
+    config['verify'].update(processes=2)
+    clear_connections()
+    uniswap.set_pools()
+    try:
+        yield chain
+    finally:
+        server.shutdown()
+        config.clear()
+        config.update(saved)
+        clear_connections()
+
+
+def make_post(item_hash, start_height, end_height):
+    pools = config['pools']
+    pool_weights = {pools[0]['address']: 0.25, pools[1]['address']: 0.75}
+    per_block = config['reward_per_block']
+    results = process_pools(pools, per_block, pool_weights, start_height,
+                            end_height)
+    distribution, to_distribute = get_distribution(pools, results,
+                                                   pool_weights, per_block)
+    distribution.update(status='distribution', targets=[{'success': True}])
+    return {'item_hash': item_hash, 'content': distribution}
+
+
+def test_get_chains():
+    assert get_chains([(5, 9), (0, 4), (3, 9), (10, 12), (5, 9)]) == [
+        [(0, 4), (5, 9), (10, 12)], [(3, 9)], [(5, 9)]]
+
+
+def test_verify(synthetic):
+    start = synthetic.start_height
+    posts = [make_post('first', start, start + 2500),
+             make_post('second', start + 2501, start + 6000),
+             # A re-run overlapping both.
+             make_post('rerun', start + 1000, start + 6000)]
+
+    second_pool = posts[1]['content']['pools'][1]
+    rewards = second_pool['distribution']
+    corrupted, *others = sorted(rewards, key=rewards.get, reverse=True)
+    rewards[corrupted] *= 1.01
+    # Rounding well within the tolerance.
+    rewards[others[0]] *= 1 + 1e-12
+
+    report = verify(posts, config['pools'])
+    assert len(report) == 6
+    failed = [entry for entry in report if not entry['ok']]
+    assert len(failed) == 1
+    assert failed[0]['hash'] == 'second'
+    assert failed[0]['pool'] == second_pool['address']
+    assert list(failed[0]['differences']) == [corrupted]
+    posted, computed = failed[0]['differences'][corrupted]
+    assert posted == pytest.approx(computed * 1.01)
+
+
+def test_verify_read_only(synthetic):
+    start = synthetic.start_height
+    posts = [make_post('first', start, start + 2500),
+             make_post('second', start + 2501, start + 6000)]
+    # Drop the snapshots saved while computing the posts.
+    for pool in config['pools']:
+        store = open_store(pool)
+        store.rewind(start)
+        store.close()
+
+    assert all(entry['ok'] for entry in verify(posts, config['pools']))
+    # The workers only read the caches filled by the parent.
+    for pool in config['pools']:
+        store = open_store(pool)
+        assert store.load_snapshot(start + 6000) is None
+        store.close()
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+import random
+import time
+
+import pytest
+from hexbytes import HexBytes
+from poolmonitor import watch
+from poolmonitor.accrual import RewardAccrual
+from poolmonitor.settings import config
+from poolmonitor.watch import PoolWatcher, Watcher
+
+__author__ = "Moshe Malawach"
+__copyright__ = "Moshe Malawach"
+__license__ = "mit"
+
+ZERO = "0x0000000000000000000000000000000000000000"
+POOL = {'address': "0x" + "11" * 20, 'start_height': 0}
+
+
+class FakeChain:
+    """Transfers and block hashes of a chain, `reorg` replacing the blocks
+    above a height."""
+
+    def __init__(self, height, seed=0):
+        self.rnd = random.Random(seed)
+        self.holders = [f"0x{i:040x}" for i in range(1, 6)]
+        self.transfers = list()
+        self.hashes = dict()
+        self.height = 0
+        self.extend(height)
+
+    def extend(self, height, fork=0):
+        for block in range(self.height + 1, height + 1):
+            self.hashes[block] = HexBytes(bytes([fork])
+                                          + block.to_bytes(31, 'big'))
+            if self.rnd.random() < 0.3:
+                src = self.rnd.choice([ZERO] + self.holders)
+                self.transfers.append((block, 0, self.hashes[block].hex(), src,
+                                       self.rnd.choice(self.holders),
+                                       self.rnd.randrange(1, 10**18)))
+        self.height = height
+
+    def reorg(self, height, fork=1):
+        end = self.height
+        self.transfers = [t for t in self.transfers if t[0] <= height]
+        self.height = height
+        self.extend(end, fork)
+
+    def replay(self, reward_start, end_height):
+        accrual = RewardAccrual(reward_start)
+        last_event_height = None
+        for height, log_index, block_hash, src, dst, amount in self.transfers:
+            if height > end_height:
+                break
+            accrual.transfer(height, src, dst, amount)
+            last_event_height = height
+        return accrual, last_event_height, None
+
+
+class FakeEth:
+    def __init__(self, chain):
+        self.chain = chain
+
+    @property
+    def blockNumber(self):
+        return self.chain.height
+
+    def getBlock(self, height):
+        return {'hash': self.chain.hashes[height]}
+
+
+class FakeWeb3:
+    def __init__(self, chain):
+        self.eth = FakeEth(chain)
+
+
+@pytest.fixture
+def chain(monkeypatch, tmp_path):
+    chain = FakeChain(300)
+    monkeypatch.setitem(config, 'reward_start', 0)
+    monkeypatch.setitem(config, 'web3', {'chain_id': 1})
+    monkeypatch.setitem(config, 'watch', {
+        'confirmations': 10, 'checkpoint_path': str(tmp_path / 'watch.json'),
+        'every_blocks': 100})
+    monkeypatch.setattr(watch, 'replay_history',
+                        lambda pool, reward_start, height:
+                        chain.replay(reward_start, height))
+    monkeypatch.setattr(watch, 'fetch_transfers',
+                        lambda web3, pool, after, end, reserves=None:
+                        iter([t for t in chain.transfers
+                              if after < t[0] <= end]))
+    return chain
+
+
+def assert_same_state(watcher, chain, end_height):
+    accrual, last_event_height, _ = chain.replay(watcher.reward_start,
+                                                 end_height)
+    assert watcher.last_event_height == last_event_height
+    assert watcher.accrual.finalize(end_height) == accrual.finalize(end_height)
+    assert watcher.accrual.total_weight == accrual.total_weight
+
+
+def test_advance(chain):
+    web3 = FakeWeb3(chain)
+    watcher = PoolWatcher(POOL, 50)
+    watcher.rebuild(web3, 100)
+    for height in (150, 151, 290):
+        watcher.advance(web3, height)
+    assert watcher.height == 290
+    assert_same_state(watcher, chain, 290)
+
+
+def test_reorg_rebuild(chain):
+    web3 = FakeWeb3(chain)
+    watcher = PoolWatcher(POOL, 50)
+    watcher.rebuild(web3, 200)
+    chain.reorg(150)
+    watcher.advance(web3, 250)
+    assert watcher.block_hash == chain.hashes[250].hex()
+    assert_same_state(watcher, chain, 250)
+
+
+def test_checkpoint(chain):
+    web3 = FakeWeb3(chain)
+    watcher = Watcher([POOL])
+    watcher.start(web3, 50)
+    # Stopped at the due height, below the safe one.
+    assert watcher.height == 150
+    watcher.watchers[0].advance(web3, 160)
+    watcher.save_checkpoint()
+
+    resumed = Watcher([POOL])
+    resumed.start(web3, 0)
+    assert resumed.window_start == 50
+    assert resumed.window_opened == watcher.window_opened
+    assert resumed.watchers[0].to_dict() == watcher.watchers[0].to_dict()
+    assert_same_state(resumed.watchers[0], chain, 160)
+
+    # Not resumed for other pools.
+    other = Watcher([POOL, dict(POOL, address="0x" + "22" * 20)])
+    assert not other.load_checkpoint()
+
+
+def test_is_due(chain, monkeypatch):
+    web3 = FakeWeb3(chain)
+    watcher = Watcher([POOL, dict(POOL, address="0x" + "22" * 20)])
+    watcher.start(web3, 50)
+    assert watcher.is_due()
+
+    # Every pool has to reach the same height.
+    watcher.watchers[1].height = 120
+    assert not watcher.is_due()
+    watcher.watchers[0].height = 120
+    assert not watcher.is_due()
+
+    monkeypatch.setattr(watcher, 'every_seconds', 60)
+    watcher.window_opened = time.time() - 30
+    assert not watcher.is_due()
+    watcher.window_opened = time.time() - 61
+    assert watcher.is_due()
+
+    # Nothing to distribute at the start of the window.
+    for pool_watcher in watcher.watchers:
+        pool_watcher.height = 50
+    assert not watcher.is_due()